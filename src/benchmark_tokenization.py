@@ -0,0 +1,76 @@
+"""
+Benchmark of the word tokenizers of convert_examples_to_crops (see
+word_tokenization.py): the examples of a jsonl shard are converted to
+crops with every backend, the time of each one is printed and the crops
+are compared with the ones of the slow backend
+"""
+import argparse
+import time
+
+import numpy as np
+from transformers import BertTokenizer
+
+import dataset_utils_version2 as dataset_utils
+import word_tokenization
+
+
+def convert(examples, tokenizer, word_tokenizer, args):
+    return dataset_utils.convert_examples_to_crops(examples_gen=examples,
+                                                   tokenizer=tokenizer,
+                                                   max_seq_length=args.max_seq_length,
+                                                   doc_stride=args.doc_stride,
+                                                   max_query_length=args.max_query_length,
+                                                   is_training=True,
+                                                   p_keep_impossible=args.p_keep_impossible,
+                                                   rng_seed=args.seed,
+                                                   word_tokenizer=word_tokenizer)
+
+
+def main(args):
+    tokenizer = BertTokenizer.from_pretrained(args.vocab)
+    tokenizer.add_tokens(dataset_utils.get_add_tokens(do_enumerate=args.do_enumerate))
+
+    args_nq = dataset_utils.get_convert_args1(args.input_file, args.num_samples)
+    entries = dataset_utils.convert_nq_to_squad(False, is_train=True, args=args_nq, keep_tokens=True)
+    examples = list(dataset_utils.read_nq_examples(entries, is_training=True))
+    num_words = sum(len(e.doc_tokens) for e in examples)
+    print("{} examples, {} words".format(len(examples), num_words))
+
+    crops = {}
+    for backend in word_tokenization.BACKENDS:
+        times = []
+        for _ in range(args.repeat):
+            # a new word tokenizer each time, not the one kept by the process, so that its cache starts empty
+            word_tokenizer = word_tokenization.get_word_tokenizer(tokenizer, backend, reuse=False)
+            start = time.perf_counter()
+            crops[backend] = convert(examples, tokenizer, word_tokenizer, args)
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        print("{:>5}: {:.2f}s ({:.0f} words/s), {} crops, {} distinct words".format(
+            backend, best, num_words / best, len(crops[backend]), len(word_tokenizer.cache)))
+
+    reference = crops['slow']
+    for backend in word_tokenization.BACKENDS[1:]:
+        different = sum(1 for a, b in zip(reference, crops[backend])
+                        if not np.array_equal(a.input_ids, b.input_ids) or a.tokens != b.tokens)
+        different += abs(len(reference) - len(crops[backend]))
+        print("{:>5}: {} crops different from the slow backend".format(backend, different))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the word tokenizers.')
+
+    parser.add_argument('--input_file', type=str, default='../TrainData/2.jsonl',
+                        help='Path of the jsonl shard')
+    parser.add_argument('--vocab', type=str, default='bert-base-uncased')
+    parser.add_argument('--num_samples', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs of each backend, the best time is printed')
+    parser.add_argument("--max_seq_length", default=512, type=int)
+    parser.add_argument("--doc_stride", default=256, type=int)
+    parser.add_argument("--max_query_length", default=64, type=int)
+    parser.add_argument('--p_keep_impossible', type=float, default=0.03)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--do_enumerate', action='store_true')
+
+    main(parser.parse_args())
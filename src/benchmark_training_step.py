@@ -0,0 +1,117 @@
+"""
+Benchmark of the metric logging of the training loop of mode_tf.py: the
+same training steps are run on random batches logging the metrics as the
+loop did before (a new summary writer and five scalars at every step, and
+the metrics read by the host for the running averages) and with
+TrainingMetrics (metrics accumulated in variables and written every
+log_every steps), and the steps per second of each one are printed.
+A model with few layers is used by default, so that the overhead of the
+logging is visible also on CPU
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from transformers import BertConfig, AlbertConfig
+
+from model_stuff.TFAlbertForNaturalQuestionAnswering import TFAlbertForNaturalQuestionAnswering
+from model_stuff.TFBertForNaturalQuestionAnswering import TFBertForNaturalQuestionAnswering
+import mode_tf
+
+MODEL_CLASSES = {
+    'bert': (BertConfig, TFBertForNaturalQuestionAnswering, 'bert-base-uncased'),
+    'albert': (AlbertConfig, TFAlbertForNaturalQuestionAnswering, 'albert-base-v2'),
+}
+
+
+def random_batches(num_batches, batch_size, max_seq_length, vocab_size, seed):
+    rng = np.random.RandomState(seed)
+    batches = []
+    for _ in range(num_batches):
+        shape = (batch_size, max_seq_length)
+        batches.append({
+            'input_ids': tf.constant(rng.randint(vocab_size, size=shape), dtype=tf.int32),
+            'attention_mask': tf.ones(shape, dtype=tf.int32),
+            'token_type_ids': tf.constant(rng.randint(2, size=shape), dtype=tf.int32),
+            'start': tf.constant(rng.randint(max_seq_length, size=batch_size), dtype=tf.int32),
+            'end': tf.constant(rng.randint(max_seq_length, size=batch_size), dtype=tf.int32),
+            'long': tf.constant(rng.randint(max_seq_length, size=batch_size), dtype=tf.int32),
+        })
+    return batches
+
+
+def run_per_step_logging(train_step, batches, num_steps, log_dir):
+    # the logging of the loop before TrainingMetrics
+    smooth = 0.99
+    running = np.zeros(len(mode_tf.METRIC_NAMES))
+    for step in range(num_steps):
+        writer = tf.summary.create_file_writer(log_dir)
+        values = train_step(batches[step % len(batches)])
+        with writer.as_default():
+            for name, value in zip(mode_tf.METRIC_NAMES, values):
+                tf.summary.scalar(name, value, step=step)
+        running = smooth * running + (1. - smooth) * np.array([float(v) for v in values])
+
+
+def run_accumulated_logging(train_step, metrics, batches, num_steps, log_every):
+    for step in range(1, num_steps + 1):
+        train_step(batches[step % len(batches)])
+        if step % log_every == 0:
+            metrics.write(step)
+    # waits for the last steps
+    metrics.write(num_steps)
+
+
+def main(args):
+    config_class, model_class, pretrained = MODEL_CLASSES[args.model]
+    config = config_class.from_pretrained(pretrained)
+    config.num_hidden_layers = args.num_hidden_layers
+    mymodel = model_class(config)
+    mymodel(mymodel.dummy_inputs)
+    optimizer = tf.optimizers.Adam(lr=1e-5)
+    batches = random_batches(args.num_batches, args.batch_size, args.max_seq_length, config.vocab_size, args.seed)
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        metrics = mode_tf.TrainingMetrics(tf.summary.create_file_writer(log_dir))
+        runs = {
+            'per step': (mode_tf.make_train_step(mymodel, optimizer),
+                         lambda step_fn, num_steps: run_per_step_logging(step_fn, batches, num_steps, log_dir)),
+            'accumulated': (mode_tf.make_train_step(mymodel, optimizer, metrics),
+                            lambda step_fn, num_steps: run_accumulated_logging(step_fn, metrics, batches,
+                                                                               num_steps, args.log_every)),
+        }
+        steps_per_second = {}
+        for name, (train_step, run) in runs.items():
+            # traces the step
+            run(train_step, args.warmup_steps)
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                run(train_step, args.num_steps)
+                times.append(time.perf_counter() - start)
+            steps_per_second[name] = args.num_steps / min(times)
+            print("{:>11}: {:.2f} steps/s".format(name, steps_per_second[name]))
+
+    print("speedup: {:.2f}x".format(steps_per_second['accumulated'] / steps_per_second['per step']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the metric logging of the training loop.')
+
+    parser.add_argument('--model', type=str, default='albert', choices=list(MODEL_CLASSES))
+    parser.add_argument('--num_hidden_layers', type=int, default=2,
+                        help='Number of layers of the model, its weights are random')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument('--num_batches', type=int, default=8,
+                        help='Number of random batches, used in turn')
+    parser.add_argument('--num_steps', type=int, default=200)
+    parser.add_argument('--warmup_steps', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs of each logging, the best time is printed')
+    parser.add_argument('--log_every', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=42)
+
+    main(parser.parse_args())
@@ -0,0 +1,169 @@
+"""
+On this file we have the checkpoints of the training of mode_tf.py: the
+whole state of the training (weights of the model, moments of the
+optimizer, global step, position in the training files and metrics) is
+saved with tf.train.Checkpoint, so that an interrupted training resumes
+exactly where it stopped.
+A checkpoint is written synchronously in a staging directory in memory
+(/dev/shm), a consistent snapshot of the variables that takes little time,
+and a background thread copies it to the checkpoint directory while the
+training goes on. Every checkpoint directory also has the files written by
+the caller, e.g. weights.h5 for model_evaluation.py
+"""
+import concurrent.futures
+import glob
+import os
+import shutil
+import tempfile
+
+import tensorflow as tf
+
+import shard_utils
+
+# prefix of the files of tf.train.Checkpoint in a checkpoint directory
+STATE_PREFIX = 'state'
+
+CHECKPOINT_PREFIX = 'checkpoint-'
+
+
+def checkpoint_name(step):
+    return '{}{:06d}'.format(CHECKPOINT_PREFIX, step)
+
+
+def is_training_checkpoint(path):
+    """
+    @param path a path given as checkpoint
+
+    @return True if path is a checkpoint directory with the state of the
+        training, False for the old checkpoints with the weights only
+    """
+    return os.path.isfile(os.path.join(path, STATE_PREFIX + '.index'))
+
+
+def list_checkpoints(checkpoint_dir):
+    """
+    @param checkpoint_dir the checkpoint directory
+
+    @return list of the paths of the complete checkpoints, from the oldest
+    """
+    paths = [path for path in glob.glob(os.path.join(checkpoint_dir, CHECKPOINT_PREFIX + '*'))
+             if os.path.basename(path)[len(CHECKPOINT_PREFIX):].isdigit() and is_training_checkpoint(path)]
+    return sorted(paths, key=lambda path: int(os.path.basename(path)[len(CHECKPOINT_PREFIX):]))
+
+
+def latest_checkpoint(checkpoint_dir):
+    """
+    @param checkpoint_dir the checkpoint directory
+
+    @return the path of the last complete checkpoint, None if there is none
+    """
+    paths = list_checkpoints(checkpoint_dir)
+    return paths[-1] if paths else None
+
+
+class AsyncCheckpointer:
+    """
+    Saves and restores the state of the training. The copies to the
+    checkpoint directory are done one at a time by a background thread, a
+    save waits for the copy of the previous one
+    """
+
+    def __init__(self, checkpoint_dir, max_to_keep=2, staging_dir=None, **trackables):
+        """
+        @param checkpoint_dir the checkpoint directory
+        @param max_to_keep number of checkpoints kept, the older ones are
+            deleted
+        @param staging_dir directory of the snapshots, None for SHM_DIR of
+            shard_utils
+        @param trackables the objects saved, passed to tf.train.Checkpoint
+        """
+        if staging_dir is None:
+            staging_dir = shard_utils.memory_dir()
+        self.checkpoint = tf.train.Checkpoint(**trackables)
+        self.checkpoint_dir = checkpoint_dir
+        self.max_to_keep = max_to_keep
+        self.staging_dir = staging_dir
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, step, write_files=None, publish=True):
+        """
+        This function takes the snapshot of the state and starts its copy.
+        With a multi worker strategy every worker must call it: the
+        variables synchronized on read (e.g. the accumulated gradients) are
+        saved with a collective reduce of all the workers
+
+        @param step the global step, in the name of the checkpoint
+        @param write_files function directory -> None that writes other
+            files of the checkpoint, None for none
+        @param publish if False the snapshot is only taken and deleted,
+            for the workers that are not the chief
+        """
+        # the errors of the previous copy are raised here
+        self.wait()
+        staging = tempfile.mkdtemp(prefix=CHECKPOINT_PREFIX, dir=self.staging_dir)
+        try:
+            self.checkpoint.write(os.path.join(staging, STATE_PREFIX))
+            if publish and write_files is not None:
+                write_files(staging)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if not publish:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        self.pending = self.executor.submit(self._publish, staging, checkpoint_name(step))
+
+    def _publish(self, staging, name):
+        # the checkpoint is copied with a temporary name and renamed, so a checkpoint that exists is complete
+        path = os.path.join(self.checkpoint_dir, name)
+        tmp_path = os.path.join(self.checkpoint_dir, '.' + name + '.tmp')
+        try:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            shutil.copytree(staging, tmp_path)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(tmp_path, path)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        # remove too many checkpoints
+        for old_path in list_checkpoints(self.checkpoint_dir)[:-self.max_to_keep]:
+            shutil.rmtree(old_path)
+        return path
+
+    def wait(self):
+        """
+        This function waits for the copy of the last checkpoint
+
+        @return its path, None if there is no copy pending
+        """
+        if self.pending is None:
+            return None
+        pending, self.pending = self.pending, None
+        return pending.result()
+
+    def restore(self, path):
+        """
+        This function restores the state of a checkpoint directory. The
+        variables not created yet (e.g. the moments of the optimizer) are
+        restored when they are created
+
+        @param path the checkpoint directory
+
+        @return the status of tf.train.Checkpoint.restore
+        """
+        status = self.checkpoint.restore(os.path.join(path, STATE_PREFIX))
+        status.assert_existing_objects_matched()
+        return status
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
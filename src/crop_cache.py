@@ -0,0 +1,253 @@
+"""
+On this file we have the cache of the crops of load_and_cache_crops.
+Every entry is addressed by a hash of the content of the input file and
+of all the preprocessing parameters, so the cache holds at the same time
+the crops of many files and configurations. Entries are written
+atomically and, when the cache grows over its maximum size, the least
+recently used ones are deleted.
+The arrays of the crops are saved as .npy files and memory mapped when
+they are read, so loading an entry costs nothing and the processes of a
+host that read the same entry share its pages.
+The same cache keeps the tokenized documents of DocumentStore, in another
+directory
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+# Maximum size of the cache by default, in GB
+CACHE_SIZE_GB = 20.
+
+ENTRY_SUFFIX = '.crops'
+
+# Files of an entry besides the .npy matrices: the side table of the per
+# crop fields, the pickled objects and the parameters it was built with
+METADATA_NAME = 'metadata.npz'
+OBJECTS_NAME = 'objects.pkl'
+PARAMS_NAME = 'params.json'
+
+# Version of the entries, to be increased when the crops change
+FORMAT_VERSION = 2
+
+# Block size used to hash the input files
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+# hashes of the files already hashed, see file_hash
+_file_hashes = {}
+
+
+def file_hash(path):
+    """
+    This function returns the sha1 of the content of a file. The hash is
+    kept by the process until the size or the modification time of the
+    file change
+
+    @param path path of the file
+
+    @return string
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    digest = _file_hashes.get(key)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                sha1.update(block)
+        digest = sha1.hexdigest()
+        _file_hashes[key] = digest
+    return digest
+
+
+def cache_key(input_file, params):
+    """
+    This function returns the key of the crops of a file
+
+    @param input_file path of the input file
+    @param params dictionary of all the parameters the crops depend on,
+        json serializable
+
+    @return string
+    """
+    key = hashlib.sha1(file_hash(input_file).encode())
+    key.update(json.dumps({'format_version': FORMAT_VERSION, 'params': params}, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+def _write_file(path, write):
+    with open(path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _entry_size(path):
+    size = 0
+    for fn in os.listdir(path):
+        try:
+            size += os.stat(os.path.join(path, fn)).st_size
+        except FileNotFoundError:
+            pass
+    return size
+
+
+class CropCache:
+    """
+    Directory of entries of at most max_bytes bytes, evicted in least
+    recently used order (the modification time of an entry is updated
+    every time it is read).
+    An entry is a directory with the arrays of the crops, the matrices as
+    .npy files that are opened with np.memmap and the per crop fields in a
+    small side table, plus some picklable objects
+    """
+
+    def __init__(self, directory, max_bytes=int(CACHE_SIZE_GB * 1024 ** 3)):
+        """
+        @param directory path of the directory of the entries
+        @param max_bytes maximum size of the entries
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def __contains__(self, key):
+        return os.path.isdir(self.entry_path(key))
+
+    def load_arrays(self, key):
+        """
+        This function opens the arrays of an entry. The matrices are memory
+        mapped read only, their pages are read from disk (or from the page
+        cache, shared with the other processes) only when they are used
+
+        @param key the key of the entry
+
+        @return dictionary name -> array
+        """
+        path = self.entry_path(key)
+        with np.load(os.path.join(path, METADATA_NAME)) as metadata:
+            arrays = {name: metadata[name] for name in metadata.files}
+        for fn in os.listdir(path):
+            if fn.endswith('.npy'):
+                arrays[fn[:-len('.npy')]] = np.load(os.path.join(path, fn), mmap_mode='r')
+        return arrays
+
+    def load_objects(self, key):
+        """
+        @param key the key of the entry
+
+        @return the objects of the entry
+        """
+        with open(os.path.join(self.entry_path(key), OBJECTS_NAME), 'rb') as f:
+            return pickle.load(f)
+
+    def get(self, key):
+        """
+        This function reads an entry
+
+        @param key the key of the entry
+
+        @return (dictionary name -> array, objects), None if the entry is
+            missing or unreadable
+        """
+        path = self.entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            value = self.load_arrays(key), self.load_objects(key)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError) as e:
+            print("Could not read the cache entry {}: {}".format(path, e))
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted by another process in the meantime
+            pass
+        return value
+
+    def put(self, key, arrays, objects, params=None, side_table=None):
+        """
+        This function writes an entry and evicts the least recently used
+        ones if the cache is too big
+
+        @param key the key of the entry
+        @param arrays dictionary name -> array, the arrays of the side table
+            are read in memory, the others are saved in .npy files
+        @param objects picklable objects saved with the arrays
+        @param params the parameters of the entry, saved next to it to
+            know what it contains
+        @param side_table names of the arrays of the side table, None for
+            all the arrays with one dimension
+        """
+        path = self.entry_path(key)
+        # the entry is written in a temporary directory and renamed, so
+        # that readers (and other processes writing the same entry) never
+        # see a partial entry
+        tmp_path = tempfile.mkdtemp(dir=self.directory, suffix='.tmp')
+        try:
+            metadata = {}
+            for name, array in arrays.items():
+                in_side_table = array.ndim == 1 if side_table is None else name in side_table
+                if in_side_table:
+                    metadata[name] = array
+                else:
+                    _write_file(os.path.join(tmp_path, name + '.npy'), lambda f: np.save(f, array))
+            _write_file(os.path.join(tmp_path, METADATA_NAME), lambda f: np.savez(f, **metadata))
+            _write_file(os.path.join(tmp_path, OBJECTS_NAME),
+                          lambda f: pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL))
+            if params is not None:
+                _write_file(os.path.join(tmp_path, PARAMS_NAME),
+                              lambda f: f.write(json.dumps(params, indent=2, sort_keys=True).encode()))
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # written in the meantime by another process
+                shutil.rmtree(tmp_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+
+    def entries(self):
+        """
+        @return list of (modification time, size, key) of the entries
+        """
+        entries = []
+        for fn in os.listdir(self.directory):
+            if not fn.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, fn)
+            try:
+                entries.append((os.stat(path).st_mtime, _entry_size(path), fn[:-len(ENTRY_SUFFIX)]))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """
+        This function deletes the least recently used entries until the
+        cache is not bigger than max_bytes. The arrays of a deleted entry
+        that are still mapped by some process stay readable
+
+        @param keep key of an entry that is never deleted
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
+            print("Evicted the cache entry {} ({:.1f} MB)".format(key, size / 1024 ** 2))
@@ -0,0 +1,127 @@
+"""
+On this file we have the TFRecord format of the preprocessed crops (see
+preprocess_crops.py): the crops of every jsonl shard are written as a
+TFRecord file (ids, masks and start/end/long labels of each crop), and
+the training reads all the files as a single tf.data stream,
+interleaving the files and parsing the batches in parallel, instead of
+building an in memory dataset for each shard
+"""
+import os
+
+import numpy as np
+import tensorflow as tf
+
+RECORD_SUFFIX = '.tfrecord'
+
+# raw features of a record: name -> numpy type of the bytes
+RAW_FEATURES = {
+    'input_ids': np.int32,
+    'attention_mask': np.uint8,
+    'token_type_ids': np.uint8,
+}
+
+LABEL_FEATURES = ('start', 'end', 'long')
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def serialize_crop(arrays, index):
+    """
+    This function serializes a crop as a tf.train.Example
+
+    @param arrays dictionary of the arrays of getTokenizedDataset
+    @param index the index of the crop
+
+    @return the serialized example
+    """
+    features = {name: _bytes_feature(np.asarray(arrays[name][index], dtype=dtype).tobytes())
+                for name, dtype in RAW_FEATURES.items()}
+    for name in LABEL_FEATURES:
+        features[name] = _int64_feature(int(arrays[name][index]))
+    return tf.train.Example(features=tf.train.Features(feature=features)).SerializeToString()
+
+
+def write_crop_records(arrays, path):
+    """
+    This function writes the crops of a shard in a TFRecord file. The
+    file is written with a temporary name and renamed, so a file that
+    exists is complete
+
+    @param arrays dictionary of the arrays of getTokenizedDataset
+    @param path path of the TFRecord file
+
+    @return the number of crops written
+    """
+    num_crops = len(arrays['input_ids'])
+    tmp_path = path + '.tmp'
+    with tf.io.TFRecordWriter(tmp_path) as writer:
+        for index in range(num_crops):
+            writer.write(serialize_crop(arrays, index))
+    os.replace(tmp_path, path)
+    return num_crops
+
+
+def parse_crop_batch(serialized, max_seq_length):
+    """
+    This function parses a batch of serialized crops
+
+    @param serialized tensor of strings [batch_size]
+    @param max_seq_length length of the crops
+
+    @return dictionary name -> int32 tensor, like the batches of
+        crop_batches
+    """
+    features = {name: tf.io.FixedLenFeature([], tf.string) for name in RAW_FEATURES}
+    features.update({name: tf.io.FixedLenFeature([], tf.int64) for name in LABEL_FEATURES})
+    parsed = tf.io.parse_example(serialized, features)
+    batch = {}
+    for name, dtype in RAW_FEATURES.items():
+        values = tf.io.decode_raw(parsed[name], tf.as_dtype(dtype))
+        batch[name] = tf.cast(tf.reshape(values, [-1, max_seq_length]), tf.int32)
+    for name in LABEL_FEATURES:
+        batch[name] = tf.cast(parsed[name], tf.int32)
+    return batch
+
+
+def read_crop_records(files, max_seq_length, batch_size, shuffle_buffer=1000, seed=None, repeat=False,
+                      cycle_length=4, skip_batches=0):
+    """
+    This function builds the training dataset of some TFRecord files: the
+    files are read cycle_length at a time and their crops are interleaved,
+    shuffled, batched and parsed in parallel and prefetched
+
+    @param files paths of the TFRecord files
+    @param max_seq_length length of the crops
+    @param batch_size size of the batches, the last incomplete one is dropped
+    @param shuffle_buffer size of the shuffle buffer of the crops, 0 not to
+        shuffle them (nor the files)
+    @param seed seed of the shuffles
+    @param repeat if True the files are read again forever
+    @param cycle_length number of files read at the same time
+    @param skip_batches number of first batches skipped without parsing
+        them (to resume the training from a checkpoint)
+
+    @return tf.data.Dataset of dictionaries name -> tensor [batch_size, ...]
+    """
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle_buffer > 0:
+        dataset = dataset.shuffle(buffer_size=len(files), seed=seed)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.interleave(tf.data.TFRecordDataset,
+                                 cycle_length=min(cycle_length, len(files)),
+                                 num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if shuffle_buffer > 0:
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer, seed=seed)
+    dataset = dataset.batch(batch_size=batch_size, drop_remainder=True)
+    if skip_batches > 0:
+        dataset = dataset.skip(skip_batches)
+    dataset = dataset.map(lambda serialized: parse_crop_batch(serialized, max_seq_length),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
@@ -1,124 +1,253 @@
 import argparse
 import json
+import multiprocessing
 import os
-from pathlib import Path
 import shutil
-import sys
-import tqdm
 
-tmp_path = "tmp.jsonl"
+import shard_utils
 
+DOCUMENT_TEXT_KEY = '"document_text": "'
 
-def dict_size(d):
+
+def count_document_tokens(line):
     """
-    This function returns the size in byte of a dictionary.
-    Notice that it needs to dump it first in order to get the real
-    size of the object when saved onto file
+    This function returns the number of tokens of the document_text of a
+    raw jsonl line, without parsing the whole json object
 
-    @param d the dictionary object
+    @param line the raw line (bytes)
 
-    @return the size in Byte
+    @return number of tokens (the text is split on single spaces)
     """
-    with open(tmp_path, 'w+') as tmp:
-        json.dump(d, tmp)
-    size = os.path.getsize(tmp_path)
-    #print(size)
-    os.remove(tmp_path)
-    return size
+    text = line.decode('utf-8')
+    start = text.find(DOCUMENT_TEXT_KEY)
+    if start == -1:
+        document_text = json.loads(text).get('document_text', '')
+    else:
+        document_text, _ = json.decoder.scanstring(text, start + len(DOCUMENT_TEXT_KEY))
+    return document_text.count(' ') + 1
 
 
-def split_json(path, dest_folder, batch_size, max_size):
+def write_shards(path, dest_folder, batch_size, max_size, start=0, end=None,
+                 prefix='', count_tokens=False, compression='none'):
+    """
+    This function copies the lines of path contained in the byte range
+    [start, end) into shards that contain at most batch_size lines each
+    and do not exceed max_size.
+
+    @param path string containing the path to the file
+    @param dest_folder path fo the destination folder
+    @param batch_size maximum number of lines in each shard
+    @param max_size maximum size of each shard in bytes
+    @param start byte offset of the first line to copy
+    @param end byte offset at which to stop, None to copy up to the end
+    @param prefix prefix of the names of the shards
+    @param count_tokens if True also count the document tokens of each shard
+    @param compression compression of the shards, one of
+        shard_utils.COMPRESSION_SUFFIXES (max_size refers to the
+        uncompressed size)
+
+    @return list of dictionaries, one per shard written, with keys file,
+        num_examples, num_bytes and num_document_tokens
+
+    @raise ValueError if a line is bigger than max_size
+    """
+    suffix = shard_utils.COMPRESSION_SUFFIXES[compression]
+    shards = []
+    dest = None
+    try:
+        with shard_utils.open_shard(path, 'rb') as infile:
+            if start > 0:
+                infile.seek(start)
+            position = start
+            for line in infile:
+                if end is not None and position >= end:
+                    break
+                position += len(line)
+                if not line.strip():
+                    continue
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                line_size = len(line)
+                if line_size > max_size:
+                    # stopping here would leave a hole in the split, in the middle of the file with more ranges
+                    raise ValueError("Error, max size smaller than line size: the line at byte {} of {} has "
+                                     "{} bytes, the maximum size is {}".format(position - len(line), path,
+                                                                                line_size, max_size))
+                # If size threshold would be exceeded or the batch size was
+                # reached close the current shard and open the next one
+                if dest is not None and (shards[-1]['num_bytes'] + line_size > max_size
+                                         or shards[-1]['num_examples'] == batch_size):
+                    dest.close()
+                    dest = None
+                if dest is None:
+                    shard_fn = prefix + str(len(shards)) + suffix
+                    dest = shard_utils.open_shard(os.path.join(dest_folder, shard_fn), 'wb')
+                    shards.append({'file': shard_fn, 'num_examples': 0, 'num_bytes': 0,
+                                   'num_document_tokens': 0})
+                dest.write(line)
+                shards[-1]['num_examples'] += 1
+                shards[-1]['num_bytes'] += line_size
+                if count_tokens:
+                    shards[-1]['num_document_tokens'] += count_document_tokens(line)
+    finally:
+        if dest is not None:
+            dest.close()
+    return shards
+
+
+def split_json(path, dest_folder, batch_size, max_size, compression='none'):
     """
     This function splits jsonline file into chunks that contain
     batch_size lines each and do not exceed max_size.
     In the case in which the batch size leads to a too big json file
     the size constraint is preferred.
 
+    The input is streamed once: every line is sized from the raw bytes
+    already read (no json parsing, no temporary files) and copied as-is
+    into the shard currently open, which is the only output handle kept
+    open at any time.
+
     @param path string containing the path to the file
     @param dest_folder path fo the destination folder
     @param batch_size the number of lines that should be contained
         in each small json file
     @param max_size maximum size of each json file
+    @param compression compression of the shards ('none', 'gzip' or 'xz'),
+        the input file may be compressed as well
     """
 
     #If destination folder already exists delete and recreate it
     if os.path.exists(dest_folder):
         shutil.rmtree(dest_folder)
     os.makedirs(dest_folder)
-    batch_id = 0
-    iter_batch = 1
-    num_lines = 0
-    with open(path) as infile:
-        for line in infile:
-            #print(line[0], line[-2])
-            line_dict = json.loads(line)
-            line_dict_size = dict_size(line_dict)
-            if (line_dict_size > max_size):
-                print("Error, max size smaller than line size")
-                break
-            #If destination file is not present create it
-            curr_dest = dest_folder + str(batch_id) + ".jsonl"
-            if not os.path.exists(curr_dest):
-                Path(curr_dest).touch()
-                #curr_dest.touch()
-            curr_dest_size = os.path.getsize(curr_dest)
-            #print("Size of dest file: {}".format(curr_dest_size))
-            #If size threshold has been reached before
-            #exhausting the batch_size or the batch size was reached
-            #set counters to 0 and dump json file
-            if (curr_dest_size + line_dict_size >
-                    max_size) or (iter_batch == batch_size):
-                batch_id += 1
-                curr_dest = dest_folder + str(batch_id) + ".jsonl"
-                with open(curr_dest, 'a+') as dest:
-                    json.dump(line_dict, dest)
-                    #Add new line
-                    dest.write('\n')
-                if (curr_dest_size + line_dict_size > max_size):
-                    print("------->File of {} rows created".format(iter_batch))
-                else:
-                    print("->File of {} rows created".format(iter_batch))
-                iter_batch = 1
-
-            else:
-                iter_batch += 1
-                #Using write mode, since file already exists (l.51)
-                with open(curr_dest, 'a') as dest:
-                    json.dump(line_dict, dest)
-                    dest.write('\n')
-            num_lines += 1
-        #The last line was written, print #lines of last file
-        print("->File of {} rows created".format(iter_batch - 1))
-
-    print("Total number of lines of original file: {}".format(num_lines))
-
-
-parser = argparse.ArgumentParser(
-    description='Tool for splitting large json files.')
-
-parser.add_argument("--input-file",
-                    metavar="input_file",
-                    default="simplified-nq-train.jsonl",
-                    help="Path of input json file")
-
-parser.add_argument("--batch-size",
-                    metavar="bs",
-                    default=500000,
-                    help="Number of lines contained in a minibatch")
-
-parser.add_argument("--file-max-size",
-                    metavar="max_size",
-                    default=100,
-                    help="Maximum size of file in MB")
-
-parser.add_argument("--dest-folder",
-                    metavar="dest_folder",
-                    default="small_jsons/",
-                    help="Path of destination folder of small jsons")
-
-args = vars(parser.parse_args())
-
-dest_folder = args['dest_folder'].split('/')[0] + "/"
-maximum_size = 1000000 * args['file_max_size']
-
-split_json(args['input_file'], dest_folder, args['batch_size'], maximum_size)
+    shards = write_shards(path, dest_folder, batch_size, max_size, compression=compression)
+    for shard in shards:
+        print("->File of {} rows created".format(shard['num_examples']))
+
+    print("Total number of lines of original file: {}".format(sum(s['num_examples'] for s in shards)))
+
+
+def find_line_boundaries(path, num_ranges):
+    """
+    This function splits a file into num_ranges byte ranges of about the
+    same size, each one starting at the beginning of a line
+
+    @param path string containing the path to the file
+    @param num_ranges number of ranges
+
+    @return list of (start, end) byte offsets
+    """
+    file_size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, num_ranges):
+            f.seek(max(file_size * i // num_ranges, boundaries[-1]))
+            # move to the beginning of the next line
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            boundaries.append(f.tell())
+    boundaries.append(file_size)
+    return [(s, e) for s, e in zip(boundaries[:-1], boundaries[1:]) if e > s]
+
+
+def _write_range_shards(task):
+    range_index, path, dest_folder, batch_size, max_size, start, end, compression = task
+    return write_shards(path, dest_folder, batch_size, max_size, start=start, end=end,
+                        prefix='range{}-'.format(range_index), count_tokens=True,
+                        compression=compression)
+
+
+def split_json_parallel(path, dest_folder, batch_size, max_size, num_workers, compression='none'):
+    """
+    This function splits jsonline file into shards like split_json, but
+    the file is first cut into num_workers byte ranges aligned to lines
+    which are sharded in parallel. The shards are then numbered
+    following their order in the original file and a manifest with the
+    number of examples, the size and the number of document tokens of
+    each shard is written in dest_folder.
+    Notice that the last shard of each range may contain less than
+    batch_size lines.
+
+    @param path string containing the path to the file
+    @param dest_folder path fo the destination folder
+    @param batch_size the number of lines that should be contained
+        in each small json file
+    @param max_size maximum size of each json file
+    @param num_workers number of processes used
+    @param compression compression of the shards ('none', 'gzip' or 'xz'),
+        the input file must not be compressed since it is read by offset
+    """
+    if path.endswith(('.gz', '.xz')):
+        raise ValueError("The input of the parallel sharding must not be compressed: {}".format(path))
+    if os.path.exists(dest_folder):
+        shutil.rmtree(dest_folder)
+    os.makedirs(dest_folder)
+    ranges = find_line_boundaries(path, num_workers)
+    tasks = [(i, path, dest_folder, batch_size, max_size, start, end, compression)
+             for i, (start, end) in enumerate(ranges)]
+    with multiprocessing.Pool(num_workers) as pool:
+        range_shards = pool.map(_write_range_shards, tasks)
+
+    # give the shards their final names K.jsonl, following the file order
+    shards = []
+    for range_shard in range_shards:
+        for shard in range_shard:
+            shard_fn = str(len(shards)) + shard_utils.COMPRESSION_SUFFIXES[compression]
+            os.rename(os.path.join(dest_folder, shard['file']), os.path.join(dest_folder, shard_fn))
+            shard['file'] = shard_fn
+            shards.append(shard)
+            print("->File of {} rows created".format(shard['num_examples']))
+    shard_utils.write_manifest(dest_folder, shards)
+
+    print("Total number of lines of original file: {}".format(sum(s['num_examples'] for s in shards)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Tool for splitting large json files.')
+
+    parser.add_argument("--input-file",
+                        metavar="input_file",
+                        default="simplified-nq-train.jsonl",
+                        help="Path of input json file")
+
+    parser.add_argument("--batch-size",
+                        metavar="bs",
+                        type=int,
+                        default=500000,
+                        help="Number of lines contained in a minibatch")
+
+    parser.add_argument("--file-max-size",
+                        metavar="max_size",
+                        type=int,
+                        default=100,
+                        help="Maximum size of file in MB")
+
+    parser.add_argument("--dest-folder",
+                        metavar="dest_folder",
+                        default="small_jsons/",
+                        help="Path of destination folder of small jsons")
+
+    parser.add_argument("--num-workers",
+                        metavar="num_workers",
+                        type=int,
+                        default=0,
+                        help="If bigger than 0 the input file is split in this number of byte ranges "
+                             "sharded in parallel, and a manifest of the shards is written")
+
+    parser.add_argument("--compression",
+                        choices=sorted(shard_utils.COMPRESSION_SUFFIXES),
+                        default="none",
+                        help="Compression of the shards written")
+
+    args = vars(parser.parse_args())
+
+    dest_folder = args['dest_folder'].split('/')[0] + "/"
+    maximum_size = 1000000 * args['file_max_size']
+
+    if args['num_workers'] > 0:
+        split_json_parallel(args['input_file'], dest_folder, args['batch_size'], maximum_size,
+                            args['num_workers'], args['compression'])
+    else:
+        split_json(args['input_file'], dest_folder, args['batch_size'], maximum_size, args['compression'])
@@ -12,6 +12,8 @@ import gc
 import numpy as np
 import pandas as pd
 import tensorflow as tf
+import shard_utils
+import word_tokenization
 from tqdm.notebook import tqdm
 from transformers import BertConfig, BertTokenizer, RobertaConfig, RobertaTokenizer, AlbertTokenizer, AlbertConfig, \
     AutoTokenizer
@@ -88,7 +90,7 @@ def read_candidates(candidate_files, do_cache=True):
     question = {}
     if not os.path.exists(cache_fn):
         for fn in candidate_files:
-            with open(fn) as f:
+            with shard_utils.open_shard(fn) as f:
                 for line in tqdm(f):  # tqdm è la progress bar
                     entry = json.loads(line)
                     example_id = str(entry['example_id'])
@@ -269,13 +271,16 @@ def convert_examples_to_crops(examples_gen, tokenizer, max_seq_length,
                               pad_token_segment_id=0,
                               mask_padding_with_zero=True,
                               p_keep_impossible=None,
-                              sep_token_extra=False):
+                              sep_token_extra=False,
+                              word_tokenizer=None):
     """
            Trasforma gli NQExample in Crops
 
            @param examples_gen gli example da convertire in crops
            @param tokenizer
            @param max_seq_length lunghezza massima (FORSE) fra domanda+risposta
+           @param word_tokenizer tokenizer delle parole dei documenti, con la sua cache
+               (vedi word_tokenization), se None le parole sono tokenizzate da tokenizer.tokenize
            @:var
            @return list of Crops
            """
@@ -283,13 +288,14 @@ def convert_examples_to_crops(examples_gen, tokenizer, max_seq_length,
     unique_id = 1000000000
     num_short_pos, num_short_neg = 0, 0
     num_long_pos, num_long_neg = 0, 0
-    sub_token_cache = {}
+    if word_tokenizer is None:
+        word_tokenizer = word_tokenization.WordTokenizer(tokenizer)
     # max_N, max_M = 1024, 1024
     # f = np.zeros((max_N, max_M), dtype=np.float32)
 
     crops = []
     # print("Dimensione Example: " +str(examples_gen)
-    for example_index, example in enumerate(examples_gen):
+    for example_index, example in enumerate(word_tokenizer.prefetch(examples_gen)):
         if example_index % 1000 == 0 and example_index > 0:
             print('Converting %s: short_pos %s short_neg %s'
                   ' long_pos %s long_neg %s',
@@ -309,10 +315,7 @@ def convert_examples_to_crops(examples_gen, tokenizer, max_seq_length,
             # take the work token
             orig_to_tok_index.append(len(all_doc_tokens))
             # map it to the number
-            sub_tokens = sub_token_cache.get(token)
-            if sub_tokens is None:  # tokenizzo i token di ogni documento(?)
-                sub_tokens = tokenizer.tokenize(token)
-                sub_token_cache[token] = sub_tokens
+            sub_tokens, _ = word_tokenizer.get(token)
             # Qui succede questo:
             # un token tipo 'Klementieff' diventa 4 subtoken : ['▁kle', 'ment', 'i', 'eff']
             # quindi mappi tutti i subtoken corrispondenti al token del testo originale corrispondente a Klementieff
@@ -941,7 +944,7 @@ def convert_nq_to_squad(verbose, is_train, args=None):
     num_short_possible, num_long_possible = 0, 0
     max_end_token = -1
     orig_data = {}
-    with open(args.fn) as f:
+    with shard_utils.open_shard(args.fn) as f:
         progress = tqdm(f, total=args.num_samples)
         entry = {}
         for kk, line in enumerate(progress):
@@ -1295,8 +1298,12 @@ def load_and_cache_crops(args, tokenizer, namefile, verbose, evaluate, max_num_s
         print("NOT loading crops")
         entries = convert_nq_to_squad(verbose, args=args_nq, is_train=not evaluate)
         examples_gen = read_nq_examples(entries, is_training=not evaluate)
+        # the word pieces cache is kept across files (and on disk if word_cache_dir is given)
+        word_tokenizer = word_tokenization.get_word_tokenizer(tokenizer,
+                                                              cache_dir=getattr(args, 'word_cache_dir', None))
         crops = convert_examples_to_crops(examples_gen=examples_gen,
                                           tokenizer=tokenizer,
+                                          word_tokenizer=word_tokenizer,
                                           max_seq_length=args.max_seq_length,
                                           doc_stride=args.doc_stride,
                                           max_query_length=args.max_query_length,
@@ -1304,6 +1311,7 @@ def load_and_cache_crops(args, tokenizer, namefile, verbose, evaluate, max_num_s
                                           cls_token_segment_id=0,
                                           pad_token_segment_id=0,
                                           p_keep_impossible=args.p_keep_impossible if not evaluate else 1.0)
+        print(word_tokenizer.cache.stats())
         if do_cache:
             with open(cached_crops_fn, "wb") as f:
                 pickle.dump(crops, f)
@@ -1366,6 +1374,9 @@ def getTokenizedDataset(model_type, vocab, do_lower_case, namefile, verbose, max
                         default=0.1, help="The fraction of impossible"
                                           " samples to keep.")
     parser.add_argument('--do_enumerate', action='store_true')
+    parser.add_argument('--word_cache_dir', type=str, default=None,
+                        help="If given the word pieces of the words of the documents are also cached on disk "
+                             "in this directory, and reused by the next runs")
 
     args, _ = parser.parse_known_args()
     print(model_type)
@@ -2,6 +2,9 @@
 """ Finetuning the library models for question-answering on SQuAD (DistilBERT, Bert, XLM, XLNet)."""
 import argparse
 import collections
+import collections.abc
+import contextlib
+import csv
 import json
 import logging
 import math
@@ -10,9 +13,15 @@ import pickle
 import random
 import time
 import gc
+import itertools
+import multiprocessing
+import operator
 import numpy as np
 import pandas as pd
 import tensorflow as tf
+import crop_cache
+import shard_utils
+import word_tokenization
 from tqdm.notebook import tqdm
 from transformers import BertConfig, BertTokenizer, AlbertTokenizer, AlbertConfig
 from transformers.tokenization_bert import whitespace_tokenize
@@ -39,6 +48,18 @@ LongAnswerCandidate = collections.namedtuple('LongAnswerCandidate', [
 
 DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
 
+# tokens of an example shared by its crops, and position of a crop in them (see fill_crop_arrays)
+CropDocument = collections.namedtuple("CropDocument", ["query_ids", "doc_ids", "tok_to_orig_index",
+                                                       "max_context_span"])
+
+CropSpec = collections.namedtuple("CropSpec", ["document_index", "example_index", "doc_span_index", "doc_span",
+                                               "doc_offset", "start_position", "end_position", "long_position",
+                                               "short_is_impossible", "long_is_impossible"])
+
+# annotations of a training document of a DocumentStore, in tokens of the document
+DocumentInfo = collections.namedtuple("DocumentInfo", ["example_id", "query_ids", "candidate_starts",
+                                                       "long_answer", "short_answers", "is_val"])
+
 PrelimPrediction = collections.namedtuple("PrelimPrediction",
                                           ["crop_index", "start_index", "end_index", "start_logit", "end_logit"])
 
@@ -53,6 +74,12 @@ RawResult = collections.namedtuple("RawResult", ["unique_id", "start_logits", "e
 UNMAPPED = -123
 CLS_INDEX = 0
 
+# default directory of the crop cache of load_and_cache_crops
+CROP_CACHE_DIR = '../cache/crops/'
+
+# arrays of a DocumentStore read in memory, the others are memory mapped
+DOCUMENT_OFFSETS = ('doc_offsets', 'word_offsets', 'token_offsets')
+
 
 def get_add_tokens(do_enumerate):
     """
@@ -77,7 +104,14 @@ def get_add_tokens(do_enumerate):
     return add_tokens
 
 
-def read_candidates(candidate_files, do_cache=True):
+def read_candidates(candidate_files, do_cache=True, example_ids=None):
+    """
+    Legge i long answer candidates e le domande degli esempi
+    @param candidate_files lista dei file jsonl
+    @param do_cache se True i candidati sono salvati in cache
+    @param example_ids se non None sono letti solo questi esempi, tramite l'indice dei file
+    @return dizionario dei candidati e dizionario delle domande
+    """
     assert isinstance(candidate_files, (tuple, list)), candidate_files
     for fn in candidate_files:
         assert os.path.exists(fn), f'Missing file {fn}'
@@ -85,10 +119,18 @@ def read_candidates(candidate_files, do_cache=True):
 
     candidates = {}  # Creo il dizionario dei candidati (che sia dalla cache o meno)
     question = {}
-    if not os.path.exists(cache_fn):
+    if example_ids is not None:
+        do_cache = False
+    if example_ids is not None or not os.path.exists(cache_fn):
         for fn in candidate_files:
-            with open(fn) as f:
-                for line in tqdm(f):  # tqdm è la progress bar
+            if example_ids is not None:
+                lines_source = shard_utils.ExampleReader([fn])
+                lines = lines_source.iter_lines(example_ids)
+            else:
+                lines_source = shard_utils.open_shard(fn)
+                lines = lines_source
+            with lines_source:
+                for line in tqdm(lines):  # tqdm è la progress bar
                     entry = json.loads(line)
                     example_id = str(entry['example_id'])
                     cnds = entry.pop('long_answer_candidates')
@@ -117,16 +159,81 @@ def is_whitespace(c):  # ok
     return False
 
 
+# whitespace characters of is_whitespace other than the space, which can appear inside a token
+_CONTEXT_WHITESPACE_RE = re.compile('[\t\r\n\u202f]')
+
+
+def context_words(context_tokens, context=None):
+    """
+    Divide i token di un context nelle parole di read_nq_examples: ogni token non vuoto è una parola, a meno che
+    contenga dei whitespace diversi dallo spazio
+    :param context_tokens: token del context
+    :param context: ' '.join(context_tokens), se già calcolato
+    :return: lista delle parole e array words_before, words_before[k] = numero di parole nei primi k token
+    """
+    if context is None:
+        context = ' '.join(context_tokens)
+    num_tokens = len(context_tokens)
+    if _CONTEXT_WHITESPACE_RE.search(context) is None:
+        # every non empty token is a word
+        words = [token for token in context_tokens if token]
+        num_words = np.fromiter(map(len, context_tokens), dtype=np.int64, count=num_tokens) > 0
+    else:
+        token_words = [[w for w in _CONTEXT_WHITESPACE_RE.split(token) if w] for token in context_tokens]
+        words = [w for t_words in token_words for w in t_words]
+        num_words = np.fromiter(map(len, token_words), dtype=np.int64, count=num_tokens)
+    words_before = np.zeros(num_tokens + 1, dtype=np.int64)
+    np.cumsum(num_words, out=words_before[1:])
+    return words, words_before
+
+
+def split_context_tokens(context, context_tokens):
+    """
+    Divide il context in parole come il ciclo sui caratteri di read_nq_examples (stesse parole,
+    stessa mappa carattere -> parola), ma lavorando sui token da cui il context è stato creato,
+    senza costruire la lista char_to_word_offset
+    :param context: ' '.join(context_tokens)
+    :param context_tokens: token del context (document_text.split(' '), eventualmente croppato)
+    :return: lista delle parole e funzione che restituisce l'indice della parola di un carattere del context
+    """
+    num_tokens = len(context_tokens)
+    # token_starts[k] = position of the k-th token in the context
+    token_starts = token_char_offsets(context_tokens)
+    doc_tokens, words_before = context_words(context_tokens, context)
+    context_len = len(context)
+
+    def char_to_word(offset):
+        # same result (and same IndexError) as char_to_word_offset[offset]
+        if offset < 0:
+            offset += context_len
+        if not 0 <= offset < context_len:
+            raise IndexError('char offset out of range')
+        token_index = int(np.searchsorted(token_starts, offset, side='right')) - 1
+        word_index = int(words_before[token_index])
+        prev_is_whitespace = True
+        for c in context_tokens[token_index][:offset - token_starts[token_index] + 1]:
+            if is_whitespace(c):
+                prev_is_whitespace = True
+            else:
+                if prev_is_whitespace:
+                    word_index += 1
+                prev_is_whitespace = False
+        return word_index - 1
+
+    return doc_tokens, char_to_word
+
+
 def read_nq_examples(input_file_or_data,
-                     is_training):  # modo diverso per fare questo https://github.com/google/retrieval-qa-eval/blob
+                     is_training, show_progress=True):  # modo diverso per fare questo https://github.com/google/retrieval-qa-eval/blob
     # /master/nq_to_squad.py (?)
 
     """
     Read a NQ json file into a list of NQExample. Refer to `nq_to_squad.py`
     to convert the `simplified-nq-t*.jsonl` files to NQ json.
        This function returns NQExample
-       @param input_file_or_data entries from jsonfile
+       @param input_file_or_data entries from jsonfile (list or generator)
        @param is_training boolean to Train or Evaluate
+       @param show_progress if False no progress bar is shown
        @return a collection of NQ Examples
        """
 
@@ -137,26 +244,34 @@ def read_nq_examples(input_file_or_data,
 
     else:
         input_data = input_file_or_data
-    print("Dimensione: " + str(len(input_data)))
-    for entry_index, entry in enumerate(tqdm(input_data, total=len(input_data))):
+    # input_data may also be a generator (see iter_nq_to_squad), whose length is unknown
+    total = len(input_data) if hasattr(input_data, '__len__') else None
+    if show_progress:
+        print("Dimensione: " + str(total))
+    for entry_index, entry in enumerate(tqdm(input_data, total=total, disable=not show_progress)):
         # if entry_index >= 2:
         #     break
         assert len(entry["paragraphs"]) == 1
         paragraph = entry["paragraphs"][0]
         paragraph_text = paragraph["context"]
-        doc_tokens = []
-        char_to_word_offset = []
-        prev_is_whitespace = True
-        for c in paragraph_text:
-            if is_whitespace(c):
-                prev_is_whitespace = True
-            else:
-                if prev_is_whitespace:
-                    doc_tokens.append(c)
+        if "context_tokens" in paragraph:
+            # the context comes already split in tokens (see iter_nq_to_squad)
+            doc_tokens, char_to_word = split_context_tokens(paragraph_text, paragraph["context_tokens"])
+        else:
+            doc_tokens = []
+            char_to_word_offset = []
+            prev_is_whitespace = True
+            for c in paragraph_text:
+                if is_whitespace(c):
+                    prev_is_whitespace = True
                 else:
-                    doc_tokens[-1] += c
-                prev_is_whitespace = False
-            char_to_word_offset.append(len(doc_tokens) - 1)
+                    if prev_is_whitespace:
+                        doc_tokens.append(c)
+                    else:
+                        doc_tokens[-1] += c
+                    prev_is_whitespace = False
+                char_to_word_offset.append(len(doc_tokens) - 1)
+            char_to_word = char_to_word_offset.__getitem__
 
         assert len(paragraph["qas"]) == 1
         qa = paragraph["qas"][0]
@@ -180,9 +295,9 @@ def read_nq_examples(input_file_or_data,
                 orig_answer_text = answer["text"]
                 answer_offset = answer["answer_start"]
                 answer_length = len(orig_answer_text)
-                start_position = char_to_word_offset[answer_offset]
-                end_position = char_to_word_offset[
-                    answer_offset + answer_length - 1]
+                start_position = char_to_word(answer_offset)
+                end_position = char_to_word(
+                    answer_offset + answer_length - 1)
                 # Only add answers where the text can be exactly
                 # recovered from the document. If this CAN'T
                 # happen it's likely due to weird Unicode stuff
@@ -213,7 +328,7 @@ def read_nq_examples(input_file_or_data,
             if not long_is_impossible:
                 long_answer = long_answers[0]
                 long_answer_offset = long_answer["answer_start"]
-                long_position = char_to_word_offset[long_answer_offset]
+                long_position = char_to_word(long_answer_offset)
             else:
                 long_position = -1
 
@@ -261,51 +376,61 @@ def convert_examples_to_crops(examples_gen, tokenizer, max_seq_length,
                               pad_token_segment_id=0,
                               mask_padding_with_zero=True,
                               p_keep_impossible=None,
-                              sep_token_extra=False):
+                              sep_token_extra=False,
+                              rng_seed=None,
+                              word_tokenizer=None):
     """
            Trasforma gli NQExample in Crops
            @param examples_gen gli example da convertire in crops
            @param tokenizer
            @param max_seq_length lunghezza massima (FORSE) fra domanda+risposta
+           @param rng_seed se None i crop impossibili sono scartati con np.random, altrimenti con il
+               generatore dell'esempio (vedi example_rng), indipendente dall'ordine degli esempi
+           @param word_tokenizer tokenizer delle parole dei documenti (vedi word_tokenization), se None
+               le parole sono tokenizzate da tokenizer.tokenize
            @:var
-           @return list of Crops
+           @return CropStore con i crops (vuoto se non ci sono crops)
            """
     assert p_keep_impossible is not None, '`p_keep_impossible` is required'
-    unique_id = 1000000000
     num_short_pos, num_short_neg = 0, 0
     num_long_pos, num_long_neg = 0, 0
-    sub_token_cache = {}
+    if word_tokenizer is None:
+        word_tokenizer = word_tokenization.WordTokenizer(tokenizer)
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
 
-    crops = []
-    for example_index, example in enumerate(examples_gen):
+    documents, crop_specs = [], []
+    # the words of the documents are tokenized a block of examples at a time
+    for example_index, example in enumerate(word_tokenizer.prefetch(examples_gen)):
         if example_index % 1000 == 0 and example_index > 0:
             print('Converting %s: short_pos %s short_neg %s'
                   ' long_pos %s long_neg %s',
                   example_index, num_short_pos, num_short_neg,
                   num_long_pos, num_long_neg)
 
+        rng = np.random if rng_seed is None else example_rng(example.qas_id, rng_seed)
+
         query_tokens = tokenizer.tokenize(example.question_text)  # tokenizzo la domanda e se troppo lunga la tronco
         if len(query_tokens) > max_query_length:
             query_tokens = query_tokens[0:max_query_length]
+        query_ids = tokenizer.convert_tokens_to_ids(query_tokens)
 
         # this takes the longest!
         tok_to_orig_index = []
         orig_to_tok_index = []
         all_doc_tokens = []
+        all_doc_ids = []
 
         for i, token in enumerate(example.doc_tokens):
             # take the work token
             orig_to_tok_index.append(len(all_doc_tokens))
             # map it to the number
-            sub_tokens = sub_token_cache.get(token)
-            if sub_tokens is None:  # tokenizzo i token di ogni documento(?)
-                sub_tokens = tokenizer.tokenize(token)
-                sub_token_cache[token] = sub_tokens
+            sub_tokens, sub_ids = word_tokenizer.get(token)
             # Qui succede questo:
             # un token tipo 'Klementieff' diventa 4 subtoken : ['▁kle', 'ment', 'i', 'eff']
             # quindi mappi tutti i subtoken corrispondenti al token del testo originale corrispondente a Klementieff
             tok_to_orig_index.extend([i for _ in range(len(sub_tokens))])
             all_doc_tokens.extend(sub_tokens)
+            all_doc_ids.extend(sub_ids)
 
         tok_start_position = None
         tok_end_position = None
@@ -329,160 +454,390 @@ def convert_examples_to_crops(examples_gen, tokenizer, max_seq_length,
         if is_training and not example.long_is_impossible:
             tok_long_position = orig_to_tok_index[example.long_position]
 
-        # For Bert: [CLS] question [SEP] paragraph [SEP]
-        special_tokens_count = 3
-        if sep_token_extra:
-            # For Roberta: <s> question </s> </s> paragraph </s>
-            special_tokens_count += 1
-        max_tokens_for_doc = max_seq_length - len(query_tokens) - special_tokens_count
-        assert max_tokens_for_doc > 0
-        # We can have documents that are longer than the maximum
-        # sequence length. To deal with this we do a sliding window
-        # approach, where we take chunks of the up to our max length
-        # with a stride of `doc_stride`.
-        doc_spans = get_spans(doc_stride, max_tokens_for_doc, len(all_doc_tokens))
-        for doc_span_index, doc_span in enumerate(doc_spans):
-            # Tokens are constructed as: CLS Query SEP Paragraph SEP
-            tokens = []
-            token_to_orig_map = UNMAPPED * np.ones((max_seq_length,), dtype=np.int32)
-            token_is_max_context = np.zeros((max_seq_length,), dtype=np.bool)
-            token_type_ids = []
-
-            # p_mask: mask with 1 for token than cannot be in the
-            # answer (0 for token which can be in an answer)
-            # Original TF implem also keep the classification token
-            # (set to 0) (not sure why...)
-            # p_mask = []
-
-            short_is_impossible = example.short_is_impossible
-            start_position = None
-            end_position = None
-            special_tokens_offset = special_tokens_count - 1
-            doc_offset = len(query_tokens) + special_tokens_offset
-            if is_training and not short_is_impossible:
-                doc_start = doc_span.start
-                doc_end = doc_span.start + doc_span.length - 1
-                if not (tok_start_position >= doc_start and tok_end_position <= doc_end):
-                    start_position = 0
-                    end_position = 0
-                    short_is_impossible = True
-                else:
-                    start_position = tok_start_position - doc_start + doc_offset
-                    end_position = tok_end_position - doc_start + doc_offset
-
-            long_is_impossible = example.long_is_impossible
-            long_position = None
-            if is_training and not long_is_impossible:
-                doc_start = doc_span.start
-                doc_end = doc_span.start + doc_span.length - 1
-                # out of span
-                if not (tok_long_position >= doc_start and tok_long_position <= doc_end):
-                    long_position = 0
-                    long_is_impossible = True
-                else:
-                    long_position = tok_long_position - doc_start + doc_offset
-
-            # drop impossible samples -> see Alberti
-            if long_is_impossible:
-                if np.random.rand() > p_keep_impossible:
-                    continue
-
-            # CLS token at the beginning
-            tokens.append(cls_token)
-            token_type_ids.append(cls_token_segment_id)
-            # p_mask.append(0)  # can be answer
-
-            # Query
-            tokens += query_tokens
-            token_type_ids += [sequence_a_segment_id] * len(query_tokens)
-            # p_mask += [1] * len(query_tokens)  # can not be answer
-
-            # SEP token
-            tokens.append(sep_token)
-            token_type_ids.append(sequence_a_segment_id)
-            # p_mask.append(1)  # can not be answer
-            if sep_token_extra:
-                tokens.append(sep_token)
-                token_type_ids.append(sequence_a_segment_id)
-                # p_mask.append(1)
-
-            # Paragraph
-            for i in range(doc_span.length):
-                split_token_index = doc_span.start + i
-                # We add `example.crop_start` as the original document
-                # is already shifted
-                token_to_orig_map[len(tokens)] = tok_to_orig_index[
-                                                     split_token_index] + example.crop_start
-
-                token_is_max_context[len(tokens)] = check_is_max_context(doc_spans,
-                                                                         doc_span_index, split_token_index)
-                tokens.append(all_doc_tokens[split_token_index])
-                token_type_ids.append(sequence_b_segment_id)
-                # p_mask.append(0)  # can be answer
-
-            paragraph_len = doc_span.length
-
-            # SEP token
-            tokens.append(sep_token)
-            token_type_ids.append(sequence_b_segment_id)
-            # p_mask.append(1)  # can not be answer
-
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-            # The mask has 1 for real tokens and 0 for padding tokens. Only real
-            # tokens are attended to.
-            attention_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-            # Zero-pad up to the sequence length.
-            while len(input_ids) < max_seq_length:
-                input_ids.append(pad_id)
-                attention_mask.append(0 if mask_padding_with_zero else 1)
-                token_type_ids.append(pad_token_segment_id)
-
-            # reduce memory, only input_ids needs more bits
-            input_ids = np.array(input_ids, dtype=np.int32)
-            attention_mask = np.array(attention_mask, dtype=np.bool)
-            token_type_ids = np.array(token_type_ids, dtype=np.uint8)
-
-            if is_training and short_is_impossible:
-                start_position = CLS_INDEX
-                end_position = CLS_INDEX
-
-            if is_training and long_is_impossible:
-                long_position = CLS_INDEX
-
-            if short_is_impossible:
+        first_crop = len(crop_specs)
+        append_example_crops(documents, crop_specs, example_index, query_ids, all_doc_ids, tok_to_orig_index,
+                             example.crop_start, tok_start_position, tok_end_position, tok_long_position,
+                             example.short_is_impossible, example.long_is_impossible, is_training,
+                             max_seq_length, doc_stride, p_keep_impossible, sep_token_extra, rng)
+        for spec in crop_specs[first_crop:]:
+            if spec.short_is_impossible:
                 num_short_neg += 1
             else:
                 num_short_pos += 1
 
-            if long_is_impossible:
+            if spec.long_is_impossible:
                 num_long_neg += 1
             else:
                 num_long_pos += 1
 
-            crop = Crop(
-                unique_id=unique_id,
-                example_index=example_index,
-                # example_index=example.qas_id,
-                doc_span_index=doc_span_index,
-                tokens=tokens,
-                token_to_orig_map=token_to_orig_map,
-                token_is_max_context=token_is_max_context,
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                token_type_ids=token_type_ids,
-                # p_mask=p_mask,
-                paragraph_len=paragraph_len,
-                start_position=start_position,
-                end_position=end_position,
-                long_position=long_position,
-                short_is_impossible=short_is_impossible,
-                long_is_impossible=long_is_impossible)
-            crops.append(crop)
-            unique_id += 1
-
-    return crops
+    # Tokens are constructed as: CLS Query SEP Paragraph SEP
+    arrays = fill_crop_arrays(documents, crop_specs, max_seq_length,
+                              cls_id=cls_id, sep_id=sep_id, pad_id=pad_id,
+                              sequence_a_segment_id=sequence_a_segment_id,
+                              sequence_b_segment_id=sequence_b_segment_id,
+                              cls_token_segment_id=cls_token_segment_id,
+                              pad_token_segment_id=pad_token_segment_id,
+                              mask_padding_with_zero=mask_padding_with_zero)
+    arrays.update(crop_fields(crop_specs, is_training))
+    return CropStore(arrays, vocabulary_tokens(tokenizer))
+
+
+def append_example_crops(documents, crop_specs, example_index, query_ids, doc_ids, tok_to_orig_index, crop_start,
+                         tok_start_position, tok_end_position, tok_long_position,
+                         short_is_impossible, long_is_impossible, is_training,
+                         max_seq_length, doc_stride, p_keep_impossible, sep_token_extra, rng):
+    """
+    Divide i subtoken del documento di un esempio in doc spans e aggiunge i suoi crops
+    :param documents: lista di CropDocument, il documento è aggiunto se almeno uno dei crops è tenuto
+    :param crop_specs: lista di CropSpec a cui sono aggiunti i crops
+    :param query_ids: id dei token della domanda (già troncata)
+    :param doc_ids: id dei subtoken del documento
+    :param tok_to_orig_index: indice della parola di ogni subtoken
+    :param crop_start: primo token del documento originale (sommato a tok_to_orig_index)
+    :param tok_start_position: posizione (in subtoken) della short answer, -1 se impossibile
+    :param tok_long_position: posizione (in subtoken) della long answer, -1 se impossibile
+    :param rng: generatore usato per scartare i crops impossibili
+    """
+    # For Bert: [CLS] question [SEP] paragraph [SEP]
+    special_tokens_count = 3
+    if sep_token_extra:
+        # For Roberta: <s> question </s> </s> paragraph </s>
+        special_tokens_count += 1
+    max_tokens_for_doc = max_seq_length - len(query_ids) - special_tokens_count
+    assert max_tokens_for_doc > 0
+    # We can have documents that are longer than the maximum
+    # sequence length. To deal with this we do a sliding window
+    # approach, where we take chunks of the up to our max length
+    # with a stride of `doc_stride`.
+    doc_spans = get_spans(doc_stride, max_tokens_for_doc, len(doc_ids))
+    # index of the 'max context' span of every token of the document
+    max_context_span = max_context_spans(doc_spans, len(doc_ids))
+    document_index = None
+    for doc_span_index, doc_span in enumerate(doc_spans):
+        # p_mask: mask with 1 for token than cannot be in the
+        # answer (0 for token which can be in an answer)
+        # Original TF implem also keep the classification token
+        # (set to 0) (not sure why...)
+        # p_mask = []
+
+        span_short_is_impossible = short_is_impossible
+        start_position = None
+        end_position = None
+        special_tokens_offset = special_tokens_count - 1
+        doc_offset = len(query_ids) + special_tokens_offset
+        if is_training and not span_short_is_impossible:
+            doc_start = doc_span.start
+            doc_end = doc_span.start + doc_span.length - 1
+            if not (tok_start_position >= doc_start and tok_end_position <= doc_end):
+                start_position = 0
+                end_position = 0
+                span_short_is_impossible = True
+            else:
+                start_position = tok_start_position - doc_start + doc_offset
+                end_position = tok_end_position - doc_start + doc_offset
+
+        span_long_is_impossible = long_is_impossible
+        long_position = None
+        if is_training and not span_long_is_impossible:
+            doc_start = doc_span.start
+            doc_end = doc_span.start + doc_span.length - 1
+            # out of span
+            if not (tok_long_position >= doc_start and tok_long_position <= doc_end):
+                long_position = 0
+                span_long_is_impossible = True
+            else:
+                long_position = tok_long_position - doc_start + doc_offset
+
+        # drop impossible samples -> see Alberti
+        if span_long_is_impossible:
+            if rng.rand() > p_keep_impossible:
+                continue
+
+        if is_training and span_short_is_impossible:
+            start_position = CLS_INDEX
+            end_position = CLS_INDEX
+
+        if is_training and span_long_is_impossible:
+            long_position = CLS_INDEX
+
+        # the tokens of the example are kept only if at least one of its crops is
+        if document_index is None:
+            # We add `crop_start` as the original document
+            # is already shifted
+            documents.append(CropDocument(
+                query_ids=query_ids,
+                doc_ids=np.asarray(doc_ids, dtype=np.int32),
+                tok_to_orig_index=np.asarray(tok_to_orig_index, dtype=np.int32) + crop_start,
+                max_context_span=max_context_span))
+            document_index = len(documents) - 1
+        crop_specs.append(CropSpec(
+            document_index=document_index,
+            example_index=example_index,
+            doc_span_index=doc_span_index,
+            doc_span=doc_span,
+            doc_offset=doc_offset,
+            start_position=start_position,
+            end_position=end_position,
+            long_position=long_position,
+            short_is_impossible=span_short_is_impossible,
+            long_is_impossible=span_long_is_impossible))
+
+
+def fill_crop_arrays(documents, crop_specs, max_seq_length, cls_id, sep_id, pad_id,
+                     sequence_a_segment_id, sequence_b_segment_id, cls_token_segment_id,
+                     pad_token_segment_id, mask_padding_with_zero):
+    """
+    Scrive i crop (CLS Query SEP Paragraph SEP e padding) direttamente nelle righe di matrici
+    [num_crops, max_seq_length] allocate una volta sola, un blocco di token alla volta
+    :param documents: lista di CropDocument
+    :param crop_specs: lista di CropSpec, una per crop
+    :return: dizionario con le matrici input_ids, attention_mask, token_type_ids,
+        token_to_orig_map e token_is_max_context
+    """
+    num_crops = len(crop_specs)
+    shape = (num_crops, max_seq_length)
+    input_ids = np.full(shape, pad_id, dtype=np.int32)
+    # The mask has 1 for real tokens and 0 for padding tokens. Only real
+    # tokens are attended to.
+    attention_mask = np.full(shape, not mask_padding_with_zero, dtype=np.bool_)
+    # reduce memory, only input_ids needs more bits
+    token_type_ids = np.full(shape, pad_token_segment_id, dtype=np.uint8)
+    token_to_orig_map = np.full(shape, UNMAPPED, dtype=np.int32)
+    token_is_max_context = np.zeros(shape, dtype=np.bool_)
+    for crop_index, spec in enumerate(crop_specs):
+        document = documents[spec.document_index]
+        num_query_tokens = len(document.query_ids)
+        doc_start = spec.doc_span.start
+        doc_end = doc_start + spec.doc_span.length
+        doc_offset = spec.doc_offset
+        seq_end = doc_offset + spec.doc_span.length
+
+        input_ids[crop_index, 0] = cls_id
+        input_ids[crop_index, 1: 1 + num_query_tokens] = document.query_ids
+        input_ids[crop_index, 1 + num_query_tokens: doc_offset] = sep_id
+        input_ids[crop_index, doc_offset: seq_end] = document.doc_ids[doc_start: doc_end]
+        input_ids[crop_index, seq_end] = sep_id
+
+        attention_mask[crop_index, :seq_end + 1] = mask_padding_with_zero
+
+        token_type_ids[crop_index, 0] = cls_token_segment_id
+        token_type_ids[crop_index, 1: doc_offset] = sequence_a_segment_id
+        token_type_ids[crop_index, doc_offset: seq_end + 1] = sequence_b_segment_id
+
+        token_to_orig_map[crop_index, doc_offset: seq_end] = document.tok_to_orig_index[doc_start: doc_end]
+        token_is_max_context[crop_index, doc_offset: seq_end] = \
+            document.max_context_span[doc_start: doc_end] == spec.doc_span_index
+
+    return {'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'token_type_ids': token_type_ids,
+            'token_to_orig_map': token_to_orig_map,
+            'token_is_max_context': token_is_max_context}
+
+
+# per crop fields of a CropStore, the positions only in training
+CROP_ROW_FIELDS = ('input_ids', 'attention_mask', 'token_type_ids', 'token_to_orig_map', 'token_is_max_context')
+CROP_POSITION_FIELDS = ('start_position', 'end_position', 'long_position')
+
+
+class CropStore:
+    """
+    I crops di un file tenuti in pochi array contigui (struct of arrays) invece che in una lista di Crop:
+    le matrici [num_crops, max_seq_length] di fill_crop_arrays più un array per ogni campo scalare
+    (unique_id, example_index, doc_span_index, paragraph_len, num_tokens, posizioni e flag).
+    I token non sono salvati, sono ricavati dagli input_ids solo quando servono (vedi CropTokens).
+    crops[i] e l'iterazione restituiscono dei CropView con gli stessi campi di Crop, quindi lo store
+    si usa come la lista di Crop in getResult e write_predictions
+    """
+
+    def __init__(self, arrays, id_to_token):
+        """
+        :param arrays: dizionario campo -> array, con una riga per crop
+        :param id_to_token: lista id -> token del tokenizer (vedi vocabulary_tokens)
+        """
+        self.arrays = arrays
+        self.id_to_token = id_to_token
+
+    def __getattr__(self, name):
+        # the arrays are also attributes: crops.input_ids, crops.example_index, ...
+        try:
+            return self.__dict__['arrays'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __len__(self):
+        return len(self.arrays['unique_id'])
+
+    def __getitem__(self, index):
+        index = operator.index(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('crop index out of range')
+        return CropView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield CropView(self, index)
+
+    @property
+    def is_training(self):
+        return 'start_position' in self.arrays
+
+    def tokens(self, index, start=0, stop=None):
+        """
+        Ricava dagli input_ids i token di un crop (padding escluso)
+        :param index: indice del crop
+        :param start: primo token
+        :param stop: token finale escluso, None per la fine del crop
+        :return: lista di token
+        """
+        num_tokens = int(self.arrays['num_tokens'][index])
+        start, stop, _ = slice(start, stop).indices(num_tokens)
+        return [self.id_to_token[i] for i in self.arrays['input_ids'][index, start: stop].tolist()]
+
+    @classmethod
+    def empty(cls, max_seq_length, is_training, id_to_token):
+        """
+        Crea uno store senza crops, con gli stessi array (vuoti) di convert_examples_to_crops
+        :param max_seq_length: lunghezza dei crops
+        :param is_training: se True ci sono anche gli array delle posizioni
+        :param id_to_token: lista id -> token del tokenizer (vedi vocabulary_tokens)
+        :return: CropStore
+        """
+        arrays = fill_crop_arrays([], [], max_seq_length, cls_id=0, sep_id=0, pad_id=0,
+                                  sequence_a_segment_id=0, sequence_b_segment_id=1, cls_token_segment_id=0,
+                                  pad_token_segment_id=0, mask_padding_with_zero=True)
+        arrays.update(crop_fields([], is_training))
+        return cls(arrays, id_to_token)
+
+    @classmethod
+    def concatenate(cls, stores, example_offsets):
+        """
+        Unisce più stores, rinumerando unique_id ed example_index
+        :param stores: lista non vuota di CropStore (vedi empty)
+        :param example_offsets: per ogni store, numero di esempi degli stores precedenti
+        :return: CropStore
+        """
+        arrays = {field: np.concatenate([s.arrays[field] for s in stores], 0) for field in stores[0].arrays}
+        arrays['example_index'] = np.concatenate([s.arrays['example_index'] + offset
+                                                  for s, offset in zip(stores, example_offsets)]).astype(np.int32)
+        arrays['unique_id'] = 1000000000 + np.arange(len(arrays['unique_id']), dtype=np.int64)
+        return cls(arrays, stores[0].id_to_token)
+
+
+class CropView:
+    """
+    Il crop i di un CropStore, con gli stessi campi di Crop: gli array sono righe delle matrici
+    dello store e tokens è una CropTokens
+    """
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getattr__(self, name):
+        arrays = self.store.arrays
+        if name in CROP_ROW_FIELDS:
+            return arrays[name][self.index]
+        if name in CROP_POSITION_FIELDS and name not in arrays:
+            return None
+        if name in arrays:
+            return arrays[name][self.index].item()
+        raise AttributeError(name)
+
+    @property
+    def tokens(self):
+        return CropTokens(self.store, self.index)
+
+
+class CropTokens(collections.abc.Sequence):
+    """
+    I token di un crop, ricavati dagli input_ids solo quando sono letti: len() non li ricava,
+    un indice restituisce un token e uno slice una lista
+    """
+    __slots__ = ('store', 'index', 'num_tokens')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+        self.num_tokens = int(store.arrays['num_tokens'][index])
+
+    def __len__(self):
+        return self.num_tokens
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if i.step not in (None, 1):
+                return self.store.tokens(self.index)[i]
+            return self.store.tokens(self.index, i.start, i.stop)
+        if i < 0:
+            i += self.num_tokens
+        if not 0 <= i < self.num_tokens:
+            raise IndexError('token index out of range')
+        return self.store.id_to_token[int(self.store.arrays['input_ids'][self.index, i])]
+
+    def __iter__(self):
+        return iter(self.store.tokens(self.index))
+
+    def __array__(self, dtype=None):
+        return np.array(self.store.tokens(self.index), dtype=dtype)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+
+def vocabulary_tokens(tokenizer):
+    """
+    :param tokenizer: tokenizer di transformers
+    :return: lista id -> token, token aggiunti compresi
+    """
+    return tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+
+
+def crop_fields(crop_specs, is_training):
+    """
+    Crea gli array dei campi scalari dei crops
+    :param crop_specs: lista di CropSpec, una per crop
+    :param is_training: se True sono create anche le posizioni
+    :return: dizionario di arrays
+    """
+    arrays = {
+        'unique_id': 1000000000 + np.arange(len(crop_specs), dtype=np.int64),
+        'example_index': np.array([s.example_index for s in crop_specs], dtype=np.int32),
+        'doc_span_index': np.array([s.doc_span_index for s in crop_specs], dtype=np.int32),
+        'paragraph_len': np.array([s.doc_span.length for s in crop_specs], dtype=np.int32),
+        'num_tokens': np.array([s.doc_offset + s.doc_span.length + 1 for s in crop_specs], dtype=np.int32),
+        'short_is_impossible': np.array([s.short_is_impossible for s in crop_specs], dtype=np.bool_),
+        'long_is_impossible': np.array([s.long_is_impossible for s in crop_specs], dtype=np.bool_),
+    }
+    if is_training:
+        for field in CROP_POSITION_FIELDS:
+            arrays[field] = np.array([getattr(s, field) for s in crop_specs], dtype=np.int32)
+    return arrays
+
+
+def max_context_spans(doc_spans, num_tokens):
+    """
+    Calcola per ogni token del documento il doc span con il 'max context' (vedi check_is_max_context),
+    uno span alla volta con numpy invece che token per token su tutti gli span
+    :param doc_spans: lista di DocSpan (vedi get_spans)
+    :param num_tokens: numero di token del documento
+    :return: np.array [num_tokens] con l'indice dello span di ogni token (-1 se il token non è in nessuno span)
+    """
+    best_score = np.full(num_tokens, -np.inf)
+    best_span_index = np.full(num_tokens, -1, dtype=np.int32)
+    for span_index, doc_span in enumerate(doc_spans):
+        span = slice(doc_span.start, doc_span.start + doc_span.length)
+        num_left_context = np.arange(doc_span.length)
+        num_right_context = doc_span.length - 1 - num_left_context
+        score = np.minimum(num_left_context, num_right_context) + 0.01 * doc_span.length
+        # strictly better, on ties the first span wins as in check_is_max_context
+        better = score > best_score[span]
+        best_score[span][better] = score[better]
+        best_span_index[span][better] = span_index
+    return best_span_index
 
 
 def check_is_max_context(doc_spans, cur_span_index, position):
@@ -827,10 +1182,14 @@ def write_predictions(examples_gen, all_crops, all_results, n_best_size,
     logger.info("Writing predictions to: %s" % output_prediction_file)
     logger.info("Writing nbest to: %s" % output_nbest_file)
 
-    # create indexes
-    example_index_to_crops = collections.defaultdict(list)
-    for crop in all_crops:
-        example_index_to_crops[crop.example_index].append(crop)
+    # create indexes, the crops of an example are taken from all_crops only when it is processed
+    if isinstance(all_crops, CropStore):
+        crop_example_indexes = all_crops.example_index.tolist()
+    else:
+        crop_example_indexes = [crop.example_index for crop in all_crops]
+    example_index_to_crop_indexes = collections.defaultdict(list)
+    for crop_index, crop_example_index in enumerate(crop_example_indexes):
+        example_index_to_crop_indexes[crop_example_index].append(crop_index)
     unique_id_to_result = {result.unique_id: result for result in all_results}
     all_predictions = collections.OrderedDict()
     all_nbest_json = collections.OrderedDict()
@@ -839,7 +1198,7 @@ def write_predictions(examples_gen, all_crops, all_results, n_best_size,
     for example_index, example in enumerate(examples_gen):
         if example_index % 1000 == 0 and example_index > 0:
             logger.info(f'[{example_index}]: {short_num_empty} short and {long_num_empty} long empty')
-        crops = example_index_to_crops[example_index]
+        crops = [all_crops[i] for i in example_index_to_crop_indexes[example_index]]
 
         short_prelim_predictions, long_prelim_predictions = [], []
         for crop_index, crop in enumerate(crops):
@@ -1096,52 +1455,174 @@ def enumerate_tags(text_split):
     return text_split
 
 
-def convert_nq_to_squad(verbose, is_train, args=None):
+def token_char_offsets(text_split):
     """
-    Converte il jsonl in un formato compatibile con il Q&A Squad.
-    Squad non contiene YES/NO answer(certo 95%)
-    :param is_train: flag che indica se siamo in fase di training o evaluation. Training di default
-    :param verbose: flag per stampare o meno varei informazioni durante le trasformazioni(solo la prima)
-    :param args: None di Default, attualmente passati tramite la funzione getParams1(da cambiare?)
-    :return: list of entries
+    Calcola una volta per documento le posizioni (in caratteri) dei token nel testo ' '.join(text_split),
+    come somma cumulativa delle lunghezze dei token
+    :param text_split: lista dei token del documento
+    :return: array char_offsets, char_offsets[k] = len(' '.join(text_split[:k])) + 1 per k > 0
     """
-    np.random.seed(123)
-    # if args is None:
-    #     parser = argparse.ArgumentParser()
-    #     parser.add_argument('--fn', type=str, default='simplified-nq-train.jsonl')
-    #     parser.add_argument('--version', type=str, default='v1.0.2')
-    #     parser.add_argument('--prefix', type=str, default='nq')
-    #     parser.add_argument('--p_val', type=float, default=0.1)
-    #     parser.add_argument('--crop_len', type=int, default=2_500)
-    #     parser.add_argument('--num_samples', type=int, default=1_000_000)
-    #     parser.add_argument('--val_ids', type=str, default='val_ids.csv')
-    #     parser.add_argument('--do_enumerate', action='store_true')
-    #     parser.add_argument('--do_not_dump', action='store_true')
-    #     parser.add_argument('--num_max_tokens', type=int, default=400_000)
-    #     args = parser.parse_args()
+    num_tokens = len(text_split)
+    char_offsets = np.zeros(num_tokens + 1, dtype=np.int64)
+    token_lens = np.fromiter(map(len, text_split), dtype=np.int64, count=num_tokens)
+    np.cumsum(token_lens + 1, out=char_offsets[1:])
+    return char_offsets
 
-    if is_train:
-        train_fn = f'{args.prefix}-train-{args.version}.json'
-        val_fn = f'{args.prefix}-val-{args.version}.json'
-        print(f'Converting {args.fn} to {train_fn} & {val_fn} ... ')
-    else:
-        test_fn = f'{args.prefix}-test-{args.version}.json'
-        print(f'Converting {args.fn} to {test_fn} ... ')
+
+def joined_text_len(char_offsets, num_tokens):
+    """
+    Restituisce len(' '.join(text_split[:num_tokens])) in O(1)
+    :param char_offsets: array calcolato da token_char_offsets(text_split)
+    :param num_tokens: numero di token (come nello slicing, anche negativo)
+    :return: lunghezza in caratteri
+    """
+    max_tokens = len(char_offsets) - 1
+    if num_tokens < 0:
+        num_tokens = max(max_tokens + num_tokens, 0)
+    num_tokens = min(num_tokens, max_tokens)
+    if num_tokens == 0:
+        return 0
+    return int(char_offsets[num_tokens]) - 1
+
+
+def read_val_ids(args):
+    """
+    Legge gli id degli esempi di validation
+    :param args: argomenti della conversione, args.val_ids è il path del csv (o None)
+    :return: set of example ids
+    """
     if args.val_ids:
-        val_ids = set(str(x) for x in pd.read_csv(args.val_ids)['val_ids'].values)
+        return set(str(x) for x in pd.read_csv(args.val_ids)['val_ids'].values)
+    return set()
+
+
+def val_csv_rows(example_id, annotations):
+    """
+    Crea le righe del csv di validation (formato della competizione) di un esempio
+    :param example_id: id dell'esempio
+    :param annotations: annotations dell'esempio nel jsonl
+    :return: list of (example_id, PredictionString) rows, short answer first
+    """
+    short_answers = annotations[0][
+        'short_answers']
+    sa_str = ''
+    for si, sa in enumerate(short_answers):
+        sa_str += f'{sa["start_token"]}:{sa["end_token"]}'
+        if si < len(short_answers) - 1:
+            sa_str += ' '
+
+    la = annotations[0][
+        'long_answer']
+    la_str = ''
+    if la['start_token'] > 0:
+        la_str += f'{la["start_token"]}:{la["end_token"]}'
+    return [(example_id + '_short', sa_str), (example_id + '_long', la_str)]
+
+
+def open_nq_lines(args):
+    """
+    Apre le righe jsonl del file args.fn: se args.example_ids è dato sono lette solo quelle degli esempi
+    richiesti, cercandole con l'indice del file
+    :param args: argomenti della conversione (vedi get_convert_args1)
+    :return: context manager da chiudere, iterabile delle righe
+    """
+    example_ids = getattr(args, 'example_ids', None)
+    if example_ids:
+        lines_source = shard_utils.ExampleReader([args.fn])
+        return lines_source, lines_source.iter_lines(example_ids)
+    lines_source = shard_utils.open_shard(args.fn)
+    return lines_source, lines_source
+
+
+def document_text_tokens(document_text, args):
+    """
+    Divide il testo di un documento in token, troncandolo a args.num_max_tokens token e enumerando i tag
+    se args.do_enumerate
+    :param document_text: document_text del jsonl
+    :param args: argomenti della conversione
+    :return: lista dei token, True se il documento è stato troncato
+    """
+    document_text_split = document_text.split(' ')
+    # trim super long
+    is_trimmed = len(document_text_split) > args.num_max_tokens
+    if is_trimmed:
+        document_text_split = document_text_split[:args.num_max_tokens]
+    if args.do_enumerate:
+        document_text_split = enumerate_tags(document_text_split)
+    return document_text_split, is_trimmed
+
+
+def choose_crop(candidate_starts, long_answer, crop_len, rng):
+    """
+    Estrae a caso la finestra di token del documento di un esempio di training: inizia fino a
+    0.75 * crop_len token prima della long answer (o di una candidate a caso se non c'è)
+    :param candidate_starts: start_token delle long answer candidates
+    :param long_answer: long_answer dell'annotazione
+    :param crop_len: lunghezza della finestra, 0 per non croppare il documento
+    :param rng: generatore delle estrazioni
+    :return: crop_start, crop_end (escluso), indice della candidate
+    """
+    if long_answer['start_token'] == -1:
+        long_answer_candidate = rng.randint(len(candidate_starts))
+    else:
+        long_answer_candidate = long_answer['candidate_index']
+    if crop_len > 0:
+        crop_start = int(candidate_starts[long_answer_candidate]) - rng.randint(int(crop_len * 0.75))
+        crop_start = max(crop_start, 0)
+        crop_end = crop_start + crop_len
+    else:
+        crop_start = 0
+        crop_end = 10_000_000
+    return crop_start, crop_end, long_answer_candidate
+
+
+def iter_nq_to_squad(verbose, is_train, args, shuffle_buffer=0, val_csv_fn=None, shuffle_seed=123,
+                     keep_tokens=False, rng_seed=None, lines=None, show_progress=True):
+    """
+    Versione generatore di convert_nq_to_squad: le entries sono restituite
+    man mano che le righe del jsonl sono lette, quindi la memoria usata non
+    dipende dalla dimensione del file.
+    :param verbose: flag per stampare o meno varei informazioni durante le trasformazioni(solo la prima)
+    :param is_train: flag che indica se siamo in fase di training o evaluation
+    :param args: argomenti della conversione (vedi get_convert_args1)
+    :param shuffle_buffer: se > 0 le entries sono mescolate con un buffer di questa dimensione,
+        altrimenti sono restituite nell'ordine del file
+    :param val_csv_fn: se non None (e in training) le righe del csv di validation sono scritte
+        in questo file man mano che gli esempi di validation sono letti
+    :param shuffle_seed: seed del buffer di shuffle
+    :param keep_tokens: se True ogni paragrafo contiene anche i token del context ('context_tokens'),
+        così read_nq_examples non deve dividere di nuovo il context carattere per carattere
+    :param rng_seed: se None le estrazioni casuali (crop e candidate) usano np.random, altrimenti
+        il generatore dell'esempio (vedi example_rng), indipendente dall'ordine degli esempi
+    :param lines: se non None le righe jsonl da convertire, invece di quelle del file args.fn
+    :param show_progress: se False non sono mostrate la barra e le statistiche
+    :return: generator of entries
+    """
+    np.random.seed(123)
+    val_ids = read_val_ids(args)
+    shuffle_rng = np.random.RandomState(shuffle_seed)
+    buffer = []
+    if is_train and val_csv_fn is not None:
+        val_csv_file = open(val_csv_fn, 'w', newline='')
+        val_csv = csv.writer(val_csv_file)
+        val_csv.writerow(['example_id', 'PredictionString'])
     else:
-        val_ids = set()
+        val_csv_file = contextlib.nullcontext()
+        val_csv = None
 
-    entries = []
+    num_entries = 0
     smooth = 0.999
     total_split_len, long_split_len = 0., 0.
     long_end = 0.
     num_very_long, num_yes_no, num_short_dropped, num_trimmed = 0, 0, 0, 0
     num_short_possible, num_long_possible = 0, 0
     max_end_token = -1
-    orig_data = {}
-    with open(args.fn) as f:
-        progress = tqdm(f, total=args.num_samples)
+    if lines is not None:
+        lines_source = contextlib.nullcontext()
+    else:
+        lines_source, lines = open_nq_lines(args)
+    with lines_source, val_csv_file:
+        progress = tqdm(lines, total=args.num_samples, disable=not show_progress)
         entry = {}
         for kk, line in enumerate(progress):
 
@@ -1149,25 +1630,13 @@ def convert_nq_to_squad(verbose, is_train, args=None):
                 break
 
             data = json.loads(line)
-            data_cpy = data.copy()
-            example_id = str(data_cpy.pop('example_id'))
-            data_cpy['document_text'] = ''
-            orig_data[example_id] = data_cpy
 
             url = 'MISSING' if not is_train else data['document_url']
             # progress.write(f'############ {url} ###############')
-            document_text = data['document_text']
-            document_text_split = document_text.split(' ')
+            document_text_split, is_trimmed = document_text_tokens(data['document_text'], args)
             if verbose: print("DOCUMENT TEXT AND SPLIT")
-            # if verbose: print(document_text)
             # if verbose: print(document_text_split)
-            # trim super long
-            if len(document_text_split) > args.num_max_tokens:
-                num_trimmed += 1
-                document_text_split = document_text_split[:args.num_max_tokens]
-
-            if args.do_enumerate:
-                document_text_split = enumerate_tags(document_text_split)
+            num_trimmed += is_trimmed
             question = data['question_text']  # + '?'
             if verbose: print("QUESTION")
             if verbose: print(question)
@@ -1177,12 +1646,14 @@ def convert_nq_to_squad(verbose, is_train, args=None):
 
             # User str keys!
             example_id = str(data['example_id'])
+            rng = np.random if rng_seed is None else example_rng(example_id, rng_seed)
             candidates = data['long_answer_candidates']
             if verbose: print("CANDIDATES")
             if verbose: print(candidates)
             if not is_train:
                 qa = {'question': question, 'id': example_id, 'crop_start': 0}
-                context = ' '.join(document_text_split)
+                context_tokens = document_text_split
+                context = ' '.join(context_tokens)
 
             else:
                 if verbose: print("In else TRAIN")
@@ -1215,33 +1686,22 @@ def convert_nq_to_squad(verbose, is_train, args=None):
                 if verbose: print(f'Q: {question}')
                 if verbose: print(f'L: {long_answer}')
                 long_is_impossible = long_answer['start_token'] == -1
-                if long_is_impossible:
-                    long_answer_candidate = np.random.randint(len(candidates))
-                else:
-                    long_answer_candidate = long_answer['candidate_index']
                 if verbose: print("LONG ANS IMPOSSIBLE STATE:" + str(long_is_impossible))
-                long_start_token = candidates[long_answer_candidate]['start_token']
-                long_end_token = candidates[long_answer_candidate]['end_token']
 
-                if verbose: print("LONG START: " + str(long_start_token) + "END: " + str(long_end_token))
+                # character offsets of the tokens, used for every token -> char conversion below
+                char_offsets = token_char_offsets(document_text_split)
 
                 # generate crop based on tokens. Note that validation samples should
                 # not be cropped as this won't reflect test set performance.
-                if args.crop_len > 0 and example_id not in val_ids:
-                    crop_start = long_start_token - np.random.randint(int(args.crop_len * 0.75))
-                    if verbose: print("IN CROP LEN: " + str(crop_start))
-
-                    if crop_start <= 0:
-                        crop_start = 0
-                        crop_start_len = -1
-                    else:
-                        crop_start_len = len(' '.join(document_text_split[:crop_start]))
-
-                    crop_end = crop_start + args.crop_len
-                else:
-                    crop_start = 0
+                crop_len = args.crop_len if example_id not in val_ids else 0
+                crop_start, crop_end, long_answer_candidate = choose_crop(
+                    [c['start_token'] for c in candidates], long_answer, crop_len, rng)
+                long_end_token = candidates[long_answer_candidate]['end_token']
+                if verbose: print("CROP: " + str(crop_start) + " LONG END: " + str(long_end_token))
+                if crop_start <= 0:
                     crop_start_len = -1
-                    crop_end = 10_000_000
+                else:
+                    crop_start_len = joined_text_len(char_offsets, crop_start)
 
                 is_very_long = False
                 if long_end_token > crop_end:
@@ -1251,14 +1711,13 @@ def convert_nq_to_squad(verbose, is_train, args=None):
                     # continue
 
                 document_text_crop_split = document_text_split[crop_start: crop_end]
+                context_tokens = document_text_crop_split
 
                 context = ' '.join(document_text_crop_split)
                 # create long answer
                 long_answers_ = []
                 if not long_is_impossible:
-                    long_answer_pre_split = document_text_split[:long_answer[
-                        'start_token']]
-                    long_answer_start = len(' '.join(long_answer_pre_split)) - \
+                    long_answer_start = joined_text_len(char_offsets, long_answer['start_token']) - \
                                         crop_start_len
                     long_answer_split = document_text_split[long_answer['start_token']:
                                                             long_answer['end_token']]
@@ -1279,8 +1738,7 @@ def convert_nq_to_squad(verbose, is_train, args=None):
                         if short_start_token >= crop_start + args.crop_len:
                             num_short_dropped += 1
                             continue
-                        short_answers_pre_split = document_text_split[:short_start_token]
-                        short_answer_start = len(' '.join(short_answers_pre_split)) - \
+                        short_answer_start = joined_text_len(char_offsets, short_start_token) - \
                                              crop_start_len
                         short_answer_split = document_text_split[short_start_token: short_end_token]
                         short_answer_text = ' '.join(short_answer_split)
@@ -1309,19 +1767,71 @@ def convert_nq_to_squad(verbose, is_train, args=None):
                 if verbose: print("QA 1 di Example formato Squad")
                 if verbose: print(qa)
             paragraph = {'qas': [qa], 'context': context}
+            if keep_tokens:
+                paragraph['context_tokens'] = context_tokens
             if verbose: print("PARAGRAFO")
             # if verbose: print(paragraph)
             entry = {'title': url, 'paragraphs': [paragraph]}
-            entries.append(entry)
-            if verbose: print("ENTRIES")
-            # if verbose: print(entries)
+            num_entries += 1
+            if val_csv is not None and example_id in val_ids:
+                val_csv.writerows(val_csv_rows(example_id, annotations))
             if verbose: verbose = False
+            if shuffle_buffer > 0:
+                # bounded shuffling: the new entry takes the place of a random
+                # entry of the buffer, which is returned
+                if len(buffer) < shuffle_buffer:
+                    buffer.append(entry)
+                    continue
+                i = shuffle_rng.randint(shuffle_buffer)
+                buffer[i], entry = entry, buffer[i]
+            yield entry
+
+    if show_progress:
+        progress.write('  ------------ STATS ------------------')
+        progress.write(f'  Number od dropped:  {num_yes_no} yes/no, {num_very_long} very long'
+                       f' and {num_short_dropped} short of {kk} and trimmed {num_trimmed}')
+        progress.write(f'  #short {num_short_possible} #long {num_long_possible}'
+                       f' of {num_entries}')
+    if val_csv is not None:
+        print(f'Wrote csv to {val_csv_fn}')
+
+    shuffle_rng.shuffle(buffer)
+    for entry in buffer:
+        yield entry
 
-    progress.write('  ------------ STATS ------------------')
-    progress.write(f'  Number od dropped:  {num_yes_no} yes/no, {num_very_long} very long'
-                   f' and {num_short_dropped} short of {kk} and trimmed {num_trimmed}')
-    progress.write(f'  #short {num_short_possible} #long {num_long_possible}'
-                   f' of {len(entries)}')
+
+def squad_entries(entries):
+    """
+    Toglie dalle entries i token del context (vedi iter_nq_to_squad), che non fanno parte del formato Squad
+    :param entries: lista di entries
+    :return: lista di entries in formato Squad
+    """
+    return [{'title': entry['title'],
+             'paragraphs': [{k: v for k, v in paragraph.items() if k != 'context_tokens'}
+                            for paragraph in entry['paragraphs']]}
+            for entry in entries]
+
+
+def convert_nq_to_squad(verbose, is_train, args=None, keep_tokens=False):
+    """
+    Converte il jsonl in un formato compatibile con il Q&A Squad.
+    Squad non contiene YES/NO answer(certo 95%)
+    :param is_train: flag che indica se siamo in fase di training o evaluation. Training di default
+    :param verbose: flag per stampare o meno varei informazioni durante le trasformazioni(solo la prima)
+    :param args: None di Default, attualmente passati tramite la funzione getParams1(da cambiare?)
+    :param keep_tokens: vedi iter_nq_to_squad, i token non sono scritti nei json
+    :return: list of entries
+    """
+    if is_train:
+        train_fn = f'{args.prefix}-train-{args.version}.json'
+        val_fn = f'{args.prefix}-val-{args.version}.json'
+        print(f'Converting {args.fn} to {train_fn} & {val_fn} ... ')
+    else:
+        test_fn = f'{args.prefix}-test-{args.version}.json'
+        print(f'Converting {args.fn} to {test_fn} ... ')
+    val_ids = read_val_ids(args)
+
+    entries = list(iter_nq_to_squad(verbose, is_train, args, keep_tokens=keep_tokens))
 
     # shuffle to test remaining code
     np.random.shuffle(entries)
@@ -1333,37 +1843,25 @@ def convert_nq_to_squad(verbose, is_train, args=None):
                 train_entries.append(entry)
             else:
                 val_entries.append(entry)
-        if verbose: print("TRAIN ENTRIES: " + str(train_entries))
-        if verbose: print("VAL ENTRIES: " + str(val_entries))
         for out_fn, _entries in [(train_fn, train_entries), (val_fn, val_entries)]:
             if not args.do_not_dump:
                 with open(out_fn, 'w') as f:
-                    json.dump({'version': args.version, 'data': _entries}, f)
-                progress.write(f'Wrote {len(_entries)} entries to {out_fn}')
+                    json.dump({'version': args.version, 'data': squad_entries(_entries)}, f)
+                print(f'Wrote {len(_entries)} entries to {out_fn}')
 
             # save val in competition csv format
             if 'val' in out_fn:
 
+                # the annotations are read back from the file through its index
+                # instead of keeping a copy of every record in memory
+                orig_data = shard_utils.ExampleReader([args.fn])
                 val_example_ids, val_strs = [], []
                 for entry in _entries:
                     example_id = entry['paragraphs'][0]['qas'][0]['id']
-                    short_answers = orig_data[example_id]['annotations'][0][
-                        'short_answers']
-                    sa_str = ''
-                    for si, sa in enumerate(short_answers):
-                        sa_str += f'{sa["start_token"]}:{sa["end_token"]}'
-                        if si < len(short_answers) - 1:
-                            sa_str += ' '
-                    val_example_ids.append(example_id + '_short')
-                    val_strs.append(sa_str)
-
-                    la = orig_data[example_id]['annotations'][0][
-                        'long_answer']
-                    la_str = ''
-                    if la['start_token'] > 0:
-                        la_str += f'{la["start_token"]}:{la["end_token"]}'
-                    val_example_ids.append(example_id + '_long')
-                    val_strs.append(la_str)
+                    for row_id, row_str in val_csv_rows(example_id, orig_data.read(example_id)['annotations']):
+                        val_example_ids.append(row_id)
+                        val_strs.append(row_str)
+                orig_data.close()
 
                 val_df = pd.DataFrame({'example_id': val_example_ids,
                                        'PredictionString': val_strs})
@@ -1375,13 +1873,11 @@ def convert_nq_to_squad(verbose, is_train, args=None):
     else:  # ELSE di IF training
         if not args.do_not_dump:
             with open(test_fn, 'w') as f:
-                json.dump({'version': args.version, 'data': entries}, f)
-            progress.write(f'Wrote to {test_fn}')
+                json.dump({'version': args.version, 'data': squad_entries(entries)}, f)
+            print(f'Wrote to {test_fn}')
 
     if args.val_ids:
         print(f'Using val ids from: {args.val_ids}')
-    if verbose: print("PRINT ENTRIES")
-    if verbose: print(entries)
     return entries
 
 
@@ -1398,6 +1894,18 @@ def set_seed(args):
     tf.random.set_seed(args.seed)
 
 
+def example_rng(example_id, seed):
+    """
+    Generatore casuale di un esempio: dipende solo dal suo example_id e dal seed, quindi le estrazioni
+    di un esempio non dipendono da quali esempi sono stati elaborati prima (né da quale processo)
+    :param example_id: id dell'esempio (anche negativo, a 64 bit)
+    :param seed: seed della conversione
+    :return: np.random.RandomState
+    """
+    example_id = int(example_id) % 2 ** 64
+    return np.random.RandomState([seed % 2 ** 32, example_id & 0xffffffff, example_id >> 32])
+
+
 def get_convert_args(name):
     convert_args = argparse.Namespace()
     convert_args.fn = name
@@ -1408,6 +1916,7 @@ def get_convert_args(name):
     convert_args.do_enumerate = False
     convert_args.do_not_dump = True
     convert_args.num_max_tokens = 400_000
+    convert_args.example_ids = None
     return convert_args
 
 
@@ -1428,6 +1937,7 @@ def get_convert_args1(namefile, max_num_samples):
     convert_args.do_enumerate = 'store_true'
     convert_args.do_not_dump = 'store_true'
     convert_args.num_max_tokens = 400_000
+    convert_args.example_ids = None
 
     return convert_args
 
@@ -1454,91 +1964,498 @@ def toMatrixTensor(crop_or_position, len):
     return tf.convert_to_tensor(m, dtype=tf.int32)
 
 
-def load_and_cache_crops(args, tokenizer, namefile, verbose, evaluate, max_num_samples, do_cache=False):
+# state of the preprocessing workers, set once by _init_preprocess_worker
+_preprocess_worker = {}
+
+
+def _init_preprocess_worker(args_nq, tokenizer, crop_kwargs, tokenizer_backend, word_cache_kwargs):
+    # the word tokenizer (and its cache) is shared by all the chunks of the worker
+    word_tokenizer = None
+    if tokenizer is not None:
+        word_tokenizer = word_tokenization.get_word_tokenizer(tokenizer, tokenizer_backend, **word_cache_kwargs)
+    _preprocess_worker.update(args_nq=args_nq, tokenizer=tokenizer, crop_kwargs=crop_kwargs,
+                              word_tokenizer=word_tokenizer)
+
+
+def _preprocess_chunk(task):
+    lines, is_train, seed, keep_tokens = task
+    args_nq = _preprocess_worker['args_nq']
+    tokenizer = _preprocess_worker['tokenizer']
+    entries = list(iter_nq_to_squad(False, is_train, args_nq, keep_tokens=keep_tokens, rng_seed=seed,
+                                    lines=lines, show_progress=False))
+    if tokenizer is None:
+        return entries, 0, None
+    examples = list(read_nq_examples(entries, is_training=is_train, show_progress=False))
+    crops = convert_examples_to_crops(examples_gen=examples, tokenizer=tokenizer, is_training=is_train,
+                                      rng_seed=seed + 1, word_tokenizer=_preprocess_worker['word_tokenizer'],
+                                      **_preprocess_worker['crop_kwargs'])
+    return entries, len(examples), crops
+
+
+def preprocess_parallel(args_nq, is_train, num_workers, seed, keep_tokens=False, tokenizer=None,
+                        crop_kwargs=None, chunk_size=256, tokenizer_backend='slow', word_cache_kwargs=None):
+    """
+    Converte il file args_nq.fn in entries e crops con num_workers processi.
+    Le righe sono mescolate con un seed fisso e divise in blocchi, ogni blocco è convertito da un
+    processo e i risultati sono uniti nell'ordine dei blocchi; le estrazioni casuali di ogni esempio
+    usano il suo generatore (vedi example_rng), quindi il risultato è lo stesso per ogni num_workers.
+    I json e il csv di validation di convert_nq_to_squad non sono scritti
+    :param args_nq: argomenti della conversione (vedi get_convert_args1)
+    :param is_train: flag che indica se siamo in fase di training o evaluation
+    :param num_workers: numero di processi, con 1 tutto è fatto nel processo corrente
+    :param seed: seed della conversione
+    :param keep_tokens: vedi iter_nq_to_squad
+    :param tokenizer: se None sono calcolate solo le entries
+    :param crop_kwargs: argomenti di convert_examples_to_crops (oltre a examples_gen, tokenizer e is_training)
+    :param chunk_size: numero di righe di ogni blocco
+    :param tokenizer_backend: backend del tokenizer delle parole (vedi word_tokenization)
+    :param word_cache_kwargs: argomenti della cache delle parole di get_word_tokenizer
+    :return: list of entries, CropStore (None se tokenizer è None)
+    """
+    example_ids = getattr(args_nq, 'example_ids', None)
+    if example_ids:
+        with shard_utils.ExampleReader([args_nq.fn]) as reader:
+            lines = list(itertools.islice(reader.iter_lines(example_ids), args_nq.num_samples))
+    else:
+        with shard_utils.open_shard(args_nq.fn) as f:
+            lines = list(itertools.islice(f, args_nq.num_samples))
+    # shuffle the examples, the entries of a line do not depend on its position
+    lines = [lines[i] for i in np.random.RandomState(seed).permutation(len(lines))]
+    tasks = [(lines[i: i + chunk_size], is_train, seed, keep_tokens) for i in range(0, len(lines), chunk_size)]
+    print(f'Converting {args_nq.fn} with {num_workers} workers ({len(tasks)} chunks) ...')
+
+    initargs = (args_nq, tokenizer, crop_kwargs or {}, tokenizer_backend, word_cache_kwargs or {})
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_preprocess_worker, initargs=initargs)
+        results = pool.imap(_preprocess_chunk, tasks)
+    else:
+        pool = contextlib.nullcontext()
+        _init_preprocess_worker(*initargs)
+        results = map(_preprocess_chunk, tasks)
+
+    # merge following the order of the chunks, renumbering examples and crops
+    entries, stores, example_offsets = [], [], []
+    num_examples = 0
+    with pool:
+        for chunk_entries, chunk_num_examples, chunk_crops in tqdm(results, total=len(tasks)):
+            entries.extend(chunk_entries)
+            if chunk_crops is not None:
+                stores.append(chunk_crops)
+                example_offsets.append(num_examples)
+            num_examples += chunk_num_examples
+    if tokenizer is None:
+        return entries, None
+    if stores:
+        crops = CropStore.concatenate(stores, example_offsets)
+    else:
+        # no chunk has crops: empty file, example_ids not found or num_samples=0
+        crops = CropStore.empty((crop_kwargs or {})['max_seq_length'], is_train, vocabulary_tokens(tokenizer))
+    print(f'Converted {len(entries)} entries to {len(crops)} crops')
+    return entries, crops
+
+
+class DocumentStore:
+    """
+    I documenti di training di un file tokenizzati una volta sola (vedi tokenize_documents): gli id dei subtoken
+    di tutto il documento, la mappa parola -> primo subtoken e la mappa token -> parole, concatenati in tre
+    array (doc_ids, word_to_tok, token_to_word) con gli offset di ogni documento, più le annotazioni.
+    sample_crops taglia da questi array le finestre casuali di crop_len token di iter_nq_to_squad e i loro
+    doc spans, in un ordine dei documenti permutato, quindi ogni epoca ha crops diversi senza tokenizzare di
+    nuovo i documenti
+    """
+
+    def __init__(self, arrays, infos):
+        """
+        :param arrays: dizionario nome -> array (anche memory mapped)
+        :param infos: lista di DocumentInfo, una per documento
+        """
+        self.arrays = arrays
+        self.infos = infos
+
+    def __len__(self):
+        return len(self.infos)
+
+    def document(self, index):
+        """
+        :param index: indice del documento
+        :return: id dei subtoken, word_to_tok (primo subtoken di ogni parola, più il numero dei subtoken) e
+            token_to_word (numero di parole prima di ogni token, più il numero delle parole) del documento
+        """
+        arrays = self.arrays
+        doc_offsets, word_offsets, token_offsets = (arrays[name] for name in DOCUMENT_OFFSETS)
+        return (arrays['doc_ids'][doc_offsets[index]: doc_offsets[index + 1]],
+                arrays['word_to_tok'][word_offsets[index]: word_offsets[index + 1]],
+                arrays['token_to_word'][token_offsets[index]: token_offsets[index + 1]])
+
+    def sample_crops(self, tokenizer, crop_len, rng_seed, max_seq_length, doc_stride, max_query_length,
+                     cls_token='[CLS]', sep_token='[SEP]', pad_id=0,
+                     sequence_a_segment_id=0,
+                     sequence_b_segment_id=1,
+                     cls_token_segment_id=0,
+                     pad_token_segment_id=0,
+                     mask_padding_with_zero=True,
+                     p_keep_impossible=None,
+                     sep_token_extra=False):
+        """
+        Estrae i crops dei documenti: gli stessi crops di iter_nq_to_squad(rng_seed=rng_seed), read_nq_examples
+        e convert_examples_to_crops(rng_seed=rng_seed + 1), ma tagliati dai subtoken già calcolati.
+        I documenti sono presi in un ordine permutato con RandomState(rng_seed), diverso a ogni epoca, così i
+        batch non seguono l'ordine del file; i crops di un documento restano consecutivi e la finestra di ogni
+        documento dipende solo dal suo example_id, non dalla sua posizione
+        :param tokenizer: tokenizer dei documenti
+        :param crop_len: lunghezza in token delle finestre (vedi choose_crop)
+        :param rng_seed: seed delle estrazioni e dell'ordine, da cambiare a ogni epoca per avere crops diversi
+        :return: CropStore con i crops, nell'ordine permutato dei documenti
+        """
+        assert p_keep_impossible is not None, '`p_keep_impossible` is required'
+        cls_id, sep_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
+        documents, crop_specs = [], []
+        for example_index in np.random.RandomState(rng_seed).permutation(len(self.infos)):
+            example_index = int(example_index)
+            info = self.infos[example_index]
+            doc_ids, word_to_tok, token_to_word = self.document(example_index)
+            rng = example_rng(info.example_id, rng_seed)
+            # validation samples are not cropped
+            crop_start, crop_end, _ = choose_crop(info.candidate_starts, info.long_answer,
+                                                  crop_len if not info.is_val else 0, rng)
+            crop_stop = min(crop_end, len(token_to_word) - 1)
+            word_start, word_stop = int(token_to_word[crop_start]), int(token_to_word[crop_stop])
+            tok_start, tok_stop = int(word_to_tok[word_start]), int(word_to_tok[word_stop])
+
+            long_is_impossible = info.long_answer['start_token'] == -1
+            tok_long_position = -1
+            if not long_is_impossible:
+                tok_long_position = int(word_to_tok[token_to_word[info.long_answer['start_token']]]) - tok_start
+
+            # the leftmost short answer that starts in the crop, the part out of the crop is cut
+            short_answers = [a for a in info.short_answers if a[0] < crop_start + crop_len]
+            short_is_impossible = len(short_answers) == 0
+            tok_start_position, tok_end_position = -1, -1
+            if not short_is_impossible:
+                short_start, short_end = min(short_answers, key=operator.itemgetter(0))
+                tok_start_position = int(word_to_tok[token_to_word[short_start]]) - tok_start
+                tok_end_position = int(word_to_tok[token_to_word[min(short_end, crop_stop)]]) - 1 - tok_start
+
+            word_lens = np.diff(word_to_tok[word_start: word_stop + 1])
+            tok_to_orig_index = np.repeat(np.arange(word_stop - word_start, dtype=np.int32), word_lens)
+            append_example_crops(documents, crop_specs, example_index, info.query_ids[:max_query_length],
+                                 doc_ids[tok_start: tok_stop], tok_to_orig_index, crop_start,
+                                 tok_start_position, tok_end_position, tok_long_position,
+                                 short_is_impossible, long_is_impossible, True,
+                                 max_seq_length, doc_stride, p_keep_impossible, sep_token_extra,
+                                 example_rng(info.example_id, rng_seed + 1))
+
+        arrays = fill_crop_arrays(documents, crop_specs, max_seq_length,
+                                  cls_id=cls_id, sep_id=sep_id, pad_id=pad_id,
+                                  sequence_a_segment_id=sequence_a_segment_id,
+                                  sequence_b_segment_id=sequence_b_segment_id,
+                                  cls_token_segment_id=cls_token_segment_id,
+                                  pad_token_segment_id=pad_token_segment_id,
+                                  mask_padding_with_zero=mask_padding_with_zero)
+        arrays.update(crop_fields(crop_specs, True))
+        return CropStore(arrays, vocabulary_tokens(tokenizer))
+
+
+def _concatenate_documents(parts, dtype):
+    # concatenated values and offsets of the parts
+    offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    np.cumsum([len(part) for part in parts], out=offsets[1:])
+    values = np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype=dtype)
+    return values, offsets
+
+
+def tokenize_documents(args_nq, tokenizer, word_tokenizer=None, lines=None, block_size=1000):
+    """
+    Tokenizza tutti i documenti di training del file args_nq.fn, interi (la finestra di crop_len token è
+    estratta dopo, vedi DocumentStore.sample_crops). Le domande yes/no sono scartate come in iter_nq_to_squad
+    :param args_nq: argomenti della conversione (vedi get_convert_args1), crop_len non è usato
+    :param tokenizer: tokenizer di transformers
+    :param word_tokenizer: tokenizer delle parole (vedi word_tokenization), se None tokenizer.tokenize
+    :param lines: se non None le righe jsonl da tokenizzare, invece di quelle del file args_nq.fn
+    :param block_size: numero di documenti le cui parole sono tokenizzate insieme
+    :return: DocumentStore
+    """
+    if word_tokenizer is None:
+        word_tokenizer = word_tokenization.WordTokenizer(tokenizer)
+    val_ids = read_val_ids(args_nq)
+    infos, doc_ids, word_to_tok, token_to_word = [], [], [], []
+    if lines is not None:
+        lines_source = contextlib.nullcontext()
+    else:
+        lines_source, lines = open_nq_lines(args_nq)
+    with lines_source:
+        lines = itertools.islice(lines, args_nq.num_samples)
+        for block in iter(lambda: list(itertools.islice(lines, block_size)), []):
+            documents = []
+            for line in block:
+                data = json.loads(line)
+                annotation = data['annotations'][0]
+                if annotation['yes_no_answer'] != 'NONE':
+                    continue
+                document_text_split, _ = document_text_tokens(data['document_text'], args_nq)
+                words, words_before = context_words(document_text_split)
+                documents.append((data, annotation, words, words_before))
+            word_tokenizer.add_words(word for _, _, words, _ in documents for word in words)
+
+            for data, annotation, words, words_before in documents:
+                word_ids = [word_tokenizer.get(word)[1] for word in words]
+                word_starts = np.zeros(len(words) + 1, dtype=np.int64)
+                np.cumsum([len(ids) for ids in word_ids], out=word_starts[1:])
+                doc_ids.append(np.fromiter(itertools.chain.from_iterable(word_ids), dtype=np.int32,
+                                           count=int(word_starts[-1])))
+                word_to_tok.append(word_starts)
+                token_to_word.append(words_before)
+                example_id = str(data['example_id'])
+                long_answer = annotation['long_answer']
+                infos.append(DocumentInfo(
+                    example_id=example_id,
+                    query_ids=tokenizer.convert_tokens_to_ids(tokenizer.tokenize(data['question_text'])),
+                    candidate_starts=np.array([c['start_token'] for c in data['long_answer_candidates']],
+                                              dtype=np.int32),
+                    long_answer={k: long_answer[k] for k in ('start_token', 'end_token', 'candidate_index')},
+                    short_answers=[(a['start_token'], a['end_token']) for a in annotation['short_answers']],
+                    is_val=example_id in val_ids))
+
+    arrays = {}
+    arrays['doc_ids'], arrays['doc_offsets'] = _concatenate_documents(doc_ids, np.int32)
+    arrays['word_to_tok'], arrays['word_offsets'] = _concatenate_documents(word_to_tok, np.int32)
+    arrays['token_to_word'], arrays['token_offsets'] = _concatenate_documents(token_to_word, np.int32)
+    return DocumentStore(arrays, infos)
+
+
+def load_and_cache_documents(args, tokenizer, args_nq, word_tokenizer):
+    """
+    Legge dalla cache dei documenti (args.document_cache_dir) i documenti tokenizzati del file args_nq.fn, o li
+    tokenizza e li salva se mancano. La chiave dipende dal contenuto del file e dai parametri della
+    tokenizzazione, non da quelli dei crops (crop_len, max_seq_length, doc_stride, ...)
+    :param args_nq: argomenti della conversione
+    :param word_tokenizer: tokenizer delle parole
+    :return: DocumentStore, con gli array memory mapped
+    """
+    cache = crop_cache.CropCache(args.document_cache_dir,
+                                 int(getattr(args, 'document_cache_size', crop_cache.CACHE_SIZE_GB) * 1024 ** 3))
+    params = {k: v for k, v in vars(args_nq).items() if k not in ('fn', 'crop_len')}
+    if args_nq.example_ids:
+        params['example_ids'] = sorted(str(e) for e in args_nq.example_ids)
+    params.update(documents=True,
+                  tokenizer=word_tokenization.tokenizer_fingerprint(tokenizer),
+                  tokenizer_backend=getattr(args, 'tokenizer_backend', 'slow'))
+    key = crop_cache.cache_key(args_nq.fn, params)
+    cached = cache.get(key)
+    if cached is not None:
+        print(f'Loading the documents of {args_nq.fn} from the cache entry {key}')
+        arrays, infos = cached
+        return DocumentStore(arrays, infos)
+
+    print(f'Tokenizing the documents of {args_nq.fn}')
+    documents = tokenize_documents(args_nq, tokenizer, word_tokenizer)
+    cache.put(key, documents.arrays, documents.infos, params, side_table=DOCUMENT_OFFSETS)
+    print(f'Saved {len(documents)} documents of {args_nq.fn} to the cache entry {key}')
+    # use the mapped arrays, the ones in memory are freed
+    return DocumentStore(cache.load_arrays(key), documents.infos)
+
+
+def get_crop_cache_params(args, args_nq, tokenizer, evaluate, crop_kwargs, parallel, stream_conversion):
+    """
+    Parametri da cui dipendono i crops di load_and_cache_crops, usati per la chiave della cache
+    :param args_nq: argomenti della conversione (il file è identificato dal suo contenuto)
+    :param crop_kwargs: argomenti di convert_examples_to_crops
+    :param parallel: True se la conversione è fatta da preprocess_parallel (l'ordine dei crops è diverso)
+    :param stream_conversion: True se la conversione è fatta da iter_nq_to_squad con shuffle buffer
+    :return: dizionario serializzabile in json
+    """
+    params = {k: v for k, v in vars(args_nq).items() if k != 'fn'}
+    if args_nq.example_ids:
+        params['example_ids'] = sorted(str(e) for e in args_nq.example_ids)
+    params.update(evaluate=evaluate,
+                  crop_kwargs=crop_kwargs,
+                  tokenizer=word_tokenization.tokenizer_fingerprint(tokenizer),
+                  tokenizer_backend=getattr(args, 'tokenizer_backend', 'slow'),
+                  seed=args.seed,
+                  parallel=parallel,
+                  stream_conversion=stream_conversion)
+    if stream_conversion:
+        params['shuffle_buffer'] = args.shuffle_buffer
+    return params
+
+
+def load_and_cache_crops(args, tokenizer, namefile, verbose, evaluate, max_num_samples, do_cache=False, epoch=0):
     """
     Load data crops from cache or dataset file
-    :param do_cache:
+    :param do_cache: se True i crops sono letti dalla cache (vedi crop_cache), o salvati se mancano; la chiave
+        dipende dal contenuto di namefile e da tutti i parametri della conversione (vedi get_crop_cache_params)
+    :param epoch: epoca di training, se args.document_cache_dir è dato i crops sono estratti dai documenti
+        tokenizzati (vedi DocumentStore) con un seed diverso per ogni epoca, e do_cache non è usato
     :param max_num_samples:
     :param args: variabili varie ed eventuali
     :param tokenizer: tokenizer(°-°)
     :param namefile: path del file da prendere in considerazione
     :param verbose: flag per stampare o meno varei informazioni durante le trasformazioni(solo la prima)
     :param evaluate: bool False di default. Se True dataset contiene solo gli Input, altrimenti anche i Target
-    :return: lista contenente input e target, lista di crops, lista di entries
+    :return: lista degli array di input e target (memory mapped se letti dalla cache), CropStore dei crops,
+        lista di entries (un generatore già consumato
+        se args.stream_conversion)
     """
 
     if evaluate:
         args_nq = get_convert_args(namefile)
     else:
         args_nq = get_convert_args1(namefile, max_num_samples)
-
-    cached_folder = '../cache/'
-    cached_crops_fn = cached_folder + 'cached_test.pkl'
-    if os.path.exists(cached_crops_fn) and do_cache:
-        print("Loading crops from cached file %s", cached_crops_fn)
-        with open(cached_crops_fn, "rb") as f:
-            crops = pickle.load(f)
-        entries = convert_nq_to_squad(verbose, args=args_nq, is_train=not evaluate)
-
+    args_nq.example_ids = getattr(args, 'example_ids', None)
+
+    # build the examples from the tokens of the documents instead of splitting the contexts again
+    keep_tokens = not getattr(args, 'char_level_examples', False)
+    num_workers = getattr(args, 'num_preprocess_workers', 0)
+    tokenizer_backend = getattr(args, 'tokenizer_backend', 'slow')
+    # the word pieces cache is kept across files (and on disk if word_cache_dir is given)
+    word_cache_kwargs = dict(cache_dir=getattr(args, 'word_cache_dir', None),
+                             cache_size=getattr(args, 'word_cache_size', word_tokenization.CACHE_SIZE))
+    crop_kwargs = dict(max_seq_length=args.max_seq_length,
+                       doc_stride=args.doc_stride,
+                       max_query_length=args.max_query_length,
+                       cls_token_segment_id=0,
+                       pad_token_segment_id=0,
+                       p_keep_impossible=args.p_keep_impossible if not evaluate else 1.0)
+
+    stream_conversion = getattr(args, 'stream_conversion', False) and not evaluate
+    document_cache_dir = getattr(args, 'document_cache_dir', None) if not evaluate else None
+    cache, cache_key, cached = None, None, None
+    if document_cache_dir:
+        # the documents are tokenized once and cropped again at every epoch, caching
+        # the crops would always give the same random windows
+        do_cache = False
+    if do_cache:
+        cache = crop_cache.CropCache(getattr(args, 'crop_cache_dir', None) or CROP_CACHE_DIR,
+                                     int(getattr(args, 'crop_cache_size', crop_cache.CACHE_SIZE_GB) * 1024 ** 3))
+        cache_params = get_crop_cache_params(args, args_nq, tokenizer, evaluate, crop_kwargs,
+                                             parallel=num_workers > 0, stream_conversion=stream_conversion)
+        cache_key = crop_cache.cache_key(namefile, cache_params)
+        cached = cache.get(cache_key)
+
+    if document_cache_dir:
+        word_tokenizer = word_tokenization.get_word_tokenizer(tokenizer, tokenizer_backend, **word_cache_kwargs)
+        documents = load_and_cache_documents(args, tokenizer, args_nq, word_tokenizer)
+        # sample_crops uses two seeds per epoch
+        crops = documents.sample_crops(tokenizer, args_nq.crop_len, args.seed + 2 * epoch, **crop_kwargs)
+        print(f'Cut {len(crops)} crops from {len(documents)} documents of {namefile} (epoch {epoch})')
+        # the entries are not built
+        entries = iter(())
+    elif cached is not None:
+        print(f'Loading crops of {namefile} from the cache entry {cache_key}')
+        arrays, (entries, id_to_token) = cached
+        crops = CropStore(arrays, id_to_token)
+        if entries is None:
+            # the entries of a stream conversion are not kept
+            entries = iter(())
     else:
         print("NOT loading crops")
-        entries = convert_nq_to_squad(verbose, args=args_nq, is_train=not evaluate)
-        examples_gen = read_nq_examples(entries, is_training=not evaluate)
-        crops = convert_examples_to_crops(examples_gen=examples_gen,
-                                          tokenizer=tokenizer,
-                                          max_seq_length=args.max_seq_length,
-                                          doc_stride=args.doc_stride,
-                                          max_query_length=args.max_query_length,
-                                          is_training=not evaluate,
-                                          cls_token_segment_id=0,
-                                          pad_token_segment_id=0,
-                                          p_keep_impossible=args.p_keep_impossible if not evaluate else 1.0)
-        if do_cache:
-            # if cached_folder does not exist create it
-            if not os.path.exists(cached_folder):
-                os.makedirs(cached_folder)
-            with open(cached_crops_fn, "wb") as f:
-                pickle.dump(crops, f)
-
-    # stack
-    all_input_ids = tf.stack([c.input_ids for c in crops], 0)
-    all_attention_mask = tf.stack([c.attention_mask for c in crops], 0)
-    all_token_type_ids = tf.stack([c.token_type_ids for c in crops], 0)
+        if num_workers > 0:
+            entries, crops = preprocess_parallel(args_nq, not evaluate, num_workers, args.seed,
+                                                 keep_tokens=keep_tokens, tokenizer=tokenizer,
+                                                 crop_kwargs=crop_kwargs, tokenizer_backend=tokenizer_backend,
+                                                 word_cache_kwargs=word_cache_kwargs)
+        else:
+            if stream_conversion:
+                # the entries are consumed as they are converted and are not kept
+                entries = iter_nq_to_squad(verbose, is_train=True, args=args_nq,
+                                           shuffle_buffer=args.shuffle_buffer, keep_tokens=keep_tokens)
+            else:
+                entries = convert_nq_to_squad(verbose, args=args_nq, is_train=not evaluate, keep_tokens=keep_tokens)
+            examples_gen = read_nq_examples(entries, is_training=not evaluate)
+            word_tokenizer = word_tokenization.get_word_tokenizer(tokenizer, tokenizer_backend, **word_cache_kwargs)
+            crops = convert_examples_to_crops(examples_gen=examples_gen,
+                                              tokenizer=tokenizer,
+                                              is_training=not evaluate,
+                                              word_tokenizer=word_tokenizer,
+                                              **crop_kwargs)
+            print(word_tokenizer.cache.stats())
+        if cache is not None:
+            cache.put(cache_key, crops.arrays, (None if stream_conversion else entries, crops.id_to_token),
+                      cache_params)
+            print(f'Saved crops of {namefile} to the cache entry {cache_key}')
+            # use the mapped arrays, the ones in memory are freed
+            crops = CropStore(cache.load_arrays(cache_key), crops.id_to_token)
+
+    # the arrays are not copied in tensors, the batches are read from them by crop_batches
+    # (the cast of the attention mask and of the token type ids is done there)
     # all_p_mask = tf.stack([c.p_mask for c in crops], 0)
-
-    # cast `tf.bool`
-    all_attention_mask = tf.cast(all_attention_mask, tf.int32)
-
-    # old stuff, ma meglio non eliminare
-    # all_p_mask = tf.cast(all_p_mask, tf.int32)
-    # all_token_type_ids = tf.cast(all_token_type_ids, tf.int32)
     if evaluate:
-        dataset = [all_input_ids, all_attention_mask, all_token_type_ids]
+        dataset = [crops.input_ids, crops.attention_mask, crops.token_type_ids]
 
     else:
         '''
         all_start_positions = tf.stack([(f.start_position, args.max_seq_length) for f in crops], 0)
         all_end_positions = tf.stack([(f.end_position, args.max_seq_length) for f in crops], 0)
         all_type = tf.stack([(f.long_position) for f in crops])'''
-        all_start_positions = tf.convert_to_tensor([f.start_position for f in crops], dtype=tf.int32)
-        all_end_positions = tf.convert_to_tensor([f.end_position for f in crops], dtype=tf.int32)
-        all_long_positions = tf.convert_to_tensor([f.long_position for f in crops], dtype=tf.int32)
-        dataset = [all_input_ids, all_attention_mask, all_token_type_ids,
-                   all_start_positions, all_end_positions, all_long_positions]
+        dataset = [crops.input_ids, crops.attention_mask, crops.token_type_ids,
+                   crops.start_position, crops.end_position, crops.long_position]
 
     return dataset, crops, entries
 
 
-def getTokenizedDataset(tokenizer, namefile, verbose, max_num_samples):
+def crop_batches(arrays, batch_size, num_rows=None, shuffle_buffer=0, seed=None, repeat=False,
+                 index_name=None, skip_batches=0):
     """
-    La funzione crea input e target per il modello da allenare
-    :param max_num_samples: massimo numero di oggetti da prendere in considerazione (1mil Default)
-    :param model_type: tipo del modello da utilizzare per tokenizzare
-    :param vocab: path del vocabolario del modello
-    :param do_lower_case: flag sfigato
-    :param namefile: path del file da tokenizzare
-    :param verbose: flag per stampare o meno varei informazioni durante le trasformazioni(solo la prima)
-    :return: dizionario degli input x e lista dei target y
+    Crea il tf.data.Dataset dei batch di crops letti direttamente dagli array (anche memory mapped): sono
+    mescolati e raggruppati solo gli indici dei crops, le righe di ogni batch sono copiate dagli array
+    da tf.numpy_function, senza copiare gli array nel grafo come from_tensor_slices
+    :param arrays: dizionario nome -> array [num_crops, ...], convertiti in int32
+    :param batch_size: dimensione dei batch, l'ultimo batch incompleto è scartato
+    :param num_rows: numero di righe del dataset, quelle oltre num_crops sono di zeri (padding), None per num_crops
+    :param shuffle_buffer: dimensione dello shuffle buffer degli indici, 0 per non mescolarli
+    :param seed: seed dello shuffle
+    :param repeat: se True il dataset è ripetuto all'infinito
+    :param index_name: se non None ogni batch contiene anche gli indici delle righe con questo nome
+    :param skip_batches: numero di batch iniziali saltati senza leggerli dagli array (per riprendere il training
+        dal punto di un checkpoint)
+    :return: tf.data.Dataset di dizionari nome -> tensore [batch_size, ...]
+    """
+    names = list(arrays)
+    num_crops = len(arrays[names[0]])
+    if num_rows is None:
+        num_rows = num_crops
+
+    def gather(indexes):
+        valid = indexes < num_crops
+        # sorted indexes read the pages of the arrays in order
+        order = np.argsort(indexes[valid])
+        rows = indexes[valid][order]
+        batch = []
+        for name in names:
+            array = arrays[name]
+            values = np.zeros((len(indexes),) + array.shape[1:], dtype=np.int32)
+            valid_values = np.empty((len(rows),) + array.shape[1:], dtype=np.int32)
+            valid_values[order] = array[rows]
+            values[valid] = valid_values
+            batch.append(values)
+        return batch
+
+    def load(indexes):
+        values = tf.numpy_function(gather, [indexes], [tf.int32] * len(names))
+        batch = {}
+        for name, value in zip(names, values):
+            value.set_shape((batch_size,) + arrays[name].shape[1:])
+            batch[name] = value
+        if index_name is not None:
+            batch[index_name] = tf.cast(indexes, tf.int32)
+        return batch
+
+    dataset = tf.data.Dataset.range(num_rows)
+    if repeat:
+        dataset = dataset.repeat()
+    if shuffle_buffer > 0:
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer, seed=seed)
+    dataset = dataset.batch(batch_size=batch_size, drop_remainder=True)
+    if skip_batches > 0:
+        dataset = dataset.skip(skip_batches)
+    dataset = dataset.map(load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def get_tokenization_args():
+    """
+    Legge dalla linea di comando le opzioni della conversione dei file di training in crops
+    :return: args
     """
     parser = argparse.ArgumentParser()
 
@@ -1557,8 +2474,55 @@ def getTokenizedDataset(tokenizer, namefile, verbose, max_num_samples):
                         default=0.03, help="The fraction of impossible"
                                            " samples to keep.")
     parser.add_argument('--do_enumerate', action='store_true')
+    parser.add_argument('--stream_conversion', action='store_true',
+                        help="Convert the file to crops as a stream, without keeping all the entries in memory")
+    parser.add_argument('--shuffle_buffer', type=int, default=1000,
+                        help="Size of the shuffle buffer of the entries when --stream_conversion is used")
+    parser.add_argument('--num_preprocess_workers', type=int, default=0,
+                        help="If bigger than 0 the file is converted to crops by this number of processes, "
+                             "with random draws seeded by example_id (same crops for any number of processes)")
+    parser.add_argument('--tokenizer_backend', choices=word_tokenization.BACKENDS, default='slow',
+                        help="Tokenizer of the words of the documents, 'fast' uses the tokenizers library "
+                             "(BERT only)")
+    parser.add_argument('--word_cache_dir', type=str, default=None,
+                        help="If given the word pieces of the words of the documents are also cached on disk "
+                             "in this directory, and reused by the next runs")
+    parser.add_argument('--word_cache_size', type=int, default=word_tokenization.CACHE_SIZE,
+                        help="Maximum number of words whose word pieces are kept in memory")
+    parser.add_argument('--char_level_examples', action='store_true',
+                        help="Build the examples splitting the SQuAD contexts character by character "
+                             "(slow path, gives the same crops)")
+    parser.add_argument('--do_cache', action='store_true',
+                        help="Read the crops from the crop cache, or save them there if missing")
+    parser.add_argument('--crop_cache_dir', type=str, default=CROP_CACHE_DIR,
+                        help="Directory of the crop cache, shared by all the files and configurations")
+    parser.add_argument('--crop_cache_size', type=float, default=crop_cache.CACHE_SIZE_GB,
+                        help="Maximum size of the crop cache in GB, the least recently used crops are deleted")
+    parser.add_argument('--document_cache_dir', type=str, default=None,
+                        help="If given the documents are tokenized once and cached in this directory, and every "
+                             "epoch cuts new random crops from them (the crop cache is not used)")
+    parser.add_argument('--document_cache_size', type=float, default=crop_cache.CACHE_SIZE_GB,
+                        help="Maximum size of the document cache in GB")
 
     args, _ = parser.parse_known_args()
+    return args
+
+
+def getTokenizedDataset(tokenizer, namefile, verbose, max_num_samples, args=None, epoch=0):
+    """
+    La funzione crea input e target per il modello da allenare
+    :param max_num_samples: massimo numero di oggetti da prendere in considerazione (1mil Default)
+    :param model_type: tipo del modello da utilizzare per tokenizzare
+    :param vocab: path del vocabolario del modello
+    :param do_lower_case: flag sfigato
+    :param namefile: path del file da tokenizzare
+    :param verbose: flag per stampare o meno varei informazioni durante le trasformazioni(solo la prima)
+    :param args: opzioni della conversione, se None sono lette dalla linea di comando (vedi get_tokenization_args)
+    :param epoch: epoca di training (vedi load_and_cache_crops)
+    :return: dizionario degli array di input e target (vedi crop_batches)
+    """
+    if args is None:
+        args = get_tokenization_args()
     """
     print(model_type)
     _, tokenizer_class = MODEL_CLASSES[model_type]
@@ -1569,7 +2533,7 @@ def getTokenizedDataset(tokenizer, namefile, verbose, max_num_samples):
         # print(f"Added {num_added} tokens")
     """
     eval_dataset, crops, entries = load_and_cache_crops(args, tokenizer, namefile, verbose, False,
-                                                        max_num_samples)
+                                                        max_num_samples, args.do_cache, epoch=epoch)
 
     do = False
     if do:
@@ -1601,22 +2565,13 @@ def getDatasetForEvaluation(args, tokenizer, namefile, verbose, max_num_samples,
     # pad dataset to multiple of `args.eval_batch_size`
     eval_dataset_length = len(eval_dataset[0])
     padded_length = math.ceil(eval_dataset_length / args.eval_batch_size) * args.eval_batch_size
-    num_pad = padded_length - eval_dataset[0].shape[0]
-    for ti, t in enumerate(eval_dataset):
-        pad_tensor = tf.expand_dims(tf.zeros_like(t[0]), 0)
-        pad_tensor = tf.repeat(pad_tensor, num_pad, 0)
-        eval_dataset[ti] = tf.concat([t, pad_tensor], 0)
-
-    # create eval dataset
-    eval_ds = tf.data.Dataset.from_tensor_slices({
-        'input_ids': tf.constant(eval_dataset[0]),
-        'attention_mask': tf.constant(eval_dataset[1]),
-        'token_type_ids': tf.constant(eval_dataset[2]),
-        'example_index': tf.range(padded_length, dtype=tf.int32)
-
-    })
-    eval_ds = eval_ds.batch(batch_size=args.eval_batch_size, drop_remainder=True)
-    # eval_ds = eval_ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+    # create eval dataset, the batches are read from the (memory mapped) arrays
+    eval_ds = crop_batches({
+        'input_ids': eval_dataset[0],
+        'attention_mask': eval_dataset[1],
+        'token_type_ids': eval_dataset[2],
+    }, batch_size=args.eval_batch_size, num_rows=padded_length, index_name='example_index')
     # eval_ds = strategy.experimental_distribute_dataset(eval_ds)
 
     # eval
@@ -1626,6 +2581,36 @@ def getDatasetForEvaluation(args, tokenizer, namefile, verbose, max_num_samples,
     return eval_ds, crops, entries, eval_dataset_length
 
 
+def get_results_cache_path(args, namefile, num_crops):
+    """
+    Restituisce il file della cache dei risultati del modello su namefile: gli unique_id dei crops ripartono
+    da 1000000000 a ogni conversione, quindi la chiave contiene tutto ciò da cui dipendono i crops (contenuto del
+    file, example_ids, parametri dei crops) e i pesi del checkpoint
+    :param args: opzioni della valutazione
+    :param namefile: file valutato
+    :param num_crops: numero dei crops valutati
+    :return: path del file pickle
+    """
+    example_ids = getattr(args, 'example_ids', None)
+    checkpoint = getattr(args, 'checkpoint', None)
+    weights = None
+    if checkpoint:
+        weights_fn = os.path.join(checkpoint, 'weights.h5')
+        weights_fn = weights_fn if os.path.exists(weights_fn) else checkpoint
+        if os.path.exists(weights_fn):
+            # the weights are identified by their path and modification time, hashing them is too slow
+            weights = [os.path.abspath(weights_fn), os.stat(weights_fn).st_mtime_ns]
+    params = dict(eval_method=args.eval_method,
+                  model=getattr(args, 'model', None),
+                  example_ids=sorted(str(e) for e in example_ids) if example_ids else None,
+                  max_seq_length=args.max_seq_length,
+                  doc_stride=args.doc_stride,
+                  max_query_length=args.max_query_length,
+                  num_crops=num_crops,
+                  weights=weights)
+    return '../cache/results_test{}-{}.pkl'.format(args.eval_method, crop_cache.cache_key(namefile, params))
+
+
 def getResult(args, model, eval_ds, crops, entries, eval_dataset_length, do_cache, namefile, app=False):
     csv_fn = '../Results/submission' + args.eval_method + '2.csv'
     padded_length = math.ceil(eval_dataset_length / args.eval_batch_size) * args.eval_batch_size
@@ -1637,8 +2622,8 @@ def getResult(args, model, eval_ds, crops, entries, eval_dataset_length, do_cach
 
     all_results = []
     tic = time.time()
-    cached_results = '../cache/results_test' + args.eval_method + '.pkl'
-    if os.path.exists(cached_results) and do_cache:
+    cached_results = get_results_cache_path(args, namefile, eval_dataset_length) if do_cache else None
+    if do_cache and os.path.exists(cached_results):
         print("Loading results from cached file ", cached_results)
         with open(cached_results, "rb") as f:
             all_results = pickle.load(f)
@@ -1687,7 +2672,8 @@ def getResult(args, model, eval_ds, crops, entries, eval_dataset_length, do_cach
     del crops, all_results
     gc.collect()
     if not app:
-        candidates, question = read_candidates([namefile], do_cache=False)
+        candidates, question = read_candidates([namefile], do_cache=False,
+                                               example_ids=getattr(args, 'example_ids', None) or None)
         sub = convert_preds_to_df(preds, candidates, question, args.true_endToken).sort_values('example_id')
         sub.to_csv(csv_fn, index=False, columns=['example_id', 'PredictionString', 'question', 'answer'])
         print(f'***** Wrote submission to {csv_fn} *****')
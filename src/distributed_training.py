@@ -0,0 +1,149 @@
+"""
+On this file we have the pieces of the data parallel training of mode_tf.py
+with tf.distribute: the strategies, the worker of the process in the cluster
+described by TF_CONFIG, the assignment of the training shards to the workers
+and a launcher of a cluster of local CPU workers, to try the multi worker
+training on a single machine.
+
+Usage: python distributed_training.py --num_workers 2 -- --train_dir ../TrainData/ --batch_size 4
+the options after -- are passed to mode_tf.py, that is run by every worker
+with --strategy multi_worker
+"""
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+
+import tensorflow as tf
+
+STRATEGIES = ('none', 'mirrored', 'multi_worker')
+
+# position of the process in the cluster, the chief (index 0) writes the logs and the checkpoints
+WorkerInfo = collections.namedtuple('WorkerInfo', ['index', 'num_workers', 'is_chief'])
+
+
+def make_strategy(name):
+    """
+    This function builds the distribution strategy of the training. The
+    multi worker strategy reads the cluster from TF_CONFIG, it must be
+    built before any other operation of tensorflow
+
+    @param name one of STRATEGIES: 'none' for the default strategy (a
+        single device), 'mirrored' for all the devices of this machine,
+        'multi_worker' for all the devices of all the workers
+
+    @return the tf.distribute.Strategy
+    """
+    if name == 'none':
+        return tf.distribute.get_strategy()
+    if name == 'mirrored':
+        return tf.distribute.MirroredStrategy()
+    if name == 'multi_worker':
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    raise ValueError("Unknown strategy: {}".format(name))
+
+
+def get_worker_info():
+    """
+    This function reads the worker of this process from TF_CONFIG. The
+    chief is the task of type chief if there is one, the worker 0 otherwise
+
+    @return WorkerInfo, a single chief worker without TF_CONFIG
+    """
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    cluster = tf_config.get('cluster', {})
+    task = tf_config.get('task', {})
+    num_chiefs = len(cluster.get('chief', []))
+    num_workers = num_chiefs + len(cluster.get('worker', []))
+    if num_workers == 0:
+        return WorkerInfo(0, 1, True)
+    if task.get('type') == 'chief':
+        return WorkerInfo(0, num_workers, True)
+    index = num_chiefs + task.get('index', 0)
+    return WorkerInfo(index, num_workers, index == 0)
+
+
+def worker_files(files, worker):
+    """
+    This function assigns the training shards to the workers, round robin.
+    The synchronous training needs the same number of shards on every
+    worker, so the last len(files) % num_workers shards are not used
+
+    @param files list of the shards, in the same order on every worker
+    @param worker WorkerInfo of this process
+
+    @return list of the shards of the worker
+    """
+    num_files = len(files) // worker.num_workers
+    if num_files == 0:
+        raise ValueError("{} shards are not enough for {} workers".format(len(files), worker.num_workers))
+    if num_files * worker.num_workers < len(files):
+        print(f"Skipping the last {len(files) - num_files * worker.num_workers} shards, "
+              f"not enough for all the {worker.num_workers} workers")
+    return files[worker.index::worker.num_workers][:num_files]
+
+
+def common_steps(strategy, num_steps):
+    """
+    This function agrees the number of steps of the current shards among
+    the workers: every step is a collective operation of all the workers,
+    so all of them must do the minimum of their numbers of steps
+
+    @param strategy the multi worker strategy
+    @param num_steps number of steps of the shard of this worker
+
+    @return the minimum number of steps of the workers
+    """
+
+    @tf.function
+    def all_steps():
+        # each replica writes the steps of its worker in its own position, the sum gathers them
+        def replica_steps():
+            replica_id = tf.distribute.get_replica_context().replica_id_in_sync_group
+            return tf.one_hot(replica_id, strategy.num_replicas_in_sync) * float(num_steps)
+
+        per_replica = strategy.experimental_run_v2(replica_steps)
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica, axis=None)
+
+    return int(tf.reduce_min(all_steps()).numpy())
+
+
+def launch_local_workers(num_workers, script_args, script='mode_tf.py', base_port=20000):
+    """
+    This function runs a cluster of num_workers local CPU workers, each one
+    a process of script with its TF_CONFIG, and waits for them
+
+    @param num_workers number of workers
+    @param script_args options of the script, --strategy multi_worker is added
+    @param script the training script
+    @param base_port port of the worker 0, the others use the next ones
+
+    @return list of the exit codes of the workers
+    """
+    cluster = {'worker': ['localhost:{}'.format(base_port + index) for index in range(num_workers)]}
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ,
+                   TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}}),
+                   CUDA_VISIBLE_DEVICES='')
+        processes.append(subprocess.Popen([sys.executable, script] + list(script_args) +
+                                          ['--strategy', 'multi_worker'], env=env))
+    return [process.wait() for process in processes]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the training on a cluster of local CPU workers.')
+
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--script', type=str, default='mode_tf.py')
+    parser.add_argument('--base_port', type=int, default=20000,
+                        help='Port of the first worker, the others use the next ones')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                        help='Options of the training script, after --')
+
+    args = parser.parse_args()
+    script_args = args.script_args[1:] if args.script_args[:1] == ['--'] else args.script_args
+    exit_codes = launch_local_workers(args.num_workers, script_args, script=args.script, base_port=args.base_port)
+    sys.exit(next((code for code in exit_codes if code != 0), 0))
@@ -4,17 +4,135 @@ in particular we build a data generator in order to
 load the json one peace at time in order to be able to
 compute the training even without more than 16 GB of RAM available
 """
+import collections
+import concurrent.futures
 import os
 import numpy as np
 import tensorflow as tf
 import dataset_utils
+import preprocess_crops
+import shard_utils
+
+
+# a shard loaded by ShardSampler, batches are the indexes of its batches not drawn yet
+Shard = collections.namedtuple('Shard', ['name', 'inputs', 'targets', 'batches'])
+
+
+class ShardSampler:
+    '''
+    Endless stream of batches drawn from num_active shards at a time.
+    Every batch comes from one of the active shards, chosen at random with
+    probability proportional to the batches it has left, and every batch of
+    a shard is drawn once. When a shard is exhausted its place is taken by
+    the next file, which is loaded in a background thread while the active
+    shards are used, so at most num_active + 1 shards are in memory.
+    The files are used in the given order the first time, then in a new
+    random order at every pass
+    '''
+
+    def __init__(self, files, load_file, batch_size, num_active=2, seed=0, first_pass=None):
+        '''
+        @param files names of all the files
+        @param load_file function name -> (dictionary of the inputs, list
+            of the targets)
+        @param batch_size size of the batches
+        @param num_active number of shards the batches are drawn from
+        @param seed seed of the orders of the files and of the batches
+        @param first_pass names of the files of the first pass, None for
+            all the files
+        '''
+        self.files = list(files)
+        self.load_file = load_file
+        self.batch_size = batch_size
+        self.num_active = num_active
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        self.order = collections.deque(self.files if first_pass is None else first_pass)
+        self.num_loaded = 0
+        self.active = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.loading = None
+
+    def _load(self, name, seed):
+        x, y = self.load_file(name)
+        num_batches = len(x['attention_mask']) // self.batch_size
+        # the batches of the shard in random order, drawn from the end
+        batches = list(np.random.RandomState(seed).permutation(num_batches))
+        return Shard(name, x, y, batches)
+
+    def _start_loading(self):
+        if not self.order:
+            self.order.extend(self.files[i] for i in self.rng.permutation(len(self.files)))
+        self.loading = self.executor.submit(self._load, self.order.popleft(), self.seed + self.num_loaded)
+        self.num_loaded += 1
+
+    def _fill(self):
+        num_empty = 0
+        while len(self.active) < self.num_active:
+            if self.loading is None:
+                self._start_loading()
+            shard = self.loading.result()
+            # the next file is loaded while the active ones are used
+            self._start_loading()
+            if not shard.batches:
+                num_empty += 1
+                if num_empty > len(self.files):
+                    raise ValueError('No file has a complete batch of {} crops'.format(self.batch_size))
+                continue
+            print('New file: ' + shard.name)
+            self.active.append(shard)
+
+    def next_batch(self):
+        '''
+        @return (dictionary of the inputs, list of the targets) of the next
+            batch
+        '''
+        self._fill()
+        remaining = np.array(self.active_batches(), dtype=np.float64)
+        shard_index = self.rng.choice(len(self.active), p=remaining / remaining.sum())
+        shard = self.active[shard_index]
+        index = shard.batches.pop()
+        if not shard.batches:
+            del self.active[shard_index]
+        return ({k: rows(v, index, self.batch_size) for k, v in shard.inputs.items()},
+                [rows(v, index, self.batch_size) for v in shard.targets])
+
+    def active_batches(self):
+        '''
+        @return the number of batches left of each active shard
+        '''
+        self._fill()
+        return [len(shard.batches) for shard in self.active]
+
+    def sample_inputs(self):
+        '''
+        @return the inputs of a batch, without drawing it
+        '''
+        self._fill()
+        shard = self.active[0]
+        return {k: rows(v, shard.batches[-1], self.batch_size) for k, v in shard.inputs.items()}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def rows(values, index, batch_size):
+    '''
+    @return the rows of a batch of an input or target array
+    '''
+    values = values[batch_size * index:batch_size * (index + 1)]
+    if isinstance(values, np.ndarray):
+        # the preprocessed crops keep masks and segment ids in smaller types
+        values = values.astype(np.int32)
+    return values
 
 
 class DataGenerator(tf.keras.utils.Sequence):
     'Generates data for Keras'
 
     def __init__(self, directory_path, namemodel, vocab, verbose, batch_size=4,
-                 max_num_samples=1_000_000_000, validation=False, batch_start=None):
+                 max_num_samples=1_000_000_000, validation=False, batch_start=None, crops_dir=None,
+                 num_active_shards=2, steps_per_epoch=None, seed=0):
         'Initialization'
         '''
         Load the files and create the question answer tuple
@@ -26,18 +144,30 @@ class DataGenerator(tf.keras.utils.Sequence):
         @param vocab the vocabulary
         @param max_num_samples integer for the maximum number of samples
         @param batch_start integer, used if we start from a checkpoint we will use the file from this index 
+        @param crops_dir directory of the crops written by preprocess_crops.py (npy format), if given
+            its shards are loaded instead of converting the files of directory_path
+        @param num_active_shards number of files the training batches are drawn from at the same time
+            (see ShardSampler)
+        @param steps_per_epoch number of training batches of an epoch, None for the batches of all the
+            files (estimated from the first file if the files are not preprocessed)
+        @param seed seed of the order of the training files and batches
         '''
         self.validation = validation
-        self.Allfiles = os.listdir(directory_path)  # list of all the files from the directory
-        self.Allfiles = sorted(self.Allfiles, key=lambda file1: int(file1[:-6]))
+        self.crops_dir = crops_dir
+        if crops_dir is not None:
+            # the ids of the crops must be the ones of the vocabulary of the model
+            preprocess_crops.check_crops_manifest(preprocess_crops.read_crops_manifest(crops_dir), namemodel)
+            # list of all the preprocessed shards
+            self.Allfiles = [os.path.basename(p) for p in preprocess_crops.crop_shard_paths(crops_dir)]
+            directory_path = crops_dir
+        else:
+            self.Allfiles = shard_utils.list_shards(directory_path)  # list of all the shards from the directory
         self.files = self.Allfiles.copy()
         print("\n\nthe file we will use for generator are: {}\n\n".format(self.files))
 
         if batch_start:
             self.files = self.files[:-batch_start]
 
-        self.namefile = self.files.pop()
-        print(self.namefile)
         self.path = directory_path
         self.batch_size = batch_size
         self.namemodel = namemodel
@@ -45,31 +175,67 @@ class DataGenerator(tf.keras.utils.Sequence):
         self.verbose = verbose
         self.max_num_samples = max_num_samples
         self.current_file_index = 0
-        # loading the first file from the directory which will be used for
-        # the first training cycle
-        self.max = 0
-
-        self.input, self.output = dataset_utils.getTokenizedDataset(self.namemodel,
-                                                                    self.vocab,
-                                                                    'uncased',
-                                                                    os.path.join(self.path, self.namefile),
-                                                                    self.verbose,
-                                                                    self.max_num_samples)
-        self.number_indexes = int(np.floor(len(self.input['attention_mask']) / self.batch_size))
+
+        if validation:
+            # the validation uses always the same file
+            self.namefile = self.files.pop()
+            print(self.namefile)
+            self.input, self.output = self.load_file(self.namefile)
+            self.number_indexes = int(np.floor(len(self.input['attention_mask']) / self.batch_size))
+            self.steps_per_epoch = self.number_indexes
+            self.sampler = None
+        else:
+            # the remaining files first, in the order they were popped
+            self.sampler = ShardSampler(self.Allfiles, self.load_file, batch_size, num_active=num_active_shards,
+                                        seed=seed, first_pass=self.files[::-1])
+            if steps_per_epoch is None:
+                steps_per_epoch = self.pass_steps()
+            self.steps_per_epoch = steps_per_epoch
+
+    def pass_steps(self):
+        '''
+        @return number of training batches of all the files, from the manifest of the preprocessed crops
+            or estimated from the first file
+        '''
+        if self.crops_dir is not None:
+            manifest = preprocess_crops.read_crops_manifest(self.crops_dir)
+            return sum(s['num_crops'] // self.batch_size for s in manifest['shards'])
+        steps = self.sampler.active_batches()[0] * len(self.Allfiles)
+        print("Estimated {} batches for the {} files".format(steps, len(self.Allfiles)))
+        return steps
+
+    def load_file(self, namefile):
+        '''
+        Load the inputs and the targets of a file
+
+        @param namefile name of the file in the directory
+
+        @return dictionary of the inputs, list of the targets
+        '''
+        if self.crops_dir is not None:
+            # memory mapped, only the rows of the batches are read
+            arrays = preprocess_crops.load_crop_shard(os.path.join(self.path, namefile))
+            x = {k: arrays[k] for k in ('input_ids', 'attention_mask', 'token_type_ids')}
+            y = [arrays['start'], arrays['end'], arrays['long']]
+            return x, y
+        return dataset_utils.getTokenizedDataset(self.namemodel,
+                                                 self.vocab,
+                                                 'uncased',
+                                                 os.path.join(self.path, namefile),
+                                                 self.verbose,
+                                                 self.max_num_samples)
 
     def num_files(self):
         return len(self.Allfiles)
 
     def __len__(self):
         'Denotes the number of batches per epoch'
-        ret = int(np.floor(len(self.input['attention_mask']) / self.batch_size))
-        print("Epoch number {} we have {} files".format(self.current_file_index, ret))
-        self.max = max(self.max, ret)
-        print("the maximum number of file until now is {}".format(self.max))
-        return 4800 // self.batch_size
+        return self.steps_per_epoch
 
     def get_sample_data(self):
-        x = {k: v[self.batch_size * 0:self.batch_size * (0 + 1)] for k, v in self.input.items()}
+        if self.sampler is not None:
+            return self.sampler.sample_inputs()
+        x = {k: rows(v, 0, self.batch_size) for k, v in self.input.items()}
 
         return x
 
@@ -87,11 +253,13 @@ class DataGenerator(tf.keras.utils.Sequence):
             'end':
             'type':
         }
+        the training batches are drawn from the sampler, whatever the index
         '''
-        index = index % self.number_indexes
-
-        x = {k: v[self.batch_size * index:self.batch_size * (index + 1)] for k, v in self.input.items()}
-        y = [v[self.batch_size * index:self.batch_size * (index + 1)] for v in self.output]
+        if self.sampler is not None:
+            x, y = self.sampler.next_batch()
+        else:
+            x = {k: rows(v, index, self.batch_size) for k, v in self.input.items()}
+            y = [rows(v, index, self.batch_size) for v in self.output]
         dictionary = True
         if dictionary:
             names = {0: "start", 1: "end",2: "long"}
@@ -101,21 +269,5 @@ class DataGenerator(tf.keras.utils.Sequence):
         return x, y
 
     def on_epoch_end(self):
-
-        # change the current file and add it to the done list
+        # the sampler continues from where it is, without repeating batches
         self.current_file_index += 1
-
-        self.number_indexes = int(np.floor(len(self.input['attention_mask']) / self.batch_size))
-
-        if not self.validation:
-            if not self.files:
-                self.files = self.Allfiles
-            self.namefile = self.files.pop()
-            print("New file: " + self.namefile)
-            # update the input and output tensors for this epoch 
-            self.input, self.output = dataset_utils.getTokenizedDataset(self.namemodel,
-                                                                        self.vocab,
-                                                                        'uncased',
-                                                                        os.path.join(self.path, self.namefile),
-                                                                        self.verbose,
-                                                                        self.max_num_samples)
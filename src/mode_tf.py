@@ -4,19 +4,23 @@ from __future__ import print_function
 
 import argparse
 import os
-import re
 from datetime import datetime
 import tensorflow as tf
 from transformers import BertConfig, BertTokenizer, AlbertTokenizer, AlbertConfig, AutoTokenizer
 from model_stuff.TFAlbertForNaturalQuestionAnswering import TFAlbertForNaturalQuestionAnswering
 from model_stuff.TFBertForNaturalQuestionAnswering import TFBertForNaturalQuestionAnswering
 import dataset_utils_version2 as dataset_utils
+import checkpointing
+import crop_records
+import distributed_training
+import preprocess_crops
+import shard_prefetch
+import shard_utils
 from tqdm import tqdm
 
 tqdm.monitor_interval = 0  #
-import glob
 import logging
-from shutil import rmtree, copy
+from shutil import copy
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +49,204 @@ def partial_accuracy(true_value, logits):
     return num / den
 
 
+# metrics of a training step, in the order returned by the step
+METRIC_NAMES = ('loss', 'acc_1', 'acc_2', 'acc_3', 'delta')
+
+
+class TrainingMetrics:
+    """
+    Metrics of the training steps accumulated in variables, updated by the
+    steps themselves, so that a step never waits for the host to read its
+    metrics. Every log_every steps the host calls write, which reads the
+    means of the steps since the previous call and writes them with a
+    single persistent summary writer
+    """
+
+    def __init__(self, writer, smooth=0.99):
+        """
+        @param writer the summary writer
+        @param smooth factor of the running averages shown by the progress bar
+        """
+        self.writer = writer
+        self.smooth = smooth
+        self.sums = tf.Variable(tf.zeros([len(METRIC_NAMES)]), trainable=False, name='metric_sums')
+        self.count = tf.Variable(0., trainable=False, name='metric_count')
+        self.running = tf.Variable(tf.zeros([len(METRIC_NAMES)]), trainable=False, name='metric_running')
+
+    def update(self, values):
+        """
+        This function adds the metrics of a step, it is called inside the
+        training step
+
+        @param values scalar tensors, in the order of METRIC_NAMES
+        """
+        values = tf.cast(tf.stack(values), tf.float32)
+        self.sums.assign_add(values)
+        self.count.assign_add(1.)
+        self.running.assign(self.smooth * self.running + (1. - self.smooth) * values)
+
+    def write(self, step):
+        """
+        This function writes the means of the metrics since the previous
+        call and resets them
+
+        @param step the global step of the summaries
+
+        @return dictionary name -> running average
+        """
+        count = float(self.count.numpy())
+        if count > 0:
+            means = self.sums.numpy() / count
+            with self.writer.as_default():
+                for name, value in zip(METRIC_NAMES, means):
+                    tf.summary.scalar(name, value, step=step)
+            self.writer.flush()
+            self.sums.assign(tf.zeros_like(self.sums))
+            self.count.assign(0.)
+        return dict(zip(METRIC_NAMES, self.running.numpy().tolist()))
+
+
+class GradientAccumulator(tf.Module):
+    """
+    Gradients of the micro batches summed by the training steps and
+    applied every num_steps steps (see make_train_step). It is a module so
+    that the gradients of an update in progress are saved in the checkpoints
+    """
+
+    def __init__(self, variables, num_steps):
+        """
+        @param variables the trainable variables of the model, built in the
+            scope of the distribution strategy
+        @param num_steps number of micro batches of every update
+        """
+        super(GradientAccumulator, self).__init__(name='gradient_accumulator')
+        self.num_steps = num_steps
+        # as big as the weights, each replica has its own ones
+        self.gradients = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype), trainable=False,
+                                      synchronization=tf.VariableSynchronization.ON_READ,
+                                      aggregation=tf.VariableAggregation.SUM, name='accumulated_gradient')
+                          for v in variables]
+        self.count = tf.Variable(0, trainable=False, dtype=tf.int32, name='num_accumulated')
+
+
+def make_train_step(mymodel, optimizer, metrics=None, accumulator=None, strategy=None):
+    """
+    This function builds the training step of a model.
+    With an accumulator a step only adds the gradients of its batch (a
+    micro batch) to it, and the optimizer applies them every
+    accumulator.num_steps steps: the loss of a micro batch is divided by
+    num_steps, so the applied gradients are the ones of the mean loss of
+    the num_steps * batch_size crops.
+    With a distribution strategy every replica computes the gradients of
+    its batch, the optimizer sums them over the replicas (so the losses are
+    divided also by the number of replicas) and the metrics of the step are
+    the means over the replicas
+
+    @param mymodel the model, already built (in the scope of the strategy)
+    @param optimizer the optimizer
+    @param metrics TrainingMetrics updated by every step, None not to
+        accumulate the metrics
+    @param accumulator GradientAccumulator of the steps, None to apply the
+        gradients at every step
+    @param strategy the tf.distribute.Strategy, None for the current one
+
+    @return tf.function batch -> (loss, acc_1, acc_2, acc_3, delta), with
+        the loss of the batch (not divided); with a strategy the batch is an
+        element of a distributed dataset
+    """
+    if strategy is None:
+        strategy = tf.distribute.get_strategy()
+    grad_accum_steps = 1 if accumulator is None else accumulator.num_steps
+    # the gradients of the replicas are summed
+    loss_scale = grad_accum_steps * strategy.num_replicas_in_sync
+    # indices of the variables with a gradient, set when the step is traced
+    used = []
+
+    def replica_step(batch):
+        with tf.GradientTape() as tape:
+            outputs = mymodel(batch, training=True)
+
+            start_loss = tf.keras.losses.sparse_categorical_crossentropy(batch["start"], outputs["start"],
+                                                                         from_logits=True)
+            end_loss = tf.keras.losses.sparse_categorical_crossentropy(batch["end"], outputs["end"], from_logits=True)
+            long_loss = tf.keras.losses.sparse_categorical_crossentropy(batch["long"], outputs["long"],
+                                                                        from_logits=True)
+
+            acc_1 = partial_accuracy(batch["start"], outputs[
+                "start"])  # tf.keras.metrics.sparse_categorical_accuracy(batch["start"], outputs["start"])
+            acc_2 = partial_accuracy(batch["end"], outputs[
+                "end"])  # tf.keras.metrics.sparse_categorical_accuracy(batch["end"], outputs["end"])
+            acc_3 = partial_accuracy(batch["long"], outputs[
+                "long"])  # tf.keras.metrics.sparse_categorical_accuracy(batch["long"], outputs["long"])
+
+            variance = tf.math.reduce_max(outputs["start"]) - tf.math.reduce_min(outputs["start"])
+            loss = ((tf.reduce_mean(start_loss) + tf.reduce_mean(end_loss)) / 2.0 +
+                    tf.reduce_mean(long_loss)) / 2.0
+            scaled_loss = loss / loss_scale
+
+        grads = tape.gradient(scaled_loss, mymodel.trainable_variables)
+        if accumulator is not None:
+            # the variables without gradient are not updated, as by apply_gradients
+            used[:] = [index for index, grad in enumerate(grads) if grad is not None]
+            for index in used:
+                # the sparse gradients of the embeddings are made dense
+                accumulator.gradients[index].assign_add(tf.convert_to_tensor(grads[index]))
+        else:
+            optimizer.apply_gradients(zip(grads, mymodel.trainable_variables))
+        return (loss, tf.reduce_mean(acc_1), tf.reduce_mean(acc_2), tf.reduce_mean(acc_3),
+                tf.reduce_mean(variance))
+
+    def replica_apply():
+        optimizer.apply_gradients([(accumulator.gradients[index].read_value(), mymodel.trainable_variables[index])
+                                   for index in used])
+        for index in used:
+            accumulator.gradients[index].assign(tf.zeros_like(accumulator.gradients[index]))
+
+    # Follows a reimplementation of the training (substituting keras)
+    @tf.function
+    def train_step(batch):
+        per_replica_metrics = strategy.experimental_run_v2(replica_step, args=(batch,))
+        step_metrics = tuple(strategy.reduce(tf.distribute.ReduceOp.MEAN, value, axis=None)
+                             for value in per_replica_metrics)
+        if accumulator is not None:
+            accumulator.count.assign_add(1)
+            if accumulator.count >= grad_accum_steps:
+                strategy.experimental_run_v2(replica_apply)
+                accumulator.count.assign(0)
+        if metrics is not None:
+            metrics.update(step_metrics)
+        return step_metrics
+
+    return train_step
+
+
+def make_multi_step(train_step, steps_per_call):
+    """
+    This function builds a tf.function that does steps_per_call training
+    steps in a tf.while_loop, taking the batches from an iterator, so that
+    python dispatches a single call for all of them
+
+    @param train_step the training step (see make_train_step)
+    @param steps_per_call number of steps of each call
+
+    @return tf.function iterator -> tensor [steps_per_call, len(METRIC_NAMES)]
+        with the metrics of each step
+    """
+
+    @tf.function
+    def multi_step(iterator):
+        def body(step, step_metrics):
+            values = train_step(next(iterator))
+            return step + 1, step_metrics.write(step, tf.cast(tf.stack(values), tf.float32))
+
+        _, step_metrics = tf.while_loop(lambda step, _: step < steps_per_call, body,
+                                        (tf.constant(0), tf.TensorArray(tf.float32, size=steps_per_call)),
+                                        parallel_iterations=1)
+        return step_metrics.stack()
+
+    return multi_step
+
+
 def main(namemodel,
          batch_size,
          train_dir,
@@ -54,12 +256,19 @@ def main(namemodel,
          log_dir="log/",
          learning_rate=0.005,
          starting_epoch=0,
-         checkpoint_interval=1000):
+         checkpoint_interval=1000,
+         train_crops=None,
+         prefetch_shards=0,
+         log_every=100,
+         steps_per_call=1,
+         grad_accum_steps=1,
+         strategy='none'):
     """
 
     :param learning_rate:
     :param log_dir:
-    :param checkpoint:
+    :param checkpoint: directory del checkpoint da cui riprendere esattamente il training (se vuoto l'ultimo di
+        checkpoint_dir), oppure un vecchio file con i soli pesi (si riparte dal file starting_epoch)
     :param epoch:
     :param train_dir:
     :param checkpoint_dir:
@@ -67,12 +276,33 @@ def main(namemodel,
     :param batch_size: dimensione del batch durante il training
     :param verbose: fag per stampare informazioni sul primo elemento del dataset
     :param max_num_samples: massimo numero di oggetti da prendere in considerazione (1mil Default)
+    :param train_crops: se non None directory dei crops già convertiti da preprocess_crops.py, usati invece di
+        convertire i file di train_dir (i TFRecord sono letti come un unico stream)
+    :param prefetch_shards: se > 0 i file di train_dir sono convertiti da altrettanti processi in anticipo
+        rispetto al training (vedi shard_prefetch), altrimenti ognuno è convertito quando serve
+    :param log_every: ogni quanti step le medie delle metriche sono scritte per tensorboard e mostrate
+    :param steps_per_call: numero di step fatti da ogni chiamata della tf.function di training (vedi make_multi_step)
+    :param grad_accum_steps: numero di batch i cui gradienti sono accumulati prima di applicarli (vedi make_train_step),
+        gli step, i log e i checkpoint contano i batch
+    :param strategy: una di distributed_training.STRATEGIES, con 'multi_worker' il cluster è letto da TF_CONFIG e
+        ogni worker allena i suoi file di train_dir; batch_size è il batch di ogni replica, solo il chief scrive log
+        e checkpoint
     :return: TUTTO
 
     """
+    # the multi worker strategy must be built before any other operation
+    distribution = distributed_training.make_strategy(strategy)
+    worker = distributed_training.get_worker_info()
+    # replicas fed by the input pipeline of this worker
+    local_replicas = distribution.num_replicas_in_sync // worker.num_workers
+    global_batch_size = batch_size * distribution.num_replicas_in_sync
+    if strategy != 'none':
+        print(f"Worker {worker.index} of {worker.num_workers}, {distribution.num_replicas_in_sync} replicas, "
+              f"global batch size {global_batch_size}")
+
     logs = os.path.join(log_dir, datetime.now().strftime("%Y%m%d-%H%M%S"))  # Linux
     # logs = "logs\\" + datetime.now().strftime("%Y%m%d-%H%M%S")  # Windows
-    if not os.path.exists(logs):
+    if worker.is_chief and not os.path.exists(logs):
         os.makedirs(logs)
 
     MODEL_CLASSES = {
@@ -107,145 +337,198 @@ def main(namemodel,
                                                 do_lower_case=do_lower_case)
 
     print(model_class)
-    start_file = 0
-    if checkpoint != "":
-        config = config_class.from_json_file(model_config)
-        mymodel = model_class(config)
-
-        # we do this in order to compile the model, otherwise it will not be able to load the weights
-        # mymodel(traingenerator.get_sample_data())
-
-        mymodel(mymodel.dummy_inputs)
-        if starting_epoch == 0:
-            start_file = os.path.split(checkpoint)[-1]
-            start_file = re.sub('weights.', '', start_file)
-            start_file = int(start_file.split("-")[0])
-            start_file = start_file
-        else:
+    if checkpoint == "":
+        # a restarted training resumes from its last checkpoint
+        checkpoint = checkpointing.latest_checkpoint(checkpoint_dir) or ""
+    resume = checkpointing.is_training_checkpoint(checkpoint)
+    # position of the first step: epoch, file, batch in the file
+    start_epoch, start_file, start_batch = 0, 0, 0
+    # the variables of the model, of the optimizer and of the metrics are mirrored on the replicas
+    with distribution.scope():
+        if checkpoint != "" and not resume:
+            # an old checkpoint with the weights only
+            config = config_class.from_json_file(model_config)
+            mymodel = model_class(config)
+
+            # we do this in order to compile the model, otherwise it will not be able to load the weights
+            # mymodel(traingenerator.get_sample_data())
+
+            mymodel(mymodel.dummy_inputs)
             start_file = starting_epoch
 
-        mymodel.load_weights(checkpoint, by_name=True)
-        print("checkpoint loaded succefully")
-    else:
-        initial_epoch = 0
-        config = config_class.from_pretrained(pretrained)
-        mymodel = model_class.from_pretrained(pretrained, config=config)
-
-    if namemodel == 'bert':
-        tags = dataset_utils.get_add_tokens(do_enumerate=True)
-        num_added = tokenizer.add_tokens(tags)
-        print(f"Added {num_added} tokens")
-        # mymodel.resize_token_embeddings(len(
-        #     tokenizer))  # Notice: resize_token_embeddings expect to receive the full size of the new vocabulary, i.e. the length of the tokenizer.
-
-    # adam = tfa.optimizers.AdamW(lr=learning_rate, weight_decay=0.01, epsilon=1e-6)
-    adam = tf.optimizers.Adam(lr=learning_rate)
-
-    # Follows a reimplementation of the training (substituting keras)
-    @tf.function
-    def train_step(batch):
-        with tf.GradientTape() as tape:
-            outputs = mymodel(batch, training=True)
-
-            start_loss = tf.keras.losses.sparse_categorical_crossentropy(batch["start"], outputs["start"],
-                                                                         from_logits=True)
-            end_loss = tf.keras.losses.sparse_categorical_crossentropy(batch["end"], outputs["end"], from_logits=True)
-            long_loss = tf.keras.losses.sparse_categorical_crossentropy(batch["long"], outputs["long"],
-                                                                        from_logits=True)
-
-            acc_1 = partial_accuracy(batch["start"], outputs[
-                "start"])  # tf.keras.metrics.sparse_categorical_accuracy(batch["start"], outputs["start"])
-            acc_2 = partial_accuracy(batch["end"], outputs[
-                "end"])  # tf.keras.metrics.sparse_categorical_accuracy(batch["end"], outputs["end"])
-            acc_3 = partial_accuracy(batch["long"], outputs[
-                "long"])  # tf.keras.metrics.sparse_categorical_accuracy(batch["long"], outputs["long"])
-
-            variance = tf.math.reduce_max(outputs["start"]) - tf.math.reduce_min(outputs["start"])
-            loss = ((tf.reduce_mean(start_loss) + tf.reduce_mean(end_loss)) / 2.0 +
-                    tf.reduce_mean(long_loss)) / 2.0
-
-        grads = tape.gradient(loss, mymodel.trainable_variables)
-        adam.apply_gradients(zip(grads, mymodel.trainable_variables))
-        return loss, tf.reduce_mean(acc_1), tf.reduce_mean(acc_2), tf.reduce_mean(acc_3), tf.reduce_mean(variance)
-
-    all_files = os.listdir(train_dir)  # list of all the files from the directory
-    all_files = sorted(all_files, key=lambda file1: int(file1[:-6]))
-    allfFile_copy = all_files.copy()
-
-    if start_file > 0:
-        print("since we loaded drom a checkpoints we had this files: ", all_files, start_file)
-        all_files = all_files[start_file:]
-        print("since we loaded drom a checkpoints we have this files: ", all_files, start_file)
-
-    global_step = 1
-    num_samples = 0
-    smooth = 0.99
-    smooth_acc = 0.99
-    running_loss = 0.0
-    running_accuracy_1 = 0.0
-    running_accuracy_2 = 0.0
-    running_accuracy_3 = 0.0
-    for j in range(epoch):
-        for i, file in enumerate(all_files):
-            # load file 
-            train_dataset = dataset_utils.getTokenizedDataset(tokenizer,
-                                                              os.path.join(train_dir, file),
-                                                              verbose,
-                                                              max_num_samples)
-
-            # how many epochs iterations we do in this file
-            num_steps_per_epoch = len(train_dataset['input_ids']) // batch_size
-
-            opt = tf.data.Options()
-            opt.experimental_deterministic = True
-            # use tf.Data in order to create an efficent pipeLine
-            train_ds = tf.data.Dataset.from_tensor_slices(train_dataset).with_options(opt)
-            train_ds = train_ds.repeat()
-            train_ds = train_ds.shuffle(buffer_size=100, seed=12)
-            train_ds = train_ds.batch(batch_size=batch_size, drop_remainder=True)
-            train_ds = iter(train_ds)
-
-            epoch_iterator = tqdm(range(num_steps_per_epoch))
-            for step in epoch_iterator:
-                batch = next(train_ds)
-                # Create writer
-                writer = tf.summary.create_file_writer(logs)
-
-                loss, accuracy_1, accuracy_2, accuracy_3, variance = train_step(batch)
-                # print('===================================')
-                # print(tf.reshape(loss, []).numpy())
-                with writer.as_default():
-                    tf.summary.scalar('loss', loss, step=global_step)
-                    tf.summary.scalar('acc_1', accuracy_1, step=global_step)
-                    tf.summary.scalar('acc_2', accuracy_2, step=global_step)
-                    tf.summary.scalar('acc_3', accuracy_3, step=global_step)
-                    tf.summary.scalar('delta', variance, step=global_step)
-
-                global_step += 1
-                num_samples += batch_size
-                running_loss = smooth * running_loss + (1. - smooth) * float(loss)
-                running_accuracy_1 = smooth_acc * running_accuracy_1 + (1. - smooth_acc) * float(accuracy_1)
-                running_accuracy_2 = smooth_acc * running_accuracy_1 + (1. - smooth_acc) * float(accuracy_2)
-                running_accuracy_3 = smooth_acc * running_accuracy_1 + (1. - smooth_acc) * float(accuracy_3)
-
-                if global_step % checkpoint_interval == 0:
-                    # Save model checkpoint
-                    step_str = '%06d' % global_step
-                    ckpt_dir = os.path.join(checkpoint_dir, 'checkpoint-{}'.format(step_str))
-                    os.makedirs(ckpt_dir, exist_ok=True)
-                    weights_fn = os.path.join(ckpt_dir, 'weights.h5')
-                    mymodel.save_weights(weights_fn)
-                    tokenizer.save_pretrained(ckpt_dir)
-
-                    # remove too many checkpoints
-                    checkpoint_fns = sorted(glob.glob(os.path.join(checkpoint_dir, 'checkpoint-*')))
-                    for fn in checkpoint_fns[:-2]:
-                        rmtree(fn)
-
-                epoch_iterator.set_postfix({'file': '%d/%d' % (i, len(all_files)),
-                                            'samples': num_samples, 'global_loss': round(running_loss, 4),
-                                            "Accuracy": "%.2f:%.2f:%.2f" % (
-                                                running_accuracy_1, running_accuracy_2, running_accuracy_3)})
+            mymodel.load_weights(checkpoint, by_name=True)
+            print("checkpoint loaded succefully")
+        else:
+            initial_epoch = 0
+            config = config_class.from_pretrained(pretrained)
+            mymodel = model_class.from_pretrained(pretrained, config=config)
+
+        if namemodel == 'bert':
+            tags = dataset_utils.get_add_tokens(do_enumerate=True)
+            num_added = tokenizer.add_tokens(tags)
+            print(f"Added {num_added} tokens")
+            # mymodel.resize_token_embeddings(len(
+            #     tokenizer))  # Notice: resize_token_embeddings expect to receive the full size of the new vocabulary, i.e. the length of the tokenizer.
+
+        # adam = tfa.optimizers.AdamW(lr=learning_rate, weight_decay=0.01, epsilon=1e-6)
+        adam = tf.optimizers.Adam(lr=learning_rate)
+
+        # the metrics are accumulated by the steps and written every log_every steps
+        # only the chief writes the summaries
+        writer = tf.summary.create_file_writer(logs) if worker.is_chief else tf.summary.create_noop_writer()
+        metrics = TrainingMetrics(writer)
+        accumulator = None
+        if grad_accum_steps > 1:
+            print(f"Applying the gradients every {grad_accum_steps} steps, {grad_accum_steps * global_batch_size} crops")
+            accumulator = GradientAccumulator(mymodel.trainable_variables, grad_accum_steps)
+        train_step = make_train_step(mymodel, adam, metrics, accumulator=accumulator, strategy=distribution)
+    multi_step = make_multi_step(train_step, steps_per_call)
+
+    # position of the next step, saved in the checkpoints with the whole state of the training
+    position = {name: tf.Variable(0, dtype=tf.int64, trainable=False, name=name)
+                for name in ('global_step', 'epoch', 'file', 'batch')}
+    trackables = dict(model=mymodel, optimizer=adam, metric_sums=metrics.sums, metric_count=metrics.count,
+                      metric_running=metrics.running, **position)
+    if accumulator is not None:
+        trackables['gradient_accumulator'] = accumulator
+    checkpointer = checkpointing.AsyncCheckpointer(checkpoint_dir, **trackables)
+    # the prefetcher and the checkpointer are closed also if the training stops with an error
+    shard_prefetcher = None
+    try:
+        global_step = 1
+        if resume:
+            checkpointer.restore(checkpoint)
+            global_step, start_epoch, start_file, start_batch = (int(position[name].numpy()) for name in position)
+            print(f"Resuming from {checkpoint}: step {global_step}, epoch {start_epoch}, file {start_file}, "
+                  f"batch {start_batch}")
+
+        def write_checkpoint_files(directory):
+            # the weights for model_evaluation.py and the tokenizer
+            mymodel.save_weights(os.path.join(directory, 'weights.h5'))
+            tokenizer.save_pretrained(directory)
+
+        all_files = shard_utils.list_shards(train_dir)  # list of all the shards from the directory
+        crops_manifest = None
+        if train_crops is not None:
+            crops_manifest = preprocess_crops.read_crops_manifest(train_crops)
+            # the ids of the crops must be the ones of the tokenizer of the model
+            preprocess_crops.check_crops_manifest(crops_manifest, namemodel, tokenizer)
+            if not crops_manifest['complete']:
+                print(f"{train_crops} has only {crops_manifest['num_shards']} preprocessed shards")
+            all_files = preprocess_crops.crop_shard_paths(train_crops)
+        if worker.num_workers > 1:
+            all_files = distributed_training.worker_files(all_files, worker)
+        if crops_manifest is not None and crops_manifest['format'] == 'tfrecord':
+            # all the shards are read from their records as a single stream
+            stream_crops = sum(s['num_crops'] for s in crops_manifest['shards']
+                               if os.path.join(train_crops, s['file']) in all_files)
+            all_files = [all_files]
+        allfFile_copy = all_files.copy()
+
+        if crops_manifest is None and prefetch_shards > 0:
+            # the next files are converted while the current one is trained
+            shard_prefetcher = shard_prefetch.ShardPrefetcher(
+                tokenizer, [(os.path.join(train_dir, file), j) for j in range(start_epoch, epoch)
+                            for i, file in enumerate(all_files) if (j, i) >= (start_epoch, start_file)],
+                depth=prefetch_shards, max_num_samples=max_num_samples, verbose=verbose)
+            prefetched_shards = iter(shard_prefetcher)
+
+        num_samples = (global_step - 1) * global_batch_size
+        for j in range(start_epoch, epoch):
+            for i, file in enumerate(all_files):
+                if (j, i) < (start_epoch, start_file):
+                    continue
+                # the steps of the file already done before the checkpoint
+                skip_steps = start_batch if (j, i) == (start_epoch, start_file) else 0
+                opt = tf.data.Options()
+                opt.experimental_deterministic = True
+                if crops_manifest is not None and crops_manifest['format'] == 'tfrecord':
+                    num_steps_per_epoch = stream_crops // (batch_size * local_replicas)
+                    train_ds = crop_records.read_crop_records(file, crops_manifest['max_seq_length'],
+                                                              batch_size=batch_size, seed=12 + j, repeat=True,
+                                                              skip_batches=skip_steps * local_replicas)
+                    train_ds = train_ds.with_options(opt)
+                else:
+                    # load file
+                    if crops_manifest is not None:
+                        train_dataset = preprocess_crops.load_crop_shard(file)
+                    elif shard_prefetcher is not None:
+                        train_dataset = next(prefetched_shards)
+                    else:
+                        train_dataset = dataset_utils.getTokenizedDataset(tokenizer,
+                                                                          os.path.join(train_dir, file),
+                                                                          verbose,
+                                                                          max_num_samples,
+                                                                          epoch=j)
+
+                    # how many epochs iterations we do in this file
+                    num_steps_per_epoch = len(train_dataset['input_ids']) // (batch_size * local_replicas)
+
+                    # use tf.Data in order to create an efficent pipeLine, reading the batches from the (memory mapped)
+                    # arrays of the crops
+                    train_ds = dataset_utils.crop_batches(train_dataset, batch_size=batch_size, shuffle_buffer=100,
+                                                          seed=12, repeat=True,
+                                                          skip_batches=skip_steps * local_replicas).with_options(opt)
+                if strategy != 'none':
+                    # each replica of the worker takes its own batches of batch_size crops
+                    train_ds = distribution.experimental_distribute_datasets_from_function(
+                        lambda input_context, dataset=train_ds: dataset)
+                if worker.num_workers > 1:
+                    # every step is a collective operation, the workers do the same number of steps
+                    num_steps_per_epoch = distributed_training.common_steps(distribution, num_steps_per_epoch)
+                train_ds = iter(train_ds)
+
+                step = min(skip_steps, num_steps_per_epoch)
+                epoch_iterator = tqdm(total=num_steps_per_epoch, initial=step, disable=not worker.is_chief)
+                while step < num_steps_per_epoch:
+                    # the steps are fused only up to the next step that writes the metrics or saves a
+                    # checkpoint, so that they are done at the same steps as without fusing
+                    steps_to_log = (-global_step) % log_every + 1
+                    steps_to_checkpoint = (-global_step) % checkpoint_interval or checkpoint_interval
+                    num_steps = min(steps_per_call, num_steps_per_epoch - step, steps_to_log, steps_to_checkpoint)
+                    # the metrics stay on the device, they are read only when they are written
+                    if steps_per_call > 1 and num_steps == steps_per_call:
+                        multi_step(train_ds)
+                    else:
+                        num_steps = 1
+                        train_step(next(train_ds))
+                    step += num_steps
+                    epoch_iterator.update(num_steps)
+                    # last step done
+                    global_step += num_steps - 1
+                    num_samples += global_batch_size * (num_steps - 1)
+
+                    if global_step % log_every == 0:
+                        running = metrics.write(global_step)
+                        epoch_iterator.set_postfix({'file': '%d/%d' % (i, len(all_files)),
+                                                    'samples': num_samples + global_batch_size,
+                                                    'global_loss': round(running['loss'], 4),
+                                                    "Accuracy": "%.2f:%.2f:%.2f" % (
+                                                        running['acc_1'], running['acc_2'], running['acc_3'])})
+
+                    global_step += 1
+                    num_samples += global_batch_size
+
+                    if global_step % checkpoint_interval == 0:
+                        # Save model checkpoint, with the position of the next step
+                        if step < num_steps_per_epoch:
+                            next_position = (j, i, step)
+                        elif i + 1 < len(all_files):
+                            next_position = (j, i + 1, 0)
+                        else:
+                            next_position = (j + 1, 0, 0)
+                        for variable, value in zip(position.values(), (global_step,) + next_position):
+                            variable.assign(value)
+                        # all the workers take part in the snapshot (the accumulated gradients are reduced among
+                        # them), only the chief copies it to checkpoint_dir, while training
+                        checkpointer.save(global_step, write_files=write_checkpoint_files, publish=worker.is_chief)
+
+        # the steps after the last write
+        metrics.write(global_step - 1)
+    finally:
+        if shard_prefetcher is not None:
+            shard_prefetcher.close()
+        checkpointer.close()
 
 
 if __name__ == "__main__":
@@ -259,7 +542,9 @@ if __name__ == "__main__":
 
     parser.add_argument("--checkpoint_dir", default="../checkpoints/", type=str,
                         help="the directory where we want to save the checkpoint")
-    parser.add_argument("--checkpoint", default="", type=str, help="The file we will use as checkpoint")
+    parser.add_argument("--checkpoint", default="", type=str,
+                        help="The checkpoint directory the training resumes from (by default the last one of "
+                             "checkpoint_dir), or an old weights file")
 
     parser.add_argument('--train_dir', type=str, default='../TrainData/',
                         help='Directory where all the traing data splitted in smaller junks are stored')
@@ -273,10 +558,28 @@ if __name__ == "__main__":
     parser.add_argument('--epoch', type=int, default=1)
     parser.add_argument('--model', type=str, default='albert')
     parser.add_argument('--batch_size', type=int, default=8)
-    parser.add_argument('--do_cache', type=bool, default=False)
+    parser.add_argument('--do_cache', action='store_true',
+                        help='Read the crops from the crop cache, or save them there if missing')
     parser.add_argument('--evaluate', type=bool, default=False)
     parser.add_argument('--verbose', type=bool, default=False)
     parser.add_argument('--starting_epoch', type=int, default=0)
+    parser.add_argument('--train_crops', type=str, default=None,
+                        help='Directory of the crops written by preprocess_crops.py, if given they are used instead '
+                             'of converting the files of train_dir')
+    parser.add_argument('--prefetch_shards', type=int, default=0,
+                        help='Number of files of train_dir converted in background processes ahead of the '
+                             'training, 0 to convert each file when it is needed')
+    parser.add_argument('--log_every', type=int, default=100,
+                        help='Number of steps whose metrics are averaged and written together')
+    parser.add_argument('--steps_per_call', type=int, default=1,
+                        help='Number of training steps fused in a single call of the tf.function, to cut the '
+                             'python overhead of every step')
+    parser.add_argument('--grad_accum_steps', type=int, default=1,
+                        help='Number of batches whose gradients are accumulated and applied together, for an '
+                             'effective batch size of grad_accum_steps * batch_size')
+    parser.add_argument('--strategy', choices=distributed_training.STRATEGIES, default='none',
+                        help='Distribution strategy: mirrored for all the devices of this machine, multi_worker for '
+                             'the cluster of TF_CONFIG (see distributed_training.py)')
 
     args, _ = parser.parse_known_args()
     print("Training / evaluation parameters %s", args)
@@ -291,4 +594,10 @@ if __name__ == "__main__":
          log_dir=args.log_dir,
          learning_rate=args.learning_rate,
          starting_epoch=args.starting_epoch,
-         checkpoint_interval=args.checkpoint_interval)
+         checkpoint_interval=args.checkpoint_interval,
+         train_crops=args.train_crops,
+         prefetch_shards=args.prefetch_shards,
+         log_every=args.log_every,
+         steps_per_call=args.steps_per_call,
+         grad_accum_steps=args.grad_accum_steps,
+         strategy=args.strategy)
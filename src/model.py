@@ -10,6 +10,8 @@ import tensorflow as tf
 import tensorflow_addons as tfa
 from transformers import BertConfig, BertTokenizer, AlbertTokenizer, AlbertConfig, AutoTokenizer
 from generator import DataGenerator
+import preprocess_crops
+import shard_utils
 from model_stuff import model_utils as mu
 from model_stuff.TFAlbertForNaturalQuestionAnswering import TFAlbertForNaturalQuestionAnswering
 from model_stuff.TFBertForNaturalQuestionAnswering import TFBertForNaturalQuestionAnswering
@@ -17,7 +19,8 @@ from model_stuff.TFBertForNaturalQuestionAnswering import TFBertForNaturalQuesti
 
 def main(namemodel, batch_size, train_dir, val_dir, epoch, checkpoint_dir, do_cache=False, verbose=False,
          evaluate=False,
-         max_num_samples=1_000_000, checkpoint="", log_dir="log/", learning_rate=0.005, starting_epoch=0):
+         max_num_samples=1_000_000, checkpoint="", log_dir="log/", learning_rate=0.005, starting_epoch=0,
+         train_crops=None, num_active_shards=2, steps_per_epoch=None):
     """
 
     :param do_cache:
@@ -33,6 +36,9 @@ def main(namemodel, batch_size, train_dir, val_dir, epoch, checkpoint_dir, do_ca
     :param verbose: fag per stampare informazioni sul primo elemento del dataset
     :param evaluate: Bool per indicare se dobbiamo eseguire Evaluation o Training. Training di Default
     :param max_num_samples: massimo numero di oggetti da prendere in considerazione (1mil Default)
+    :param train_crops: se non None directory dei crops di training già convertiti da preprocess_crops.py
+    :param num_active_shards: numero di file da cui sono estratti insieme i batch di training (vedi ShardSampler)
+    :param steps_per_epoch: numero di batch di un'epoca, None per i batch di tutti i file
     :return: TUTTO
 
     """
@@ -149,20 +155,30 @@ def main(namemodel, batch_size, train_dir, val_dir, epoch, checkpoint_dir, do_ca
                     optimizer=adam
                     )
 
+    # the resume point counts the files already trained, fit counts the passes over all the files:
+    # the first pass skips only the files left over
+    if train_crops is not None:
+        n_files = len(preprocess_crops.crop_shard_paths(train_crops))
+    else:
+        n_files = len(shard_utils.list_shards(train_dir))
+    epoch = int(epoch)
+    initial_epoch, start_file = divmod(initial_epoch, n_files)
+    if initial_epoch >= epoch:
+        raise ValueError("The checkpoint is at pass {} (file {}), the training has only {} passes".format(
+            initial_epoch, start_file, epoch))
+
     # We create data generator
     validation_generator = DataGenerator(val_dir, namemodel, vocab, verbose, batch_size=batch_size,
                                          validation=True)
 
     traingenerator = DataGenerator(train_dir, namemodel, vocab, verbose, batch_size=batch_size,
-                                   batch_start=initial_epoch)
+                                   batch_start=start_file, crops_dir=train_crops,
+                                   num_active_shards=num_active_shards, steps_per_epoch=steps_per_epoch)
 
     # Training data
-    # since we do an epoch for each file eventually we have to do
-    # epoch*n_files epochs
-    n_files = traingenerator.num_files()
-    epoch = int(epoch) * n_files
-
-    print('\n\nwe have {} files so we will train for {} epochs\n\n'.format(n_files, epoch))
+    # the batches are drawn from all the files, an epoch has the batches of all of them
+    print('\n\nwe have {} files so we will train for {} epochs of {} steps, from epoch {}\n\n'.format(
+        n_files, epoch, len(traingenerator), initial_epoch))
 
     cb = mu.TimingCallback()  # execution time callback
     filepath = os.path.join(checkpoint_dir, "weights_preTrained.hdf5")
@@ -214,10 +230,18 @@ if __name__ == "__main__":
     parser.add_argument('--epoch', type=int, default=1)
     parser.add_argument('--model', type=str, default='albert')
     parser.add_argument('--batch_size', type=int, default=8)
-    parser.add_argument('--do_cache', type=bool, default=False)
+    parser.add_argument('--do_cache', action='store_true',
+                        help='Read the crops from the crop cache, or save them there if missing')
     parser.add_argument('--evaluate', type=bool, default=False)
     parser.add_argument('--verbose', type=bool, default=False)
     parser.add_argument('--starting_epoch', type=int, default=0)
+    parser.add_argument('--train_crops', type=str, default=None,
+                        help='Directory of the crops written by preprocess_crops.py, if given they are used instead '
+                             'of converting the files of train_dir')
+    parser.add_argument('--num_active_shards', type=int, default=2,
+                        help='Number of training files the batches are drawn from at the same time')
+    parser.add_argument('--steps_per_epoch', type=int, default=None,
+                        help='Number of batches of an epoch, by default the batches of all the training files')
 
     args, _ = parser.parse_known_args()
     # assert args.model_type not in ('xlnet', 'xlm'), f'Unsupported model_type: {args.model_type}'
@@ -226,4 +250,5 @@ if __name__ == "__main__":
     main(args.model, args.batch_size, args.train_dir, args.validation_dir, args.epoch, args.checkpoint_dir,
          checkpoint=args.checkpoint, do_cache=args.do_cache,
          evaluate=args.evaluate, verbose=args.verbose, log_dir=args.log_dir, learning_rate=args.learning_rate,
-         starting_epoch=args.starting_epoch)
+         starting_epoch=args.starting_epoch, train_crops=args.train_crops,
+         num_active_shards=args.num_active_shards, steps_per_epoch=args.steps_per_epoch)
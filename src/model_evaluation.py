@@ -105,6 +105,24 @@ if __name__ == "__main__":
 
     parser.add_argument('--test_dir', type=str, default='../TestData/simplified-nq-test.jsonl',
                         help='Path of test set')
+    parser.add_argument('--example_ids', type=str, nargs='*', default=None,
+                        help='If given only these examples of the test set are evaluated, '
+                             'they are read through the index of the file')
+
+    parser.add_argument('--num_preprocess_workers', type=int, default=0,
+                        help="If bigger than 0 the test set is converted to crops by this number of processes")
+
+    parser.add_argument('--tokenizer_backend', choices=word_tokenization.BACKENDS, default='slow',
+                        help="Tokenizer of the words of the documents, 'fast' uses the tokenizers library "
+                             "(BERT only)")
+    parser.add_argument('--word_cache_dir', type=str, default=None,
+                        help="If given the word pieces of the words of the documents are also cached on disk "
+                             "in this directory, and reused by the next runs")
+    parser.add_argument('--crop_cache_dir', type=str, default=CROP_CACHE_DIR,
+                        help="Directory of the crop cache used with --do_cache, shared by all the files and "
+                             "configurations")
+    parser.add_argument('--crop_cache_size', type=float, default=crop_cache.CACHE_SIZE_GB,
+                        help="Maximum size of the crop cache in GB, the least recently used crops are deleted")
 
     parser.add_argument('--epoch', type=int, default=1)
     parser.add_argument('--model', type=str, default='bert')
@@ -0,0 +1,288 @@
+"""
+On this file we have the offline preprocessing of a whole directory of
+jsonl shards (e.g. TrainData/): every shard is converted to the crops of
+getTokenizedDataset once, in parallel, and saved ready to train, so that
+the training runs (mode_tf.py --train_crops, DataGenerator(crops_dir=...))
+do not tokenize anything.
+The output directory has a crop shard per jsonl shard, in one of
+OUTPUT_FORMATS, and a manifest with the number of crops of each shard, the
+model and the tokenizer that produced the ids and the options of the
+conversion:
+- npy: a directory K.crops with an .npy file per array, memory mapped
+  when it is loaded (see load_crop_shard)
+- tfrecord: a file K.tfrecord, streamed by crop_records.read_crop_records
+
+Usage: python preprocess_crops.py --train_dir ../TrainData/ --crops_dir ../TrainCrops/ --num_workers 8
+plus the options of the conversion of getTokenizedDataset (--max_seq_length, --doc_stride, ...)
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from transformers import BertTokenizer, AlbertTokenizer
+
+import crop_records
+import dataset_utils_version2 as dataset_utils
+import shard_utils
+import word_tokenization
+
+CROPS_MANIFEST_NAME = 'crops_manifest.json'
+
+OUTPUT_FORMATS = ('npy', 'tfrecord')
+
+CROP_SHARD_SUFFIX = '.crops'
+
+# state of the workers, set once by _init_worker
+_worker = {}
+
+
+def get_tokenizer(model):
+    """
+    This function returns the tokenizer used by mode_tf for a model
+
+    @param model 'albert' or 'bert'
+
+    @return the tokenizer of transformers
+    """
+    if model == 'albert':
+        return AlbertTokenizer.from_pretrained('albert-base-v2', do_lower_case='uncased')
+    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case='uncased')
+    tokenizer.add_tokens(dataset_utils.get_add_tokens(do_enumerate=True))
+    return tokenizer
+
+
+def save_crop_shard(arrays, path):
+    """
+    This function saves the arrays of a shard as .npy files of a
+    directory. The directory is written with a temporary name and renamed,
+    so a directory that exists is complete
+
+    @param arrays dictionary of the arrays of getTokenizedDataset
+    @param path path of the directory
+    """
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+        if os.path.exists(path):
+            # converted again with other options
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def load_crop_shard(path):
+    """
+    This function opens the arrays of a shard saved by save_crop_shard,
+    memory mapped read only
+
+    @param path path of the directory
+
+    @return dictionary of the arrays, like the one of getTokenizedDataset
+    """
+    return {fn[:-len('.npy')]: np.load(os.path.join(path, fn), mmap_mode='r')
+            for fn in sorted(os.listdir(path)) if fn.endswith('.npy')}
+
+
+def read_crops_manifest(crops_dir):
+    """
+    @param crops_dir a directory written by preprocess_directory
+
+    @return the manifest dictionary
+    """
+    with open(os.path.join(crops_dir, CROPS_MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def check_crops_manifest(manifest, model, tokenizer=None):
+    """
+    This function checks that the crops of a manifest were converted for
+    the model that is trained, so that its ids are not read with another
+    vocabulary
+
+    @param manifest the manifest dictionary
+    @param model name of the model trained ('albert', 'bert', ...)
+    @param tokenizer the tokenizer of the training, None to check only the
+        model
+
+    @raise ValueError if the crops were converted for another model or
+        tokenizer
+    """
+    if manifest.get('model') != model:
+        raise ValueError("The crops were converted for the model {}, not for {}: convert them again with "
+                         "preprocess_crops.py --model {}".format(manifest.get('model'), model, model))
+    if tokenizer is not None and \
+            manifest.get('tokenizer') != word_tokenization.tokenizer_fingerprint(tokenizer):
+        raise ValueError("The crops were converted with another tokenizer (fingerprint {}): convert them "
+                         "again with preprocess_crops.py --model {}".format(manifest.get('tokenizer'), model))
+
+
+def crop_shard_paths(crops_dir):
+    """
+    @param crops_dir a directory written by preprocess_directory
+
+    @return list of the paths of the crop shards, in the order of the
+        jsonl shards
+    """
+    return [os.path.join(crops_dir, s['file']) for s in read_crops_manifest(crops_dir)['shards']]
+
+
+def pool_worker_args(args):
+    """
+    This function returns the options of the conversion for a process of a
+    pool: nested pools are not allowed, the workers convert their shard
+    alone
+
+    @param args options of the conversion (see get_tokenization_args)
+
+    @return a copy of args with num_preprocess_workers 0
+    """
+    worker_args = argparse.Namespace(**vars(args))
+    worker_args.num_preprocess_workers = 0
+    return worker_args
+
+
+def _init_worker(tokenizer, crops_dir, output_format, max_num_samples, args):
+    _worker.update(tokenizer=tokenizer, crops_dir=crops_dir, output_format=output_format,
+                   max_num_samples=max_num_samples, args=args)
+
+
+def _preprocess_shard(shard_path):
+    output_format = _worker['output_format']
+    number = shard_utils.shard_number(os.path.basename(shard_path))
+    suffix = CROP_SHARD_SUFFIX if output_format == 'npy' else crop_records.RECORD_SUFFIX
+    output_file = '{}{}'.format(number, suffix)
+    arrays = dataset_utils.getTokenizedDataset(_worker['tokenizer'], shard_path, False, _worker['max_num_samples'],
+                                               args=_worker['args'])
+    output_path = os.path.join(_worker['crops_dir'], output_file)
+    if output_format == 'npy':
+        save_crop_shard(arrays, output_path)
+    else:
+        crop_records.write_crop_records(arrays, output_path)
+    return {'shard': os.path.basename(shard_path), 'file': output_file,
+            'num_crops': len(arrays['input_ids']), 'max_seq_length': arrays['input_ids'].shape[1]}
+
+
+def preprocess_directory(tokenizer, train_dir, crops_dir, args, num_workers=1, output_format='npy',
+                         max_num_samples=1_000_000, model=None):
+    """
+    This function converts all the jsonl shards of a directory to crop
+    shards and writes the manifest. The shards that are already in the
+    manifest of crops_dir are skipped, so an interrupted run can be resumed
+    (only if the manifest has the same options, model and tokenizer)
+
+    @param tokenizer the tokenizer of transformers
+    @param train_dir directory of the jsonl shards
+    @param crops_dir output directory
+    @param args options of the conversion (see get_tokenization_args)
+    @param num_workers number of processes, each one converts a shard at
+        a time (with more than one process the shards are not converted
+        with --num_preprocess_workers)
+    @param output_format one of OUTPUT_FORMATS
+    @param max_num_samples maximum number of examples of a shard
+    @param model name of the model of the tokenizer, written in the manifest
+
+    @return the manifest dictionary
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format: {}".format(output_format))
+    os.makedirs(crops_dir, exist_ok=True)
+    # the ids of the crops depend on the tokenizer
+    producer = {'model': model, 'tokenizer': word_tokenization.tokenizer_fingerprint(tokenizer),
+                'max_num_samples': max_num_samples}
+    done = {}
+    if os.path.exists(os.path.join(crops_dir, CROPS_MANIFEST_NAME)):
+        manifest = read_crops_manifest(crops_dir)
+        if manifest['format'] == output_format and manifest['args'] == vars(args) and \
+                all(manifest.get(key) == value for key, value in producer.items()):
+            done = {s['shard']: s for s in manifest['shards']
+                    if os.path.exists(os.path.join(crops_dir, s['file']))}
+    shards = shard_utils.list_shards(train_dir)
+    todo = [os.path.join(train_dir, s) for s in shards if s not in done]
+    print(f'Preprocessing {len(todo)} of {len(shards)} shards of {train_dir} with {num_workers} workers')
+
+    results = dict(done)
+
+    def add_result(shard_info):
+        results[shard_info['shard']] = shard_info
+        print(f"Converted {shard_info['shard']}: {shard_info['num_crops']} crops")
+        # written after every shard, so that an interrupted run can be resumed
+        write_crops_manifest(crops_dir, output_format, args, [results[s] for s in shards if s in results],
+                             complete=all(s in results for s in shards), **producer)
+
+    if num_workers > 1:
+        initargs = (tokenizer, crops_dir, output_format, max_num_samples, pool_worker_args(args))
+        with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=initargs) as pool:
+            for shard_info in pool.imap_unordered(_preprocess_shard, todo):
+                add_result(shard_info)
+    else:
+        _init_worker(tokenizer, crops_dir, output_format, max_num_samples, args)
+        for shard_path in todo:
+            add_result(_preprocess_shard(shard_path))
+
+    return write_crops_manifest(crops_dir, output_format, args, [results[s] for s in shards], complete=True,
+                                **producer)
+
+
+def write_crops_manifest(crops_dir, output_format, args, shard_infos, complete, model=None, tokenizer=None,
+                         max_num_samples=None):
+    """
+    This function writes the manifest of a directory of crop shards
+
+    @param crops_dir the directory
+    @param output_format one of OUTPUT_FORMATS
+    @param args options of the conversion
+    @param shard_infos list of dictionaries, one per crop shard, with keys
+        shard, file, num_crops and max_seq_length
+    @param complete False if some jsonl shards are not converted yet
+    @param model name of the model of the tokenizer
+    @param tokenizer fingerprint of the tokenizer (see
+        word_tokenization.tokenizer_fingerprint)
+    @param max_num_samples maximum number of examples of a shard
+
+    @return the manifest dictionary
+    """
+    manifest = {
+        'format': output_format,
+        'complete': complete,
+        'num_shards': len(shard_infos),
+        'num_crops': sum(s['num_crops'] for s in shard_infos),
+        'max_seq_length': args.max_seq_length,
+        'model': model,
+        'tokenizer': tokenizer,
+        'max_num_samples': max_num_samples,
+        'args': vars(args),
+        'shards': shard_infos,
+    }
+    with open(os.path.join(crops_dir, CROPS_MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a directory of jsonl shards to ready to train crops.')
+
+    parser.add_argument('--train_dir', type=str, default='../TrainData/',
+                        help='Directory of the jsonl shards')
+    parser.add_argument('--crops_dir', type=str, default='../TrainCrops/',
+                        help='Output directory of the crop shards and of their manifest')
+    parser.add_argument('--output_format', choices=OUTPUT_FORMATS, default='npy')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Number of shards converted at the same time')
+    parser.add_argument('--model', type=str, default='albert')
+    parser.add_argument('--max_num_samples', type=int, default=1_000_000)
+
+    main_args, _ = parser.parse_known_args()
+    # the options of the conversion are the ones of getTokenizedDataset
+    tokenization_args = dataset_utils.get_tokenization_args()
+
+    preprocess_directory(get_tokenizer(main_args.model), main_args.train_dir, main_args.crops_dir,
+                         tokenization_args, num_workers=main_args.num_workers,
+                         output_format=main_args.output_format, max_num_samples=main_args.max_num_samples,
+                         model=main_args.model)
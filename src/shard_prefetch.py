@@ -0,0 +1,107 @@
+"""
+On this file we have the prefetching of the training shards: while the
+model trains on a shard, the next ones are converted to crops by
+getTokenizedDataset in worker processes. The arrays of a converted shard
+are handed over through shared memory: the worker saves them as .npy
+files in a tmpfs directory (/dev/shm) and the training process memory
+maps them, so they are never copied nor pickled between the processes
+"""
+import collections
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import dataset_utils_version2 as dataset_utils
+import preprocess_crops
+import shard_utils
+
+# state of the workers, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(tokenizer, args, max_num_samples, verbose):
+    _worker.update(tokenizer=tokenizer, args=args, max_num_samples=max_num_samples, verbose=verbose)
+
+
+def _prefetch_shard(task):
+    path, epoch, output_path = task
+    arrays = dataset_utils.getTokenizedDataset(_worker['tokenizer'], path, _worker['verbose'],
+                                               _worker['max_num_samples'], args=_worker['args'], epoch=epoch)
+    preprocess_crops.save_crop_shard(arrays, output_path)
+    return output_path
+
+
+class ShardPrefetcher:
+    """
+    Iterator over the arrays of getTokenizedDataset of a list of shards,
+    in order. Up to depth shards are converted ahead of the one that is
+    used, each one by a worker process; the arrays of a shard are deleted
+    from the shared memory when the next one is requested
+    """
+
+    def __init__(self, tokenizer, tasks, depth=1, args=None, max_num_samples=1_000_000, verbose=False,
+                 shm_dir=None):
+        """
+        @param tokenizer the tokenizer of transformers
+        @param tasks list of (path of the jsonl shard, training epoch)
+        @param depth number of shards converted ahead
+        @param args options of the conversion, None to read them from the
+            command line (see get_tokenization_args)
+        @param max_num_samples maximum number of examples of a shard
+        @param verbose passed to getTokenizedDataset
+        @param shm_dir directory of the converted shards, None for SHM_DIR of
+            shard_utils
+        """
+        if depth < 1:
+            raise ValueError("The prefetch depth must be at least 1, not {}".format(depth))
+        if args is None:
+            args = dataset_utils.get_tokenization_args()
+        if shm_dir is None:
+            shm_dir = shard_utils.memory_dir()
+        self.directory = tempfile.mkdtemp(prefix='shards-', dir=shm_dir)
+        self.tasks = list(tasks)
+        self.depth = depth
+        # the training process has already started tensorflow, which must not be forked
+        context = multiprocessing.get_context('spawn')
+        initargs = (tokenizer, preprocess_crops.pool_worker_args(args), max_num_samples, verbose)
+        self.pool = context.Pool(min(depth, len(self.tasks)) or 1, initializer=_init_worker, initargs=initargs)
+        self.pending = collections.deque()
+        self.next_task = 0
+        self.current_path = None
+
+    def _submit(self):
+        while len(self.pending) < self.depth and self.next_task < len(self.tasks):
+            path, epoch = self.tasks[self.next_task]
+            output_path = os.path.join(self.directory, '{}{}'.format(self.next_task,
+                                                                     preprocess_crops.CROP_SHARD_SUFFIX))
+            self.pending.append(self.pool.apply_async(_prefetch_shard, ((path, epoch, output_path),)))
+            self.next_task += 1
+
+    def _release(self):
+        # the arrays still mapped by the training stay readable
+        if self.current_path is not None:
+            shutil.rmtree(self.current_path, ignore_errors=True)
+            self.current_path = None
+
+    def __iter__(self):
+        self._submit()
+        while self.pending:
+            result = self.pending.popleft()
+            self._release()
+            self._submit()
+            # the exceptions of the worker are raised here
+            self.current_path = result.get()
+            yield preprocess_crops.load_crop_shard(self.current_path)
+        self._release()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,259 @@
+"""
+On this file we have the utilities shared by the tools that produce the
+numbered jsonl shards (0.jsonl, 1.jsonl, ...) of the Natural Questions
+dataset and by the training code that consumes them
+"""
+import gzip
+import io
+import json
+import lzma
+import os
+import re
+import tempfile
+
+MANIFEST_NAME = 'manifest.json'
+
+# Suffix of the sidecar index of a shard (example_id -> offset, length)
+INDEX_SUFFIX = '.idx'
+
+# Suffix of the shards for each supported compression
+COMPRESSION_SUFFIXES = {
+    'none': '.jsonl',
+    'gzip': '.jsonl.gz',
+    'xz': '.jsonl.xz',
+}
+
+# Size of the buffers of the shards: lines are accumulated in memory and
+# reach the disk (or the (de)compressor) in large sequential blocks
+BUFFER_SIZE = 16 * 1024 * 1024
+
+# tmpfs directory of the temporary files that are written and read back
+# while training (prefetched shards, checkpoint snapshots)
+SHM_DIR = '/dev/shm'
+
+_SHARD_RE = re.compile(r'^(\d+)\.jsonl(\.gz|\.xz)?$')
+
+_EXAMPLE_ID_RE = re.compile(rb'"example_id": ?(-?\d+)')
+
+
+def memory_dir():
+    """
+    @return SHM_DIR, the temporary directory if it is missing
+    """
+    return SHM_DIR if os.path.isdir(SHM_DIR) else tempfile.gettempdir()
+
+
+def shard_number(filename):
+    """
+    This function returns the number K of a shard called K.jsonl,
+    K.jsonl.gz or K.jsonl.xz
+
+    @param filename name (not path) of the file
+
+    @return the number of the shard, None if the file is not a shard
+    """
+    match = _SHARD_RE.match(filename)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def open_shard(path, mode='rt'):
+    """
+    This function opens a jsonl file, compressed or not depending on its
+    suffix (.gz for gzip, .xz for lzma). Compressed files are streamed
+    through the decompressor, so they are never fully held in memory
+
+    @param path path of the file
+    @param mode 'rt' or 'wt' for text (utf-8), 'rb' or 'wb' for bytes
+
+    @return the file object
+    """
+    binary = 'b' in mode
+    raw_mode = mode.replace('t', '').replace('b', '') + 'b'
+    if path.endswith('.gz'):
+        f = gzip.open(path, raw_mode, compresslevel=6) if 'w' in raw_mode else gzip.open(path, raw_mode)
+    elif path.endswith('.xz'):
+        f = lzma.open(path, raw_mode)
+    else:
+        if binary:
+            return open(path, raw_mode, buffering=BUFFER_SIZE)
+        return open(path, mode, encoding='utf-8')
+    f = io.BufferedWriter(f, BUFFER_SIZE) if 'w' in raw_mode else io.BufferedReader(f, BUFFER_SIZE)
+    if binary:
+        return f
+    return io.TextIOWrapper(f, encoding='utf-8')
+
+
+def list_shards(directory):
+    """
+    This function lists the shards contained in a directory, ignoring
+    any other file (e.g. the manifest), sorted by shard number
+
+    @param directory path of the directory containing the shards
+
+    @return list of file names (not paths)
+    """
+    shards = [f for f in os.listdir(directory) if shard_number(f) is not None]
+    return sorted(shards, key=shard_number)
+
+
+def write_manifest(directory, shards):
+    """
+    This function writes the manifest of a directory of shards.
+    The manifest lets whoever schedules the work know how big each shard
+    is without reading it
+
+    @param directory path of the directory containing the shards
+    @param shards list of dictionaries, one per shard, with keys
+        file, num_examples, num_bytes and num_document_tokens
+    """
+    manifest = {
+        'num_shards': len(shards),
+        'num_examples': sum(s['num_examples'] for s in shards),
+        'num_bytes': sum(s['num_bytes'] for s in shards),
+        'num_document_tokens': sum(s['num_document_tokens'] for s in shards),
+        'shards': shards,
+    }
+    with open(os.path.join(directory, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(directory):
+    """
+    This function reads the manifest of a directory of shards
+
+    @param directory path of the directory containing the shards
+
+    @return the manifest dictionary, None if the directory has no manifest
+    """
+    manifest_fn = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(manifest_fn):
+        return None
+    with open(manifest_fn) as f:
+        return json.load(f)
+
+
+def _example_id_of_line(line):
+    # quotes inside json strings are escaped, so the first match is the key
+    match = _EXAMPLE_ID_RE.search(line)
+    if match is not None:
+        return match.group(1).decode('ascii')
+    return str(json.loads(line)['example_id'])
+
+
+def build_shard_index(path):
+    """
+    This function builds the sidecar index of a shard, i.e. the position
+    of every example in the (uncompressed) shard, and saves it next to
+    the shard as path + INDEX_SUFFIX
+
+    @param path path of the shard
+
+    @return dictionary example_id -> (byte offset, length in bytes)
+    """
+    index = {}
+    offset = 0
+    with open_shard(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                index[_example_id_of_line(line)] = (offset, len(line))
+            offset += len(line)
+    try:
+        with open(path + INDEX_SUFFIX, 'w') as f:
+            json.dump(index, f)
+    except OSError as e:
+        print("Could not save the index of {}: {}".format(path, e))
+    return index
+
+
+def load_shard_index(path):
+    """
+    This function loads the sidecar index of a shard, building it if it
+    is missing or older than the shard
+
+    @param path path of the shard
+
+    @return dictionary example_id -> (byte offset, length in bytes)
+    """
+    index_fn = path + INDEX_SUFFIX
+    if os.path.exists(index_fn) and os.path.getmtime(index_fn) >= os.path.getmtime(path):
+        with open(index_fn) as f:
+            return {k: tuple(v) for k, v in json.load(f).items()}
+    return build_shard_index(path)
+
+
+class ExampleReader:
+    """
+    Random access to the examples of one or more shards by example_id,
+    through the sidecar indexes of the shards.
+    Reading an example from an uncompressed shard is a single seek and
+    read; compressed shards are supported but the seek has to decompress
+    the shard up to the example.
+    """
+
+    def __init__(self, shard_paths):
+        """
+        @param shard_paths list of paths of the shards
+        """
+        self.shard_paths = list(shard_paths)
+        self.index = {}
+        for shard_id, path in enumerate(self.shard_paths):
+            for example_id, (offset, length) in load_shard_index(path).items():
+                self.index[example_id] = (shard_id, offset, length)
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, example_id):
+        return str(example_id) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def read_line(self, example_id):
+        """
+        This function returns the raw jsonl line of an example
+
+        @param example_id the id of the example
+
+        @return the line as a string
+        """
+        shard_id, offset, length = self.index[str(example_id)]
+        f = self.files.get(shard_id)
+        if f is None:
+            f = open_shard(self.shard_paths[shard_id], 'rb')
+            self.files[shard_id] = f
+        f.seek(offset)
+        return f.read(length).decode('utf-8')
+
+    def read(self, example_id):
+        """
+        This function returns an example
+
+        @param example_id the id of the example
+
+        @return the example as a dictionary
+        """
+        return json.loads(self.read_line(example_id))
+
+    def iter_lines(self, example_ids):
+        """
+        This function yields the raw jsonl lines of some examples, in the
+        order of their position in the shards
+
+        @param example_ids iterable of example ids, those that are not
+            in the shards are skipped
+        """
+        example_ids = [str(e) for e in example_ids if str(e) in self.index]
+        for example_id in sorted(example_ids, key=lambda e: self.index[e]):
+            yield self.read_line(example_id)
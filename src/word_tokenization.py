@@ -0,0 +1,335 @@
+"""
+On this file we have the word tokenizers used by convert_examples_to_crops.
+The documents are already split in words, so every word is tokenized
+alone: a word tokenizer maps each word to its word pieces and their ids
+and caches the result, since the same words appear over and over.
+The cache has a bounded in memory tier and an optional sqlite tier on
+disk, so that the words tokenized for a shard are not tokenized again for
+the next shards, epochs or runs
+"""
+import collections
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+
+from transformers import BertTokenizer
+
+try:
+    from tokenizers import BertWordPieceTokenizer
+except ImportError:
+    BertWordPieceTokenizer = None
+
+# 'slow' tokenizes with the python tokenizer of transformers, 'fast' with
+# the rust tokenizers library (bert word piece tokenizers only)
+BACKENDS = ('slow', 'fast')
+
+# Maximum number of words kept in memory by default
+CACHE_SIZE = 1000000
+
+# Number of words looked up on disk in a single query (sqlite limits the
+# number of parameters of a query)
+DISK_QUERY_SIZE = 500
+
+# word tokenizers already created, see get_word_tokenizer
+_word_tokenizers = {}
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    This function returns an identifier of the tokenization of a
+    tokenizer: its class, its vocabulary files, its added tokens and
+    whether it lower cases the text
+
+    @param tokenizer the tokenizer of transformers
+
+    @return string
+    """
+    fingerprint = hashlib.sha1(type(tokenizer).__name__.encode())
+    with tempfile.TemporaryDirectory() as vocab_dir:
+        for vocab_file in sorted(tokenizer.save_vocabulary(vocab_dir)):
+            with open(vocab_file, 'rb') as f:
+                fingerprint.update(f.read())
+    fingerprint.update(json.dumps(sorted(tokenizer.added_tokens_encoder.items())).encode())
+    fingerprint.update(json.dumps(bool(tokenizer.init_kwargs.get('do_lower_case'))).encode())
+    return fingerprint.hexdigest()[:16]
+
+
+class WordPieceCache:
+    """
+    Cache word -> (word pieces, ids) with a memory tier of at most max_size
+    words, evicted in least recently used order, and an optional sqlite
+    tier on disk which is never evicted
+    """
+
+    def __init__(self, path=None, max_size=CACHE_SIZE):
+        """
+        @param path path of the sqlite file, None to keep the cache only in
+            memory
+        @param max_size maximum number of words kept in memory
+        """
+        self.path = path
+        self.max_size = max_size
+        self.memory = collections.OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # the workers of a preprocessing pool may share the file
+            self.db = sqlite3.connect(path, timeout=600)
+            self.db.execute('CREATE TABLE IF NOT EXISTS word_pieces '
+                            '(word TEXT PRIMARY KEY, tokens TEXT, ids TEXT)')
+            self.db.commit()
+
+    def __len__(self):
+        return len(self.memory)
+
+    def __contains__(self, word):
+        return word in self.memory
+
+    def get(self, word):
+        """
+        This function returns the word pieces of a word kept in memory
+
+        @param word the word
+
+        @return (list of word pieces, list of ids), None if the word is not
+            in memory
+        """
+        entry = self.memory.get(word)
+        if entry is not None:
+            self.memory.move_to_end(word)
+        return entry
+
+    def _put_memory(self, word, entry):
+        self.memory[word] = entry
+        self.memory.move_to_end(word)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def lookup(self, words):
+        """
+        This function moves in memory the words that are on disk, updating
+        the counters
+
+        @param words list of distinct words
+
+        @return list of the words that are neither in memory nor on disk
+        """
+        missing = []
+        for word in words:
+            if self.get(word) is None:
+                missing.append(word)
+        self.memory_hits += len(words) - len(missing)
+        if self.db is None or not missing:
+            self.misses += len(missing)
+            return missing
+        found = {}
+        for i in range(0, len(missing), DISK_QUERY_SIZE):
+            query_words = missing[i: i + DISK_QUERY_SIZE]
+            rows = self.db.execute('SELECT word, tokens, ids FROM word_pieces WHERE word IN ({})'.format(
+                ','.join('?' * len(query_words))), query_words)
+            for word, tokens, ids in rows:
+                found[word] = (json.loads(tokens), json.loads(ids))
+        for word, entry in found.items():
+            self._put_memory(word, entry)
+        self.disk_hits += len(found)
+        missing = [word for word in missing if word not in found]
+        self.misses += len(missing)
+        return missing
+
+    def put(self, entries):
+        """
+        This function adds new words to the cache
+
+        @param entries dictionary word -> (list of word pieces, list of ids)
+        """
+        for word, entry in entries.items():
+            self._put_memory(word, entry)
+        if self.db is not None and entries:
+            self.db.executemany('INSERT OR IGNORE INTO word_pieces VALUES (?, ?, ?)',
+                                ((word, json.dumps(tokens), json.dumps(ids))
+                                 for word, (tokens, ids) in entries.items()))
+            self.db.commit()
+
+    def hit_rate(self):
+        """
+        @return fraction of the distinct words looked up that were not
+            tokenized again
+        """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.
+
+    def stats(self):
+        return 'word pieces cache: {} memory hits, {} disk hits, {} misses, hit rate {:.1%}, {} words in memory'.format(
+            self.memory_hits, self.disk_hits, self.misses, self.hit_rate(), len(self.memory))
+
+
+class WordTokenizer:
+    """
+    Word pieces of single words computed by the python tokenizer of
+    transformers (tokenizer.tokenize), cached by word
+    """
+
+    def __init__(self, tokenizer, cache=None):
+        """
+        @param tokenizer the tokenizer of transformers
+        @param cache the WordPieceCache, None for a new one in memory
+        """
+        self.tokenizer = tokenizer
+        self.cache = cache if cache is not None else WordPieceCache()
+
+    def tokenize_words(self, words):
+        """
+        This function tokenizes some words
+
+        @param words list of words
+
+        @return dictionary word -> (list of word pieces, list of ids)
+        """
+        entries = {}
+        for word in words:
+            sub_tokens = self.tokenizer.tokenize(word)
+            entries[word] = (sub_tokens, self.tokenizer.convert_tokens_to_ids(sub_tokens))
+        return entries
+
+    def add_words(self, words):
+        """
+        This function tokenizes together all the words that are not cached
+        yet
+
+        @param words iterable of words
+        """
+        new_words = self.cache.lookup(list(dict.fromkeys(words)))
+        if new_words:
+            self.cache.put(self.tokenize_words(new_words))
+
+    def get(self, word):
+        """
+        This function returns the word pieces of a word
+
+        @param word the word
+
+        @return (list of word pieces, list of their ids)
+        """
+        entry = self.cache.get(word)
+        if entry is None:
+            # evicted from memory after the prefetch of its block
+            entry = self.tokenize_words([word])[word]
+            self.cache.put({word: entry})
+        return entry
+
+    def prefetch(self, examples, block_size=1000):
+        """
+        This generator yields the examples, tokenizing the words of each
+        block of block_size examples with a single add_words call
+
+        @param examples iterable of NQExample
+        @param block_size number of examples of a block
+        """
+        block = []
+        for example in examples:
+            block.append(example)
+            if len(block) == block_size:
+                self.add_words(word for e in block for word in e.doc_tokens)
+                yield from block
+                block = []
+        self.add_words(word for e in block for word in e.doc_tokens)
+        yield from block
+
+
+class FastWordTokenizer(WordTokenizer):
+    """
+    Word pieces of single words computed by the rust BertWordPieceTokenizer
+    of the tokenizers library, which encodes a whole batch of words in a
+    single call. It is built from the vocabulary of a BertTokenizer, the
+    words that contain one of its added or special tokens are left to the
+    python tokenizer, which splits on them
+    """
+
+    def __init__(self, tokenizer, cache=None):
+        """
+        @param tokenizer a BertTokenizer of transformers
+        @param cache the WordPieceCache, None for a new one in memory
+        """
+        super().__init__(tokenizer, cache)
+        lowercase = tokenizer.basic_tokenizer.do_lower_case
+        with tempfile.TemporaryDirectory() as vocab_dir:
+            vocab_file = tokenizer.save_vocabulary(vocab_dir)[0]
+            self.fast_tokenizer = BertWordPieceTokenizer(
+                vocab_file,
+                add_special_tokens=False,
+                unk_token=tokenizer.unk_token,
+                sep_token=tokenizer.sep_token,
+                cls_token=tokenizer.cls_token,
+                handle_chinese_chars=tokenizer.basic_tokenizer.tokenize_chinese_chars,
+                strip_accents=lowercase,
+                lowercase=lowercase)
+        self.lowercase = lowercase
+        special_tokens = list(tokenizer.added_tokens_encoder) + tokenizer.all_special_tokens
+        self.special_tokens_re = re.compile('|'.join(
+            re.escape(t) for t in sorted(special_tokens, key=len, reverse=True)))
+
+    def tokenize_words(self, words):
+        fast_words, slow_words = [], []
+        for word in words:
+            if (self.special_tokens_re.search(word) is not None or
+                    (self.lowercase and self.special_tokens_re.search(word.lower()) is not None)):
+                slow_words.append(word)
+            else:
+                fast_words.append(word)
+        entries = super().tokenize_words(slow_words)
+        if fast_words:
+            for word, encoding in zip(fast_words, self.fast_tokenizer.encode_batch(fast_words)):
+                entries[word] = (encoding.tokens, encoding.ids)
+        return entries
+
+
+def get_word_tokenizer(tokenizer, backend='slow', cache_dir=None, cache_size=CACHE_SIZE, reuse=True):
+    """
+    This function returns the word tokenizer of a tokenizer.
+    The word tokenizers are kept by the process and reused, with their
+    cache, by the next calls with a tokenizer with the same fingerprint
+    (see tokenizer_fingerprint).
+    The fast backend needs the tokenizers library and a BertTokenizer,
+    otherwise the slow one is used
+
+    @param tokenizer the tokenizer of transformers
+    @param backend one of BACKENDS
+    @param cache_dir directory of the sqlite files of the caches, None to
+        keep the cache only in memory
+    @param cache_size maximum number of words kept in memory
+    @param reuse if False a new word tokenizer is built (with an empty
+        memory cache) and not kept, e.g. to measure the tokenization
+
+    @return the WordTokenizer
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown tokenizer backend: {}".format(backend))
+    if backend == 'fast':
+        if BertWordPieceTokenizer is None:
+            print("The tokenizers library is not installed, using the slow tokenizer")
+            backend = 'slow'
+        elif not isinstance(tokenizer, BertTokenizer):
+            print("The fast tokenizer supports only BertTokenizer, using the slow tokenizer")
+            backend = 'slow'
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    # sqlite connections must not be shared with forked processes
+    key = (os.getpid(), fingerprint, backend, cache_dir, cache_size)
+    word_tokenizer = _word_tokenizers.get(key) if reuse else None
+    if word_tokenizer is None:
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, 'word_pieces-{}-{}.sqlite'.format(fingerprint, backend))
+        cache = WordPieceCache(cache_path, cache_size)
+        if backend == 'fast':
+            word_tokenizer = FastWordTokenizer(tokenizer, cache)
+        else:
+            word_tokenizer = WordTokenizer(tokenizer, cache)
+        if reuse:
+            _word_tokenizers[key] = word_tokenizer
+    return word_tokenizer